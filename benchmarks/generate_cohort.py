@@ -0,0 +1,364 @@
+""" Generate a synthetic cohort that mimics the layout of the OSF data, so the pipelines can be run without it.
+
+The cohort contains:
+- Raw FIF recordings with a `Status` trigger channel (onset and target triggers) and EXG channels
+- Stereo WAV stimuli with the cue in the second channel
+- MFA-like TextGrids with word and phone tiers
+- The stimuli sentence table, participant logs and participant information
+- The YAML configurations of all pipeline stages, derived from the repository configurations
+
+"""
+
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import yaml
+from scipy.io import wavfile
+from scipy.signal import butter, sosfilt
+from helpers import load_config
+
+import mne
+
+REPO_FOLDER = Path(__file__).resolve().parent.parent
+
+WORDS = ['erika', 'hat', 'heute', 'dass', 'die', 'den', 'gatten', 'peter', 'kauft', 'neun', 'alte', 'sessel']
+
+
+def get_stimuli_names(n_stimuli: int) -> list:
+    """ Stimuli names, half of them in the context and half in the random condition. """
+    n_context = n_stimuli // 2
+    context = [f'context{str(i).zfill(3)}' for i in range(1, n_context + 1)]
+    random = [f'random{str(i).zfill(3)}' for i in range(1, n_stimuli - n_context + 1)]
+
+    return context + random
+
+
+def make_speech(duration: float, sfreq: int, rng: np.random.Generator) -> np.ndarray:
+    """ Speech-like noise: band-limited noise modulated at phrase, word and syllable rates.
+
+    Parameters
+    ----------
+    duration : float
+        Duration of the speech signal in seconds.
+    sfreq : int
+        Sampling frequency of the speech signal.
+    rng : np.random.Generator
+        Random number generator.
+
+    Returns
+    -------
+    speech : np.ndarray
+        Speech signal scaled to the int16 range.
+
+    """
+    times = np.arange(int(duration * sfreq)) / sfreq
+    carrier = sosfilt(butter(4, [100, min(4000, 0.4 * sfreq)], btype='band', fs=sfreq, output='sos'),
+                      rng.standard_normal(times.shape[0]))
+
+    modulation = np.ones_like(times)
+    for rate in (0.7, 2.4, 4.2):
+        modulation *= 1 + np.sin(2 * np.pi * rate * times + rng.uniform(0, 2 * np.pi))
+
+    speech = carrier * modulation
+    speech = 0.5 * speech / np.max(np.abs(speech)) * 2**15
+
+    return speech
+
+
+def write_textgrid(path: Path, duration: float, n_words: int, n_phones_per_word: int, rng: np.random.Generator) -> None:
+    """ Write a TextGrid with a word and a phone tier, the last word interval being the offset silence.
+
+    Parameters
+    ----------
+    path : Path
+        Path of the TextGrid.
+    duration : float
+        Duration of the stimulus in seconds.
+    n_words : int
+        Number of words in the sentence.
+    n_phones_per_word : int
+        Number of phones per word.
+    rng : np.random.Generator
+        Random number generator.
+
+    """
+    speech_end = 0.9 * duration
+    word_bounds = np.linspace(0, speech_end, n_words + 1)
+    words = [(word_bounds[i], word_bounds[i + 1], rng.choice(WORDS)) for i in range(n_words)]
+    words.append((speech_end, duration, ''))
+
+    phones = []
+    for start, end, mark in words[:-1]:
+        phone_bounds = np.linspace(start, end, n_phones_per_word + 1)
+        phones += [(phone_bounds[i], phone_bounds[i + 1], mark[i % len(mark)]) for i in range(n_phones_per_word)]
+    phones.append((speech_end, duration, ''))
+
+    lines = [
+        'File type = "ooTextFile"',
+        'Object class = "TextGrid"',
+        '',
+        'xmin = 0 ',
+        f'xmax = {duration} ',
+        'tiers? <exists> ',
+        'size = 2 ',
+        'item []: '
+    ]
+    for tier_idx, (name, intervals) in enumerate([('words', words), ('phones', phones)]):
+        lines += [
+            f'    item [{tier_idx + 1}]:',
+            '        class = "IntervalTier" ',
+            f'        name = "{name}" ',
+            '        xmin = 0 ',
+            f'        xmax = {duration} ',
+            f'        intervals: size = {len(intervals)} '
+        ]
+        for idx, (start, end, mark) in enumerate(intervals):
+            lines += [
+                f'        intervals [{idx + 1}]:',
+                f'            xmin = {round(start, 4)} ',
+                f'            xmax = {round(end, 4)} ',
+                f'            text = "{mark}" '
+            ]
+
+    path.write_text('\n'.join(lines) + '\n')
+
+
+def write_raw(
+    path: Path,
+    montage: str,
+    sfreq: float,
+    onset_samples: np.ndarray,
+    target_samples: np.ndarray,
+    target_codes: np.ndarray,
+    n_samples: int,
+    rng: np.random.Generator
+) -> None:
+    """ Write a raw FIF recording with EEG, EXG and `Status` trigger channels.
+
+    Parameters
+    ----------
+    path : Path
+        Path of the raw FIF file.
+    montage : str
+        Name of the standard montage providing the EEG channel names.
+    sfreq : float
+        Sampling frequency of the recording.
+    onset_samples : np.ndarray
+        Samples of the sentence onset triggers.
+    target_samples : np.ndarray
+        Samples of the target triggers.
+    target_codes : np.ndarray
+        Trigger codes of the target triggers.
+    n_samples : int
+        Length of the recording in samples.
+    rng : np.random.Generator
+        Random number generator.
+
+    """
+    eeg_channels = mne.channels.make_standard_montage(montage).ch_names
+    exg_channels = [f'EXG{i}' for i in range(1, 9)]
+    ch_names = eeg_channels + exg_channels + ['Status']
+    ch_types = ['eeg'] * len(eeg_channels) + ['misc'] * len(exg_channels) + ['stim']
+    info = mne.create_info(ch_names, sfreq, ch_types)
+
+    data = np.empty((len(ch_names), n_samples))
+    data[:-1] = rng.standard_normal((len(ch_names) - 1, n_samples)) * 1e-5
+
+    # Line noise at 50 Hz and its harmonics, so the notch filters have something to remove
+    times = np.arange(n_samples) / sfreq
+    for line_frequency in (50, 100, 150):
+        data[:-1] += 2e-6 * np.sin(2 * np.pi * line_frequency * times)
+
+    status = np.zeros(n_samples)
+    pulse = max(int(0.005 * sfreq), 1)
+    for sample in onset_samples:
+        status[sample:sample + pulse] = 256
+    for sample, code in zip(target_samples, target_codes):
+        status[sample:sample + pulse] = code
+    data[-1] = status
+
+    raw = mne.io.RawArray(data, info, verbose=False)
+    raw.save(path, overwrite=True, verbose=False)
+
+
+def generate_cohort(cohort: dict, work_folder: Path, seed: int) -> dict:
+    """ Generate the synthetic cohort and the configurations of all stages.
+
+    Parameters
+    ----------
+    cohort : dict
+        Scale of the cohort (participants, montage, stimuli, durations, sampling frequencies).
+    work_folder : Path
+        Folder the data and configurations are written to.
+    seed : int
+        Seed of the random number generator.
+
+    Returns
+    -------
+    config_folders : dict
+        Folder containing the configuration of each pipeline folder, keyed by pipeline folder.
+
+    """
+    rng = np.random.default_rng(seed)
+    data_folder = work_folder / 'data'
+
+    folders = {
+        name: data_folder / name
+        for name in ['raw', 'raw_cued', 'aligned', 'logs', 'preprocessed', 'evoked', 'plots', 'bands']
+    }
+    for folder in folders.values():
+        folder.mkdir(parents=True, exist_ok=True)
+
+    n_participants = cohort['n_participants']
+    participants = ['p' + str(i).zfill(2) for i in range(1, n_participants + 1)]
+    stimuli = get_stimuli_names(cohort['n_stimuli'])
+    duration = cohort['stimulus_duration_s']
+    sfreq_wav = cohort['sfreq_wav']
+    sfreq_eeg = cohort['sfreq_eeg']
+    trial_interval = max(cohort['trial_interval_s'], duration + 5.0)
+
+    # Stimuli: stereo WAVs with the cue in the second channel, sentence table and TextGrids
+    sentences = []
+    for stimulus in stimuli:
+        lead = int(rng.uniform(0.1, 0.3) * sfreq_wav)
+        speech = make_speech(duration, sfreq_wav, rng)
+        data = np.zeros((lead + speech.shape[0], 2), dtype=np.int16)
+        data[lead:, 0] = speech.astype(np.int16)
+        data[lead, 1] = 2**14
+        wavfile.write(folders['raw_cued'] / f'{stimulus}_70dB_cued.wav', sfreq_wav, data)
+
+        n_words = int(rng.integers(8, 14))
+        write_textgrid(folders['aligned'] / f'{stimulus}_70dB.TextGrid', duration, n_words, 3, rng)
+        sentences.append((stimulus, ' '.join(rng.choice(WORDS, n_words)), 2 * n_words))
+
+    sentences_file = data_folder / 'matrix_sentences.xlsx'
+    pd.DataFrame(sentences).to_excel(sentences_file, header=False, index=False)
+
+    # Participants: logs in randomized order, participant information and raw recordings
+    logs_txt_extension = '-matrix_sentences_order.txt'
+    raw_fif_extension = '_matrix_raw.fif'
+    target_delay = duration / 2
+
+    for participant in participants:
+        order = rng.permutation(stimuli)
+        log = pd.DataFrame({
+            'file': order,
+            'hit': rng.binomial(1, 0.8, len(order)),
+            'RT': rng.integers(500, 2000, len(order))
+        })
+        log.to_csv(folders['logs'] / f'{participant}{logs_txt_extension}', sep='\t', index=False)
+
+        onsets = (3.0 + np.arange(len(order)) * trial_interval) * sfreq_eeg
+        target_codes = np.array([82 if name.startswith('context') else 92 for name in order])
+        write_raw(
+            folders['raw'] / f'{participant}{raw_fif_extension}',
+            montage=cohort['montage'],
+            sfreq=sfreq_eeg,
+            onset_samples=onsets.astype(int),
+            target_samples=(onsets + target_delay * sfreq_eeg).astype(int),
+            target_codes=target_codes,
+            n_samples=int(onsets[-1] + 12.0 * sfreq_eeg),
+            rng=rng
+        )
+
+    participant_file = data_folder / 'participant_info.csv'
+    pd.DataFrame({
+        'participant_id': participants,
+        'age': rng.integers(60, 85, n_participants),
+        'MoCA_score': rng.integers(20, 31, n_participants),
+        'MoCA_group': rng.choice(['normal', 'low'], n_participants),
+        'PTA_dB': rng.uniform(10, 40, n_participants).round(1)
+    }).to_csv(participant_file, index=False)
+
+    # Configurations: the repository configurations with paths and scale replaced
+    config_folders = {}
+    center_freqs = {'low': 20, 'high': int(min(20000, 0.45 * sfreq_wav)), 'N': cohort['n_gammatone_filters']}
+
+    eeg_config = load_config(REPO_FOLDER / 'preprocess' / 'eeg' / 'eeg_config.yaml')
+    eeg_config.update({
+        'raw_folder': str(folders['raw']),
+        'preprocessed_folder': str(folders['preprocessed']),
+        'evoked_folder': str(folders['evoked']),
+        'plots_folder': str(folders['plots']),
+        'interpolation_folder': str(data_folder / 'interpolation'),
+        'logs_folder': str(folders['logs'])
+    })
+    eeg_config['files_parameters']['no_participants'] = n_participants
+    eeg_config['eeg_parameters']['p21_extra_events_t'] = []
+    eeg_config['channels']['montage'] = cohort['montage']
+    eeg_config['channels']['bad_mastoids'] = []
+    eeg_config['channels']['bad_eog'] = []
+    eeg_config['channels']['bad_cap'] = {participant: [] for participant in participants}
+    eeg_config['channels']['onset_ica_components'] = {participant: [0] for participant in participants}
+    eeg_config['channels']['target_ica_components'] = {participant: [0] for participant in participants}
+    eeg_config['eeg_parameters']['sfreq_goal'] = cohort['sfreq_eeg_goal']
+    config_folders['eeg'] = write_config(eeg_config, work_folder / 'configs' / 'eeg', 'eeg_config.yaml')
+
+    speech_config = load_config(REPO_FOLDER / 'preprocess' / 'speech' / 'speech_config.yaml')
+    speech_config['raw_stimuli_folder'] = str(folders['raw_cued'])
+    speech_config['output_folder'] = str(data_folder / 'speech_output')
+    speech_config['mfa_parameters']['sentences_filename'] = str(sentences_file)
+    speech_config['mfa_parameters']['final_output'] = str(folders['aligned'])
+    speech_config['stimuli_parameters']['stimuli_folder'] = str(data_folder / 'stimuli')
+    speech_config['stimuli_parameters']['sfreq'] = sfreq_wav
+    speech_config['gammatone_parameters']['gammatone_center_freqs'] = dict(center_freqs)
+    config_folders['speech'] = write_config(speech_config, work_folder / 'configs' / 'speech', 'speech_config.yaml')
+
+    tracking_config = load_config(REPO_FOLDER / 'tracking' / 'tracking_config.yaml')
+    tracking_config.update({
+        'eeg_folder': str(folders['preprocessed'] / eeg_config['onset_epochs_params']['folder']),
+        'speech_folder': str(data_folder / 'stimuli'),
+        'logs_folder': str(folders['logs']),
+        'bands_folder': str(folders['bands']),
+        'output_folder': str(data_folder / 'tracking_output')
+    })
+    tracking_config['files_parameters']['no_participants'] = n_participants
+    tracking_config['files_parameters']['eeg_montage'] = cohort['montage']
+    tracking_config['files_parameters']['sentences_filename'] = str(sentences_file)
+    tracking_config['filtering_parameters']['sfreq_wav'] = sfreq_wav
+    tracking_config['filtering_parameters']['sfreq_eeg'] = cohort['sfreq_eeg_goal']
+    tracking_config['filtering_parameters']['gammatone_center_freqs'] = dict(center_freqs)
+    tracking_config['filtering_parameters']['mean_length_s'] = duration
+    config_folders['tracking'] = write_config(tracking_config, work_folder / 'configs' / 'tracking',
+                                              'tracking_config.yaml')
+
+    evoked_config = load_config(REPO_FOLDER / 'evoked' / 'evoked_config.yaml')
+    evoked_config['evoked_folder'] = str(folders['evoked'])
+    evoked_config['output_folder'] = str(data_folder / 'evoked_output')
+    evoked_config['files_parameters']['no_participants'] = n_participants
+    evoked_config['resampling']['preprocessed_folder'] = str(folders['preprocessed'])
+    evoked_config['resampling']['logs_folder'] = str(folders['logs'])
+    config_folders['evoked'] = write_config(evoked_config, work_folder / 'configs' / 'evoked', 'evoked_config.yaml')
+
+    statistics_config = load_config(REPO_FOLDER / 'statistics' / 'statistics_config.yaml')
+    statistics_config.update({
+        'logs_folder': str(folders['logs']),
+        'data_folder': str(data_folder / 'statistics_output'),
+        'participant_file': str(participant_file),
+        'tracking_file': str(data_folder / 'tracking_output' / tracking_config['files_parameters']['csv_filename'])
+    })
+    statistics_config['track_files_parameters']['no_participants'] = n_participants
+    config_folders['statistics'] = write_config(statistics_config, work_folder / 'configs' / 'statistics',
+                                                'statistics_config.yaml')
+
+    sweep_config = load_config(REPO_FOLDER / 'sweep_config.yaml')
+    sweep_config['configs'] = ['../tracking', '../eeg']
+    sweep_config['work_folder'] = str(data_folder / 'sweep')
+    sweep_config['output_folder'] = str(data_folder / 'sweep_output')
+    config_folders['sweep'] = write_config(sweep_config, work_folder / 'configs' / 'sweep', 'sweep_config.yaml')
+
+    return config_folders
+
+
+def write_config(config: dict, folder: Path, filename: str) -> Path:
+    """ Write a configuration to a YAML file and return its folder. """
+    folder.mkdir(parents=True, exist_ok=True)
+    with open(folder / filename, 'w') as file:
+        yaml.safe_dump(config, file, sort_keys=False)
+
+    return folder
+
+
+if __name__ == '__main__':
+    config = load_config('benchmark_config.yaml')
+    generate_cohort(config['cohort'], Path(config['work_folder']).resolve(), seed=config['seed'])
@@ -0,0 +1,273 @@
+""" Time and memory-profile the pipeline stages on a synthetic cohort.
+
+Each stage runs in its own process from the folder holding its configuration, exactly like the scripts are run by
+hand. Wall time, CPU time and peak resident memory of every stage are stored as JSON in the results folder and, if a
+baseline results file is configured, compared against it.
+
+"""
+
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+from helpers import load_config
+
+REPO_FOLDER = Path(__file__).resolve().parent.parent
+
+STAGES = {
+    'cut_stimuli': {
+        'folder': 'preprocess/speech',
+        'config': 'speech',
+        'script': 'cut_stimuli.py'
+    },
+    'get_linguistic_properties': {
+        'folder': 'preprocess/speech',
+        'config': 'speech',
+        'script': 'get_linguistic_properties.py'
+    },
+    'compute_modulation_spectrum': {
+        'folder': 'preprocess/speech',
+        'config': 'speech',
+        'script': 'compute_modulation_spectrum.py'
+    },
+    'run_preprocessing': {
+        'folder': 'preprocess/eeg',
+        'config': 'eeg',
+        'code': (
+            'from helpers import load_config\n'
+            'from preprocess import run_preprocessing\n'
+            'config = load_config("eeg_config.yaml")\n'
+            'run_preprocessing(config, segment_to="onset")\n'
+            'run_preprocessing(config, segment_to="target")\n'
+        )
+    },
+    'get_evoked': {
+        'folder': 'preprocess/eeg',
+        'config': 'eeg',
+        'script': 'get_evoked.py'
+    },
+    'get_N400_clusters': {
+        'folder': 'evoked',
+        'config': 'evoked',
+        'script': 'get_N400_clusters.py'
+    },
+    'get_peak_resampling': {
+        'folder': 'evoked',
+        'config': 'evoked',
+        'script': 'get_peak_resampling.py'
+    },
+    'filter_in_frequencybands': {
+        'folder': 'tracking',
+        'config': 'tracking',
+        'script': 'filter_in_frequencybands.py'
+    },
+    'calculate_phase_locking': {
+        'folder': 'tracking',
+        'config': 'tracking',
+        'script': 'calculate_phase_locking.py'
+    },
+    'calculate_trf': {
+        'folder': 'tracking',
+        'config': 'tracking',
+        'script': 'calculate_trf.py'
+    },
+    'calculate_coherence_spectrum': {
+        'folder': 'tracking',
+        'config': 'tracking',
+        'script': 'calculate_coherence_spectrum.py'
+    },
+    'stream_tracking': {
+        'folder': 'tracking',
+        'config': 'tracking',
+        'script': 'stream_tracking.py'
+    },
+    'get_tracking_df': {
+        'folder': 'statistics',
+        'config': 'statistics',
+        'code': (
+            'from get_dataframes import load_config, get_tracking_df\n'
+            'get_tracking_df(load_config("statistics_config.yaml"))\n'
+        )
+    },
+    'sweep': {
+        'folder': '.',
+        'config': 'sweep',
+        'code': (
+            'import shutil, sys, yaml\n'
+            'from neuroscales import main\n'
+            '# Cold sweep: the nodes of earlier runs would be reused\n'
+            'shutil.rmtree(yaml.safe_load(open("sweep_config.yaml"))["work_folder"], ignore_errors=True)\n'
+            'sys.exit(main(["sweep", "sweep_config.yaml"]))\n'
+        )
+    },
+    'cli_startup': {
+        'folder': '.',
+        'config': 'tracking',
+        'code': (
+            'import sys\n'
+            'from neuroscales import main\n'
+            'sys.exit(main(["check", "--configs", "../speech", "../eeg", "../evoked", ".", "../statistics"]))\n'
+        )
+    }
+}
+
+
+def prepare_cohort(config: dict, work_folder: Path) -> dict:
+    """ Generate the synthetic cohort unless one with the same scale, seed and repository configurations exists.
+
+    The cohort is generated in a child process: the stages are forked from this process, and a parent that imported
+    MNE would inflate the peak memory reported for every stage.
+
+    """
+    cohort_file = work_folder / 'cohort.json'
+    cohort = {'seed': config['seed'], **config['cohort']}
+    # The stage configurations are derived from the repository configurations, so changes to them regenerate the cohort
+    cohort['configs'] = {
+        str(path.relative_to(REPO_FOLDER)): hashlib.sha1(path.read_bytes()).hexdigest()
+        for path in sorted(REPO_FOLDER.glob('**/*_config.yaml'))
+        if 'benchmarks' not in path.parts
+    }
+
+    if not cohort_file.exists() or json.loads(cohort_file.read_text()) != cohort:
+        print(f'Generating synthetic cohort in {work_folder}')
+        subprocess.run([sys.executable, str(Path(__file__).parent / 'generate_cohort.py')], check=True)
+        cohort_file.write_text(json.dumps(cohort, indent=1))
+
+    return {name: work_folder / 'configs' / name for name in ['eeg', 'speech', 'evoked', 'tracking', 'statistics', 'sweep']}
+
+
+def run_stage(stage: dict, config_folder: Path, log_file: Path, trace_folder: Path | None = None) -> dict:
+    """ Run a stage in a child process and measure its resource usage.
+
+    Parameters
+    ----------
+    stage : dict
+        Stage definition with the pipeline folder, and either the script or the code to run.
+    config_folder : Path
+        Folder containing the stage's configuration, used as working directory.
+    log_file : Path
+        File the stage's output is written to.
+    trace_folder : Path | None
+        If given, the stage's scripts record their instrumented stages in this folder.
+
+    Returns
+    -------
+    result : dict
+        Return code, wall time, CPU time and peak resident memory of the stage.
+
+    """
+    folder = REPO_FOLDER / stage['folder']
+    if 'script' in stage:
+        command = [sys.executable, str(folder / stage['script'])]
+    else:
+        command = [sys.executable, '-c', stage['code']]
+
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [str(folder), str(REPO_FOLDER), env.get('PYTHONPATH')]))
+    if trace_folder is not None:
+        env['NEUROSCALES_TRACE'] = str(trace_folder)
+
+    with open(log_file, 'w') as log:
+        start = time.perf_counter()
+        process = subprocess.Popen(command, cwd=config_folder, env=env, stdout=log, stderr=subprocess.STDOUT)
+        # wait4 reports the resource usage of this child only, unlike getrusage(RUSAGE_CHILDREN)
+        _, status, usage = os.wait4(process.pid, 0)
+        wall_time = time.perf_counter() - start
+        process.returncode = os.waitstatus_to_exitcode(status)
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak_rss = usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024
+
+    return {
+        'returncode': process.returncode,
+        'wall_s': round(wall_time, 3),
+        'cpu_s': round(usage.ru_utime + usage.ru_stime, 3),
+        'peak_rss_mb': round(peak_rss / 2**20, 1)
+    }
+
+
+def compare_results(results: dict, baseline: dict, threshold: float) -> list:
+    """ Print the results next to the baseline and return the stages that regressed. """
+    regressions = []
+    print(f'{"stage":<30}{"wall [s]":>10}{"baseline":>10}{"ratio":>8}{"RSS [MB]":>10}{"baseline":>10}{"ratio":>8}')
+
+    for name, result in results['stages'].items():
+        reference = baseline['stages'].get(name)
+        if reference is None or result['returncode'] != 0 or reference['returncode'] != 0:
+            print(f'{name:<30}{result["wall_s"]:>10.2f}{"-":>10}{"-":>8}{result["peak_rss_mb"]:>10.1f}{"-":>10}{"-":>8}')
+            continue
+
+        wall_ratio = result['wall_s'] / max(reference['wall_s'], 1e-9)
+        rss_ratio = result['peak_rss_mb'] / max(reference['peak_rss_mb'], 1e-9)
+        flag = '  <-- regression' if max(wall_ratio, rss_ratio) > threshold else ''
+        if flag:
+            regressions.append(name)
+        print(
+            f'{name:<30}{result["wall_s"]:>10.2f}{reference["wall_s"]:>10.2f}{wall_ratio:>8.2f}'
+            f'{result["peak_rss_mb"]:>10.1f}{reference["peak_rss_mb"]:>10.1f}{rss_ratio:>8.2f}{flag}'
+        )
+
+    return regressions
+
+
+def check_budgets(results: dict, budgets: dict) -> list:
+    """ Return the stages whose wall time exceeds their budget in seconds. """
+    over_budget = []
+    for name, budget in budgets.items():
+        result = results['stages'].get(name)
+        if result is not None and result['wall_s'] > budget:
+            print(f'Stage `{name}` took {result["wall_s"]:.2f} s, over its budget of {budget:.2f} s')
+            over_budget.append(name)
+
+    return over_budget
+
+
+if __name__ == '__main__':
+    config = load_config('benchmark_config.yaml')
+
+    work_folder = Path(config['work_folder']).resolve()
+    results_folder = Path(config['results_folder'])
+    logs_folder = work_folder / 'logs'
+    results_folder.mkdir(parents=True, exist_ok=True)
+    logs_folder.mkdir(parents=True, exist_ok=True)
+
+    config_folders = prepare_cohort(config, work_folder)
+
+    results = {
+        'label': config['label'] or datetime.now().strftime('%Y%m%d-%H%M%S'),
+        'cohort': config['cohort'],
+        'python': sys.version.split()[0],
+        'platform': sys.platform,
+        'cpu_count': os.cpu_count(),
+        'stages': {}
+    }
+
+    for name in config['stages']:
+        stage = STAGES[name]
+        print(f'Running stage `{name}`')
+        trace_folder = work_folder / 'traces' / name if config['trace'] else None
+        result = run_stage(stage, config_folders[stage['config']], logs_folder / f'{name}.log', trace_folder)
+        results['stages'][name] = result
+        print(f'  {result["wall_s"]:.2f} s wall, {result["cpu_s"]:.2f} s CPU, {result["peak_rss_mb"]:.1f} MB peak RSS')
+
+        if result['returncode'] != 0:
+            print(f'  stage failed, see {logs_folder / f"{name}.log"}; skipping the remaining stages')
+            break
+
+    results_file = results_folder / f'{results["label"]}.json'
+    results_file.write_text(json.dumps(results, indent=1))
+    print(f'Results written to {results_file}')
+
+    regressions = []
+    if config['baseline_file'] is not None:
+        baseline = json.loads(Path(config['baseline_file']).read_text())
+        regressions = compare_results(results, baseline, config['regression_threshold'])
+
+    over_budget = check_budgets(results, config['budgets'] or {})
+
+    if regressions or over_budget:
+        sys.exit(f'Regressions or exceeded budgets in: {", ".join(regressions + over_budget)}')
@@ -0,0 +1,120 @@
+""" Atomic per-unit outputs and a manifest of completed units, to resume long participant loops.
+
+A unit is one job of a participant loop, e.g., a participant and band. Its outputs are first written to a temporary
+folder next to them and only moved in place once the unit succeeded, so an output either is complete or does not
+exist. Completed units are recorded in a manifest (`.json` file) with a fingerprint of the parameters, code and input
+files they were computed from. In resume mode, units with the same fingerprint whose outputs exist are skipped, so a
+crash only costs the units that were running.
+
+The code a unit depends on is fingerprinted with `code_fingerprint`, which covers the modules the scripts import.
+
+Usage:
+    manifest = RunManifest(output_folder / 'manifest.json', resume=True)
+    unit_fingerprint = fingerprint(code_fingerprint(Path(__file__).parent), parameters, file_fingerprint(input_file))
+    if not manifest.completed('p01/phrase_rate', unit_fingerprint, [output_file]):
+        with atomic_output(output_file) as partial_file:
+            np.save(partial_file, result)
+        manifest.record('p01/phrase_rate', unit_fingerprint, [output_file])
+
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+REPO_FOLDER = Path(__file__).resolve().parent
+
+# Modules at the repository root that are entry points rather than modules shared by the pipelines
+ENTRY_POINTS = ('neuroscales.py', 'sweep.py')
+
+
+def fingerprint(*parts) -> str:
+    """ Hash of JSON-serializable parts, e.g., parameters, source code and file fingerprints. """
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def code_fingerprint(folder: Path) -> str:
+    """ Hash of the code of a pipeline folder: its modules, i.e., the scripts and the modules they import (e.g.,
+    `tracking_utils.py`), and the modules shared from the repository root (e.g., `scheduler.py`). """
+    code = hashlib.sha1()
+    modules = sorted(Path(folder).glob('*.py')) + [
+        path for path in sorted(REPO_FOLDER.glob('*.py')) if path.name not in ENTRY_POINTS
+    ]
+    for module in modules:
+        code.update(module.name.encode())
+        code.update(module.read_bytes())
+
+    return code.hexdigest()
+
+
+def file_fingerprint(path: Path) -> list:
+    """ Size and modification time of a file, changed whenever the file is rewritten. """
+    stat = Path(path).stat()
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+@contextmanager
+def atomic_output(path: Path):
+    """ Yield a temporary path for an output, whose files are moved next to `path` if the block succeeds.
+
+    The temporary path has the output's name in the folder `.partial_<name>`, so file name conventions (e.g., `_epo.fif`
+    or `.npy`) hold, and split files written alongside it (e.g., `_epo-1.fif`) are moved as well. If the block fails,
+    the temporary files are removed and an earlier output is left untouched.
+
+    """
+    path = Path(path)
+    partial_folder = path.parent / f'.partial_{path.name}'
+    shutil.rmtree(partial_folder, ignore_errors=True)
+    partial_folder.mkdir(parents=True)
+    try:
+        yield partial_folder / path.name
+        for partial_file in partial_folder.iterdir():
+            os.replace(partial_file, path.parent / partial_file.name)
+    finally:
+        shutil.rmtree(partial_folder, ignore_errors=True)
+
+
+class RunManifest:
+    """ Completed units of a participant loop with the fingerprints and outputs they were recorded with.
+
+    Parameters
+    ----------
+    manifest_file : Path
+        `.json` file of the manifest, created on the first recorded unit.
+    resume : bool
+        Whether completed units are skipped. Units are recorded either way, so a later run can resume.
+
+    """
+
+    def __init__(self, manifest_file: Path, resume: bool = False):
+        self.manifest_file = Path(manifest_file)
+        self.resume = resume
+        self.units = {}
+        if self.manifest_file.exists():
+            self.units = json.loads(self.manifest_file.read_text())
+
+    def completed(self, unit: str, unit_fingerprint: str, outputs: list) -> bool:
+        """ Whether a unit can be skipped: resuming, recorded with the same fingerprint and all outputs exist. """
+        entry = self.units.get(unit)
+        return (
+            self.resume
+            and entry is not None
+            and entry['fingerprint'] == unit_fingerprint
+            and all(Path(output).exists() for output in outputs)
+        )
+
+    def record(self, unit: str, unit_fingerprint: str, outputs: list) -> None:
+        """ Record a completed unit and persist the manifest (written to a temporary file and renamed). """
+        self.units[unit] = {
+            'fingerprint': unit_fingerprint,
+            'outputs': [Path(output).name for output in outputs],
+            'completed': time.strftime('%Y-%m-%dT%H:%M:%S')
+        }
+        self.manifest_file.parent.mkdir(parents=True, exist_ok=True)
+        partial_file = self.manifest_file.with_name(f'.partial_{self.manifest_file.name}')
+        partial_file.write_text(json.dumps(self.units, indent=1))
+        os.replace(partial_file, self.manifest_file)
@@ -0,0 +1,89 @@
+""" Spatiotemporal cluster permutation test of the context vs. random evoked responses.
+
+Complements the N400 peak-window amplitudes of `get_N400_data.py` with a test over all channels and time points of
+the test window, see `cluster_permutation.py`. The clusters with their polarity, mass, p-value, time range and
+channels are stored as `.csv` file; the t-values, cluster masks and null distribution as `.npz` file.
+
+"""
+
+from pathlib import Path
+from helpers import load_config
+from cluster_permutation import spatiotemporal_adjacency, cluster_permutation_test
+import pandas as pd
+import numpy as np
+import mne
+mne.set_log_level('ERROR')
+
+
+if __name__ == '__main__':
+    # Load configuration
+    config = load_config('evoked_config.yaml')
+
+    no_participants = config['files_parameters']['no_participants']
+    participants = ['p' + str(i).zfill(2) for i in range(1, no_participants + 1)]
+
+    out_folder = Path(config['output_folder'])
+    out_folder.mkdir(parents=True, exist_ok=True)
+
+    evoked_params = config['evoked_parameters']['N400']
+    evoked_folder = Path(config['evoked_folder']) / Path(evoked_params['subfolder'])
+    context_file_extension = evoked_params['context_file_extension']
+    random_file_extension = evoked_params['random_file_extension']
+
+    permutation_params = config['cluster_permutation']
+    window = permutation_params['window']
+
+    # Paired differences of all participants (participants x times x channels), the layout of the adjacency
+    differences = []
+    for participant in participants:
+        evoked_context = mne.read_evokeds(evoked_folder / (participant + context_file_extension))[0]
+        evoked_random = mne.read_evokeds(evoked_folder / (participant + random_file_extension))[0]
+        evoked_context.pick('eeg').crop(tmin=window[0], tmax=window[1])
+        evoked_random.pick('eeg').crop(tmin=window[0], tmax=window[1])
+        differences.append((evoked_context.get_data() - evoked_random.get_data()).T)
+
+    differences = np.stack(differences)
+    info = evoked_context.info
+    times = evoked_context.times
+    channel_names = np.array(info['ch_names'])
+
+    adjacency = spatiotemporal_adjacency(info, n_times=times.shape[0])
+
+    t_obs, clusters, p_values, h0 = cluster_permutation_test(
+        differences,
+        adjacency,
+        threshold=permutation_params['threshold'],
+        tail=permutation_params['tail'],
+        n_permutations=permutation_params['n_permutations'],
+        batch_size=permutation_params['batch_size'],
+        n_jobs=permutation_params['n_jobs'],
+        seed=permutation_params['seed']
+    )
+
+    rows = []
+    for cluster_idx, (mask, p_value) in enumerate(zip(clusters, p_values)):
+        cluster_times = times[mask.any(axis=1)]
+        mass = t_obs[mask].sum()
+        rows.append({
+            'cluster_id': cluster_idx,
+            'polarity': 'positive' if mass > 0 else 'negative',
+            'mass': mass,
+            'p_value': p_value,
+            'tmin_ms': int(round(cluster_times[0] * 1e3)),
+            'tmax_ms': int(round(cluster_times[-1] * 1e3)),
+            'channels': ' '.join(channel_names[mask.any(axis=0)])
+        })
+
+    columns = ['cluster_id', 'polarity', 'mass', 'p_value', 'tmin_ms', 'tmax_ms', 'channels']
+    clusters_df = pd.DataFrame(rows, columns=columns).sort_values('p_value', kind='stable')
+    clusters_df.to_csv(out_folder / permutation_params['clusters_filename'], index=False)
+
+    np.savez(
+        out_folder / permutation_params['stats_filename'],
+        t_obs=t_obs.T,
+        clusters=np.array([mask.T for mask in clusters], dtype=bool).reshape(-1, *t_obs.T.shape),
+        p_values=p_values,
+        h0=h0,
+        times=times,
+        channels=channel_names
+    )
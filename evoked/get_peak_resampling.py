@@ -0,0 +1,231 @@
+""" Jackknife and bootstrap estimates of the AEP (P1, N1, P2) and N400 peak latencies and amplitudes.
+
+Complements the single-participant peaks of `get_AEP_data.py` and `get_N400_data.py`, see `resampling.py`:
+
+- Jackknife over participants, from the evoked responses: the peaks of the grand average with their jackknife standard
+  errors, and the peaks of the leave-one-out grand averages with the retrieved individual estimates.
+- Bootstrap over the trials of each participant, from the preprocessed epochs processed as in `get_evoked.py`: the
+  peaks of the participant's average with their bootstrap standard errors and confidence intervals.
+
+As in `get_N400_data.py`, the N400 latency is the peak of the random condition and both amplitudes are taken at it.
+
+"""
+
+from pathlib import Path
+from helpers import load_config
+from resampling import (
+    amplitudes_around, find_peaks, jackknife_averages, jackknife_statistics, bootstrap_averages, bootstrap_statistics
+)
+import pandas as pd
+import numpy as np
+import mne
+mne.set_log_level('ERROR')
+
+
+def aep_peaks(signals: np.ndarray, times: np.ndarray, sfreq: float, params: dict) -> dict:
+    """ Latencies and amplitudes of the P1, N1 and P2 peaks of the signals (resamples x times). """
+    peaks = {}
+    for component, polarity in [('P1', 'positive'), ('N1', 'negative'), ('P2', 'positive')]:
+        latencies, peak_idx = find_peaks(signals, times, params[f'{component}_window'], polarity)
+        peaks[component] = (latencies, amplitudes_around(signals, peak_idx, sfreq, params['window_area']))
+
+    return peaks
+
+
+def n400_peaks(random: np.ndarray, context: np.ndarray, times: np.ndarray, sfreq: float, params: dict) -> dict:
+    """ Latencies and amplitudes of the N400 peaks of the random and context signals (resamples x times), both at the
+    latency of the random condition. """
+    latencies, peak_idx = find_peaks(random, times, params['window'], 'negative')
+
+    return {
+        'N400_random': (latencies, amplitudes_around(random, peak_idx, sfreq, params['window_area'])),
+        'N400_context': (latencies, amplitudes_around(context, peak_idx, sfreq, params['window_area']))
+    }
+
+
+def load_trials(
+    epochs_file: Path,
+    log_file: Path,
+    cluster: list,
+    final_frequencies: list,
+    iir_parameters: dict,
+    time_limits: list
+) -> tuple[dict, np.ndarray, float]:
+    """ Cluster signals of the hit trials of each condition (trials x times), filtered and baseline-corrected as in
+    `get_evoked.py` and cropped to the time limits. """
+    log = pd.read_csv(log_file, sep='\t')
+    log['condition'] = [x[:-3] for x in log['file'].values]
+    epochs = mne.read_epochs(epochs_file)
+    epochs.metadata = log
+
+    epochs.filter(l_freq=final_frequencies[0], h_freq=final_frequencies[1], method='iir', iir_params=iir_parameters)
+    epochs = epochs[epochs.metadata['hit'] == 1]
+    epochs.apply_baseline(baseline=(None, 0))
+    epochs.crop(tmin=time_limits[0], tmax=time_limits[1])
+
+    cluster_idx = [epochs.ch_names.index(channel) for channel in cluster]
+    data = epochs.get_data()[:, cluster_idx, :].mean(axis=1)
+    conditions = epochs.metadata['condition'].values
+    trials = {condition: data[conditions == condition] for condition in np.unique(conditions)}
+    trials['all'] = data
+
+    return trials, epochs.times, epochs.info['sfreq']
+
+
+def time_limits(windows: list, window_area: float) -> list:
+    """ Time range covering the peak windows and the areas around their peaks. """
+    return [min(window[0] for window in windows) - window_area, max(window[1] for window in windows) + window_area]
+
+
+if __name__ == '__main__':
+    # Load configuration
+    config = load_config('evoked_config.yaml')
+
+    no_participants = config['files_parameters']['no_participants']
+    participants = ['p' + str(i).zfill(2) for i in range(1, no_participants + 1)]
+
+    out_folder = Path(config['output_folder'])
+    out_folder.mkdir(parents=True, exist_ok=True)
+
+    aep_params = config['evoked_parameters']['AEP']
+    n400_params = config['evoked_parameters']['N400']
+    aep_folder = Path(config['evoked_folder']) / Path(aep_params['subfolder'])
+    n400_folder = Path(config['evoked_folder']) / Path(n400_params['subfolder'])
+
+    resampling_params = config['resampling']
+    preprocessed_folder = Path(resampling_params['preprocessed_folder'])
+    logs_folder = Path(resampling_params['logs_folder'])
+    n_bootstrap = resampling_params['n_bootstrap']
+    ci = resampling_params['ci']
+    rng = np.random.default_rng(resampling_params['seed'])
+
+    # -----------------------------------------
+    # Section: Jackknife over participants
+    # -----------------------------------------
+    aep_signals, random_signals, context_signals = [], [], []
+    for participant in participants:
+        evoked = mne.read_evokeds(aep_folder / (participant + aep_params['file_extension']))[0]
+        aep_signals.append(evoked.copy().pick(aep_params['cluster']).get_data().mean(axis=0))
+        aep_times, aep_sfreq = evoked.times, evoked.info['sfreq']
+
+        evoked_random = mne.read_evokeds(n400_folder / (participant + n400_params['random_file_extension']))[0]
+        evoked_context = mne.read_evokeds(n400_folder / (participant + n400_params['context_file_extension']))[0]
+        random_signals.append(evoked_random.copy().pick(n400_params['cluster']).get_data().mean(axis=0))
+        context_signals.append(evoked_context.copy().pick(n400_params['cluster']).get_data().mean(axis=0))
+        n400_times, n400_sfreq = evoked_random.times, evoked_random.info['sfreq']
+
+    aep_signals, random_signals, context_signals = map(np.stack, [aep_signals, random_signals, context_signals])
+
+    grand_peaks = {
+        **aep_peaks(aep_signals.mean(axis=0, keepdims=True), aep_times, aep_sfreq, aep_params),
+        **n400_peaks(
+            random_signals.mean(axis=0, keepdims=True),
+            context_signals.mean(axis=0, keepdims=True),
+            n400_times,
+            n400_sfreq,
+            n400_params
+        )
+    }
+    jackknife_peaks = {
+        **aep_peaks(jackknife_averages(aep_signals), aep_times, aep_sfreq, aep_params),
+        **n400_peaks(
+            jackknife_averages(random_signals),
+            jackknife_averages(context_signals),
+            n400_times,
+            n400_sfreq,
+            n400_params
+        )
+    }
+
+    jackknife_rows, summary_rows = [], []
+    for component, (latencies, amplitudes) in jackknife_peaks.items():
+        grand_latency, grand_amplitude = grand_peaks[component][0][0], grand_peaks[component][1][0]
+        retrieved_latencies, latency_se = jackknife_statistics(grand_latency, latencies)
+        retrieved_amplitudes, amplitude_se = jackknife_statistics(grand_amplitude, amplitudes)
+
+        summary_rows.append({
+            'component': component,
+            'latency_ms': grand_latency * 1e3,
+            'latency_se_ms': latency_se * 1e3,
+            'amplitude_uV': grand_amplitude * 1e6,
+            'amplitude_se_uV': amplitude_se * 1e6
+        })
+        for participant_idx, participant in enumerate(participants):
+            jackknife_rows.append({
+                'participant_id': participant,
+                'component': component,
+                'jackknife_latency_ms': latencies[participant_idx] * 1e3,
+                'jackknife_amplitude_uV': amplitudes[participant_idx] * 1e6,
+                'retrieved_latency_ms': retrieved_latencies[participant_idx] * 1e3,
+                'retrieved_amplitude_uV': retrieved_amplitudes[participant_idx] * 1e6
+            })
+
+    pd.DataFrame(summary_rows).to_csv(out_folder / resampling_params['jackknife_summary_filename'], index=False)
+    pd.DataFrame(jackknife_rows).to_csv(out_folder / resampling_params['jackknife_filename'], index=False)
+
+    # -----------------------------------------
+    # Section: Bootstrap over trials
+    # -----------------------------------------
+    aep_limits = time_limits([aep_params[f'{c}_window'] for c in ['P1', 'N1', 'P2']], aep_params['window_area'])
+    n400_limits = time_limits([n400_params['window']], n400_params['window_area'])
+
+    bootstrap_rows = []
+    for participant in participants:
+        print(f'Participant {participant}')
+        log_file = logs_folder / (participant + resampling_params['logs_txt_extension'])
+
+        trials, times, sfreq = load_trials(
+            preprocessed_folder / aep_params['subfolder'] / (participant + resampling_params['epochs_fif_extension']),
+            log_file,
+            aep_params['cluster'],
+            resampling_params['final_frequencies'],
+            resampling_params['iir_parameters'],
+            aep_limits
+        )
+        n_trials = {component: trials['all'].shape[0] for component in ['P1', 'N1', 'P2']}
+        peaks = aep_peaks(trials['all'].mean(axis=0, keepdims=True), times, sfreq, aep_params)
+        bootstrap_peaks = aep_peaks(bootstrap_averages(trials['all'], n_bootstrap, rng), times, sfreq, aep_params)
+
+        trials, times, sfreq = load_trials(
+            preprocessed_folder / n400_params['subfolder'] / (participant + resampling_params['epochs_fif_extension']),
+            log_file,
+            n400_params['cluster'],
+            resampling_params['final_frequencies'],
+            resampling_params['iir_parameters'],
+            n400_limits
+        )
+        n_trials['N400_random'] = trials['random'].shape[0]
+        n_trials['N400_context'] = trials['context'].shape[0]
+        peaks.update(n400_peaks(
+            trials['random'].mean(axis=0, keepdims=True),
+            trials['context'].mean(axis=0, keepdims=True),
+            times,
+            sfreq,
+            n400_params
+        ))
+        bootstrap_peaks.update(n400_peaks(
+            bootstrap_averages(trials['random'], n_bootstrap, rng),
+            bootstrap_averages(trials['context'], n_bootstrap, rng),
+            times,
+            sfreq,
+            n400_params
+        ))
+
+        for component, (latencies, amplitudes) in bootstrap_peaks.items():
+            latency_se, latency_ci_low, latency_ci_high = bootstrap_statistics(latencies, ci)
+            amplitude_se, amplitude_ci_low, amplitude_ci_high = bootstrap_statistics(amplitudes, ci)
+            bootstrap_rows.append({
+                'participant_id': participant,
+                'component': component,
+                'n_trials': n_trials[component],
+                'latency_ms': peaks[component][0][0] * 1e3,
+                'latency_se_ms': latency_se * 1e3,
+                'latency_ci_low_ms': latency_ci_low * 1e3,
+                'latency_ci_high_ms': latency_ci_high * 1e3,
+                'amplitude_uV': peaks[component][1][0] * 1e6,
+                'amplitude_se_uV': amplitude_se * 1e6,
+                'amplitude_ci_low_uV': amplitude_ci_low * 1e6,
+                'amplitude_ci_high_uV': amplitude_ci_high * 1e6
+            })
+
+    pd.DataFrame(bootstrap_rows).to_csv(out_folder / resampling_params['bootstrap_filename'], index=False)
@@ -0,0 +1,161 @@
+""" Jackknife and bootstrap estimates of evoked peak latencies and amplitudes.
+
+Peak latencies of single-participant evoked responses are noisy. Two resampling schemes give more robust estimates,
+both vectorized over the resamples so that all resampled averages are one array and the peaks of all of them are found
+at once:
+
+- Jackknife over participants (Miller et al., 1998): the peaks are measured on the leave-one-participant-out grand
+  averages. These are computed from the total sum as `(sum - x_i) / (N - 1)`, i.e., in O(N) instead of averaging N
+  subsets of N - 1 participants. The jackknife standard error follows from the spread of the leave-one-out estimates,
+  and individual estimates are retrieved as `N * J - (N - 1) * J_i` (Smulders, 2010).
+- Bootstrap over trials: the trials of a participant are resampled with replacement. A resample is a vector of
+  counts per trial (multinomial), so the averages of all resamples are one (resamples x trials) matrix product.
+
+References
+----------
+Miller, J., Patterson, T., & Ulrich, R. (1998). Jackknife-based method for measuring LRP onset latency differences.
+Psychophysiology, 35(1), 99-115. https://doi.org/10.1111/1469-8986.3510099
+
+Smulders, F. T. Y. (2010). Simplifying jackknifing of ERPs and getting more out of it: Retrieving estimates of
+participants' latencies. Psychophysiology, 47(2), 387-392. https://doi.org/10.1111/j.1469-8986.2009.00934.x
+
+"""
+
+import numpy as np
+
+
+def amplitudes_around(signals: np.ndarray, peak_idx: np.ndarray, sfreq: float, window: float) -> np.ndarray:
+    """ Mean amplitude of each signal within `window` seconds around its peak index, see
+    `helpers.mean_amplitude_around_peak`.
+
+    Parameters
+    ----------
+    signals : np.ndarray
+        Signals (resamples x times).
+    peak_idx : np.ndarray
+        Peak index of each signal.
+    sfreq : float
+        Sampling frequency of the signals.
+    window : float
+        Half-width of the window around the peak in seconds.
+
+    Returns
+    -------
+    amplitudes : np.ndarray
+        Mean amplitude around the peak of each signal.
+
+    """
+    window_samples = int(window * sfreq)
+    cumulative = np.concatenate([np.zeros((signals.shape[0], 1)), np.cumsum(signals, axis=-1)], axis=-1)
+    start_idx = np.clip(peak_idx - window_samples, 0, signals.shape[-1])
+    end_idx = np.clip(peak_idx + window_samples, 0, signals.shape[-1])
+    rows = np.arange(signals.shape[0])
+
+    return (cumulative[rows, end_idx] - cumulative[rows, start_idx]) / np.maximum(end_idx - start_idx, 1)
+
+
+def find_peaks(
+    signals: np.ndarray,
+    times: np.ndarray,
+    window: list,
+    polarity: str
+) -> tuple[np.ndarray, np.ndarray]:
+    """ Peak of each signal within a window, see `helpers.find_peak`.
+
+    Parameters
+    ----------
+    signals : np.ndarray
+        Signals (resamples x times).
+    times : np.ndarray
+        Time points of the signals.
+    window : list
+        Window of interest in seconds.
+    polarity : str
+        Polarity of the peak (either `positive` or `negative`).
+
+    Returns
+    -------
+    peak_times : np.ndarray
+        Time of the peak of each signal.
+    peak_idx : np.ndarray
+        Index of the peak of each signal.
+
+    """
+    start_idx = np.flatnonzero(times >= window[0])[0]
+    end_idx = np.flatnonzero(times <= window[1])[-1]
+
+    if polarity == 'positive':
+        peak_idx = start_idx + np.argmax(signals[:, start_idx:end_idx], axis=-1)
+    elif polarity == 'negative':
+        peak_idx = start_idx + np.argmin(signals[:, start_idx:end_idx], axis=-1)
+    else:
+        raise ValueError('Polarity must be either `positive` or `negative`.')
+
+    return times[peak_idx], peak_idx
+
+
+def jackknife_averages(signals: np.ndarray) -> np.ndarray:
+    """ Leave-one-out averages (observations x ...) of the signals (observations x ...), from their total sum. """
+    n_observations = signals.shape[0]
+    if n_observations < 2:
+        raise ValueError('Jackknifing needs at least two observations.')
+
+    return (signals.sum(axis=0) - signals) / (n_observations - 1)
+
+
+def jackknife_statistics(full_estimate: float, jackknife_estimates: np.ndarray) -> tuple[np.ndarray, float]:
+    """ Retrieved individual estimates and jackknife standard error.
+
+    Parameters
+    ----------
+    full_estimate : float
+        Estimate on the average of all observations.
+    jackknife_estimates : np.ndarray
+        Estimates on the leave-one-out averages.
+
+    Returns
+    -------
+    retrieved : np.ndarray
+        Individual estimates `N * full - (N - 1) * jackknife` (Smulders, 2010).
+    standard_error : float
+        Jackknife standard error of the full estimate.
+
+    """
+    n_observations = jackknife_estimates.shape[0]
+    retrieved = n_observations * full_estimate - (n_observations - 1) * jackknife_estimates
+    deviations = jackknife_estimates - jackknife_estimates.mean()
+    standard_error = np.sqrt((n_observations - 1) / n_observations * np.sum(deviations**2))
+
+    return retrieved, standard_error
+
+
+def bootstrap_averages(trials: np.ndarray, n_bootstrap: int, rng: np.random.Generator) -> np.ndarray:
+    """ Averages of bootstrap resamples of the trials.
+
+    Parameters
+    ----------
+    trials : np.ndarray
+        Trials (trials x ...).
+    n_bootstrap : int
+        Number of resamples.
+    rng : np.random.Generator
+        Random generator drawing the resamples.
+
+    Returns
+    -------
+    averages : np.ndarray
+        Average of each resample (resamples x ...).
+
+    """
+    n_trials = trials.shape[0]
+    counts = rng.multinomial(n_trials, np.full(n_trials, 1 / n_trials), size=n_bootstrap)
+    averages = counts @ trials.reshape(n_trials, -1) / n_trials
+
+    return averages.reshape((n_bootstrap,) + trials.shape[1:])
+
+
+def bootstrap_statistics(estimates: np.ndarray, ci: list) -> tuple[float, float, float]:
+    """ Standard error and percentile confidence interval of bootstrap estimates, `ci` in percent. """
+    ci_low, ci_high = np.percentile(estimates, ci)
+
+    return np.std(estimates, ddof=1), ci_low, ci_high
@@ -0,0 +1,163 @@
+""" Lightweight per-stage instrumentation of the pipelines.
+
+Tracing is off unless the environment variable `NEUROSCALES_TRACE` names a folder. When it is set, every stage
+records wall time, CPU time, peak resident memory and bytes read/written, tagged with the enclosing stages' tags (e.g.,
+participant and band). At exit, the records are written to `<script>_<pid>.json` and `.csv` in that folder and, if
+`NEUROSCALES_TRACE_CHROME` is set, to a Chrome trace (`chrome://tracing`, Perfetto) `<script>_<pid>_chrome.json`.
+
+Usage:
+    with stage('participant', participant=participant_id):
+        ...
+
+    @instrument
+    def extract_envelope(...):
+        ...
+
+"""
+
+import atexit
+import csv
+import functools
+import json
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+TRACE_FOLDER = os.environ.get('NEUROSCALES_TRACE')
+CHROME_TRACE = bool(os.environ.get('NEUROSCALES_TRACE_CHROME'))
+
+_records = []
+_stack = []
+_origin = time.perf_counter()
+
+
+def _io_bytes() -> tuple[int, int]:
+    """ Bytes read and written by this process so far (Linux only, zeros elsewhere). """
+    try:
+        with open('/proc/self/io', 'r') as file:
+            counters = dict(line.split(': ') for line in file.read().splitlines())
+        return int(counters['rchar']), int(counters['wchar'])
+    except OSError:
+        return 0, 0
+
+
+def peak_rss() -> int:
+    """ Peak resident memory in bytes, since the last reset where the platform supports it. """
+    try:
+        with open('/proc/self/status', 'r') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def reset_peak_rss() -> None:
+    """ Reset the peak resident memory (Linux only), so each stage or scheduled job reports its own peak. """
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+    except OSError:
+        pass
+
+
+@contextmanager
+def stage(name: str, **tags):
+    """ Record the resource usage of the enclosed block as stage `name`, tagged with `tags`. """
+    if TRACE_FOLDER is None:
+        yield
+        return
+
+    # The peak is reset per stage, so enclosing stages first take over the peak reached so far
+    peak = peak_rss()
+    for frame in _stack:
+        frame['peak'] = max(frame['peak'], peak)
+    reset_peak_rss()
+
+    parent_tags = _stack[-1]['tags'] if _stack else {}
+    frame = {'tags': {**parent_tags, **tags}, 'peak': 0}
+    _stack.append(frame)
+
+    read_start, written_start = _io_bytes()
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    try:
+        yield
+    finally:
+        wall_end = time.perf_counter()
+        cpu_end = time.process_time()
+        read_end, written_end = _io_bytes()
+        frame['peak'] = max(frame['peak'], peak_rss())
+        _stack.pop()
+        for parent in _stack:
+            parent['peak'] = max(parent['peak'], frame['peak'])
+
+        _records.append({
+            'stage': name,
+            **frame['tags'],
+            'depth': len(_stack),
+            'start_s': round(wall_start - _origin, 6),
+            'wall_s': round(wall_end - wall_start, 6),
+            'cpu_s': round(cpu_end - cpu_start, 6),
+            'peak_rss_mb': round(frame['peak'] / 2**20, 2),
+            'read_mb': round((read_end - read_start) / 2**20, 3),
+            'written_mb': round((written_end - written_start) / 2**20, 3)
+        })
+
+
+def instrument(function):
+    """ Decorator recording each call of `function` as a stage. Returns `function` unchanged when tracing is off. """
+    if TRACE_FOLDER is None:
+        return function
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with stage(function.__name__):
+            return function(*args, **kwargs)
+
+    return wrapper
+
+
+def save_trace() -> None:
+    """ Write the records to JSON, CSV and, optionally, Chrome trace files in the trace folder. """
+    if TRACE_FOLDER is None or not _records:
+        return
+
+    folder = Path(TRACE_FOLDER)
+    folder.mkdir(parents=True, exist_ok=True)
+    script = Path(sys.argv[0]).stem if sys.argv[0] not in ('', '-c') else 'python'
+    stem = f'{script}_{os.getpid()}'
+
+    with open(folder / f'{stem}.json', 'w') as file:
+        json.dump(_records, file, indent=1)
+
+    columns = list(dict.fromkeys(key for record in _records for key in record))
+    with open(folder / f'{stem}.csv', 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(_records)
+
+    if CHROME_TRACE:
+        events = [
+            {
+                'name': record['stage'],
+                'ph': 'X',
+                'ts': record['start_s'] * 1e6,
+                'dur': record['wall_s'] * 1e6,
+                'pid': os.getpid(),
+                'tid': 0,
+                'args': {key: value for key, value in record.items() if key not in ('stage', 'start_s', 'wall_s')}
+            }
+            for record in _records
+        ]
+        with open(folder / f'{stem}_chrome.json', 'w') as file:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, file)
+
+
+if TRACE_FOLDER is not None:
+    atexit.register(save_trace)
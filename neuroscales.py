@@ -0,0 +1,196 @@
+""" Command-line entry point to the pipelines.
+
+Each subcommand runs the scripts of a pipeline step in a child process, with the step's folder and the repository (for
+the modules shared by the pipelines, e.g., `instrumentation.py`) on the Python path and the folder containing its
+configuration as working directory, just like running the scripts by hand from within their folders with the
+repository on `PYTHONPATH`. This module only imports the standard library (and YAML to check configurations), so
+`--help` and `--check` return immediately; the scientific libraries are imported by the scripts of the steps that are
+run.
+
+Usage:
+    python neuroscales.py preprocess speech
+    python neuroscales.py preprocess eeg --segment onset target
+    python neuroscales.py plv --configs path/to/configs
+    python neuroscales.py check --configs path/to/configs
+    python neuroscales.py sweep path/to/sweep_config.yaml
+
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+REPO_FOLDER = Path(__file__).resolve().parent
+
+# Steps of each subcommand: folder with the scripts, configuration file, and either the script or the code to run
+STEPS = {
+    'speech': [
+        {'folder': 'preprocess/speech', 'config': 'speech_config.yaml', 'script': 'cut_stimuli.py'},
+        {'folder': 'preprocess/speech', 'config': 'speech_config.yaml', 'script': 'get_linguistic_properties.py'},
+        {'folder': 'preprocess/speech', 'config': 'speech_config.yaml', 'script': 'compute_modulation_spectrum.py'}
+    ],
+    'eeg': [
+        {
+            'folder': 'preprocess/eeg',
+            'config': 'eeg_config.yaml',
+            'code': (
+                'from helpers import load_config\n'
+                'from preprocess import run_preprocessing\n'
+                'config = load_config("eeg_config.yaml")\n'
+                'for segment_to in {segments}:\n'
+                '    run_preprocessing(config, segment_to=segment_to)\n'
+            )
+        }
+    ],
+    'evoked': [
+        {'folder': 'preprocess/eeg', 'config': 'eeg_config.yaml', 'script': 'get_evoked.py'},
+        {'folder': 'evoked', 'config': 'evoked_config.yaml', 'script': 'get_AEP_data.py'},
+        {'folder': 'evoked', 'config': 'evoked_config.yaml', 'script': 'get_N400_data.py'},
+        {'folder': 'evoked', 'config': 'evoked_config.yaml', 'script': 'get_N400_clusters.py'},
+        {'folder': 'evoked', 'config': 'evoked_config.yaml', 'script': 'get_peak_resampling.py'}
+    ],
+    'bands': [{'folder': 'tracking', 'config': 'tracking_config.yaml', 'script': 'filter_in_frequencybands.py'}],
+    'plv': [{'folder': 'tracking', 'config': 'tracking_config.yaml', 'script': 'calculate_phase_locking.py'}],
+    'trf': [{'folder': 'tracking', 'config': 'tracking_config.yaml', 'script': 'calculate_trf.py'}],
+    'spectrum': [{'folder': 'tracking', 'config': 'tracking_config.yaml', 'script': 'calculate_coherence_spectrum.py'}],
+    'stream': [{'folder': 'tracking', 'config': 'tracking_config.yaml', 'script': 'stream_tracking.py'}],
+    'stats': [{'folder': 'statistics', 'config': 'statistics_config.yaml', 'script': 'get_dataframes.py'}]
+}
+
+
+def find_config(step: dict, config_folders: list) -> Path:
+    """ Folder with the step's configuration: the first of `config_folders` containing it, else the step's folder. """
+    for folder in config_folders:
+        if (Path(folder) / step['config']).exists():
+            return Path(folder).resolve()
+    return REPO_FOLDER / step['folder']
+
+
+def missing_keys(config: dict, reference: dict, prefix: str = '', depth: int = 2) -> list:
+    """ Sections and keys within sections of the reference configuration that are missing in a configuration.
+
+    Deeper levels hold data rather than settings, e.g., the ICA components of each participant, and are not compared.
+
+    """
+    missing = []
+    for key, value in reference.items():
+        if key not in config:
+            missing.append(f'{prefix}{key}')
+        elif depth > 1 and isinstance(value, dict) and isinstance(config[key], dict):
+            missing.extend(missing_keys(config[key], value, prefix=f'{prefix}{key}.', depth=depth - 1))
+    return missing
+
+
+def check_configs(steps: list, config_folders: list) -> int:
+    """ Check that the configurations of the steps contain all keys of the repository's configurations. """
+    import yaml
+
+    # Each configuration is checked once against the repository's configuration of the same pipeline
+    config_files = {}
+    for step in steps:
+        config_files.setdefault(find_config(step, config_folders) / step['config'], REPO_FOLDER / step['folder'])
+
+    n_errors = 0
+    for config_file, reference_folder in config_files.items():
+        reference_file = reference_folder / config_file.name
+        with open(config_file, 'r') as file:
+            config = yaml.safe_load(file)
+        with open(reference_file, 'r') as file:
+            reference = yaml.safe_load(file)
+
+        missing = missing_keys(config, reference)
+        if missing:
+            n_errors += 1
+            print(f'{config_file}: missing {", ".join(missing)}')
+        else:
+            print(f'{config_file}: ok')
+
+    return n_errors
+
+
+def run_step(step: dict, cwd: Path, **kwargs) -> int:
+    """ Run a step in a child process with its folder and the repository on the Python path, `kwargs` are passed to
+    `subprocess.run`. """
+    folder = REPO_FOLDER / step['folder']
+    if 'script' in step:
+        command = [sys.executable, str(folder / step['script'])]
+    else:
+        command = [sys.executable, '-c', step['code']]
+
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [str(folder), str(REPO_FOLDER), env.get('PYTHONPATH')]))
+
+    return subprocess.run(command, cwd=cwd, env=env, **kwargs).returncode
+
+
+def run_steps(steps: list, config_folders: list) -> int:
+    """ Run the steps one after the other in child processes, stopping at the first that fails. """
+    for step in steps:
+        returncode = run_step(step, cwd=find_config(step, config_folders))
+        if returncode != 0:
+            print(f'Step {step.get("script", step["folder"])} failed with return code {returncode}.')
+            return returncode
+
+    return 0
+
+
+def parse_args(argv: list | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog='neuroscales', description=__doc__.split('\n')[0])
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    options = argparse.ArgumentParser(add_help=False)
+    options.add_argument(
+        '--configs', nargs='+', default=[], metavar='FOLDER',
+        help='folders searched for the configuration files, defaults to the pipeline folders'
+    )
+    options.add_argument('--check', action='store_true', help='only check the configurations, do not run')
+
+    preprocess = subparsers.add_parser('preprocess', parents=[options], help='preprocess the stimuli or the EEG')
+    preprocess.add_argument('modality', choices=['speech', 'eeg'])
+    preprocess.add_argument(
+        '--segment', nargs='+', choices=['onset', 'target'], default=['onset', 'target'],
+        help='EEG epochs to extract, locked to the sentence onset and/or the target word'
+    )
+    subparsers.add_parser('evoked', parents=[options], help='extract AEPs and N400s and test for N400 clusters')
+    subparsers.add_parser('bands', parents=[options], help='extract the envelope and EEG phases in frequency bands')
+    subparsers.add_parser('plv', parents=[options], help='calculate the phase-locking values')
+    subparsers.add_parser('trf', parents=[options], help='fit temporal response functions')
+    subparsers.add_parser('spectrum', parents=[options], help='calculate the stimulus-brain coherence spectrum')
+    subparsers.add_parser('stream', parents=[options], help='replay a session through the streaming PLV engine')
+    subparsers.add_parser('stats', parents=[options], help='collect the data frames for the statistical analyses')
+    sweep = subparsers.add_parser('sweep', help='run steps for a grid of configuration values, see sweep.py')
+    sweep.add_argument('sweep_config', nargs='?', default='sweep_config.yaml', help='configuration of the sweep')
+    sweep.add_argument('--configs', nargs='+', default=None, metavar='FOLDER', help='overrides `configs` of the sweep')
+    check = subparsers.add_parser('check', help='check the configurations of all pipelines')
+    check.add_argument('--configs', nargs='+', default=[], metavar='FOLDER')
+
+    return parser.parse_args(argv)
+
+
+def main(argv: list | None = None) -> int:
+    args = parse_args(argv)
+
+    if args.command == 'check':
+        return int(check_configs([step for steps in STEPS.values() for step in steps], args.configs) > 0)
+
+    if args.command == 'sweep':
+        from sweep import run_sweep
+        return run_sweep(Path(args.sweep_config), args.configs)
+
+    if args.command == 'preprocess':
+        steps = STEPS[args.modality]
+        if args.modality == 'eeg':
+            steps = [dict(step, code=step['code'].format(segments=args.segment)) for step in steps]
+    else:
+        steps = STEPS[args.command]
+
+    if args.check:
+        return int(check_configs(steps, args.configs) > 0)
+
+    return run_steps(steps, args.configs)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
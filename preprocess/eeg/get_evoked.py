@@ -10,6 +10,7 @@ Procedure includes the following steps:
 
 from pathlib import Path
 from helpers import load_config
+from instrumentation import stage
 import pandas as pd
 import mne
 
@@ -90,21 +91,23 @@ if __name__ == '__main__':
             epochs.metadata = log
 
             if analysis == 'target':
-                context_evoked, random_evoked = get_evoked(
-                    epochs,
-                    final_frequencies,
-                    iir_parameters,
-                    evoked_limits,
-                    by_condition=True
-                )
+                with stage('get_evoked', participant=participant, analysis=analysis):
+                    context_evoked, random_evoked = get_evoked(
+                        epochs,
+                        final_frequencies,
+                        iir_parameters,
+                        evoked_limits,
+                        by_condition=True
+                    )
                 context_evoked.save(folder_out / (participant + evoked_context_extension), overwrite=True)
                 random_evoked.save(folder_out / (participant + evoked_random_extension), overwrite=True)
             else:
-                evoked = get_evoked(
-                    epochs,
-                    final_frequencies,
-                    iir_parameters,
-                    evoked_limits,
-                    by_condition=False
-                )
+                with stage('get_evoked', participant=participant, analysis=analysis):
+                    evoked = get_evoked(
+                        epochs,
+                        final_frequencies,
+                        iir_parameters,
+                        evoked_limits,
+                        by_condition=False
+                    )
                 evoked.save(folder_out / (participant + evoked_extension), overwrite=True)
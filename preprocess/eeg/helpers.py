@@ -1,3 +1,5 @@
+import mne
+import numpy as np
 import yaml
 
 
@@ -5,3 +7,76 @@ def load_config(config_path: str) -> dict:
     """ Load configuration from YAML file. """
     with open(config_path, 'r') as file:
         return yaml.safe_load(file)
+
+
+def design_filters(
+    sfreq: float,
+    sfreq_goal: float,
+    notch_frequencies: list,
+    notch_width: float,
+    alias_dict: dict,
+    notch_dict: dict,
+    notch_trans_bandwidth: float = 1.0
+) -> tuple[np.ndarray, int]:
+    """ Design the anti-alias and notch filters of the preprocessing pipeline as a single cascade.
+
+    The filters are designed exactly like `raw.filter` and `raw.notch_filter` with `method='iir'` design them. Because
+    the filters are linear and time-invariant, applying their cascade forward and backward equals applying each of them
+    forward and backward in turn.
+
+    Parameters
+    ----------
+    sfreq : float
+        Sampling frequency of the raw recording.
+    sfreq_goal : float
+        Goal sampling frequency. The anti-alias low-pass is set at a third of it.
+    notch_frequencies : list
+        Power line frequencies to remove.
+    notch_width : float
+        Width of the notch filters.
+    alias_dict : dict
+        IIR parameters of the anti-alias filter.
+    notch_dict : dict
+        IIR parameters of the notch filters.
+    notch_trans_bandwidth : float
+        Transition bandwidth of the notch filters, the default of `raw.notch_filter`.
+
+    Returns
+    -------
+    sos : np.ndarray
+        Second-order sections of the filter cascade.
+    ringing_samples : int
+        Number of samples after which the cascade's impulse response has decayed.
+
+    """
+    filters = [
+        mne.filter.create_filter(
+            None,
+            sfreq,
+            l_freq=None,
+            h_freq=sfreq_goal / 3.0,
+            h_trans_bandwidth=sfreq_goal / 10.0,
+            method='iir',
+            iir_params=dict(alias_dict),
+            verbose=False
+        )
+    ]
+    for freq in notch_frequencies:
+        filters.append(
+            mne.filter.create_filter(
+                None,
+                sfreq,
+                l_freq=freq + notch_width / 2.0 + notch_trans_bandwidth / 2.0,
+                h_freq=freq - notch_width / 2.0 - notch_trans_bandwidth / 2.0,
+                l_trans_bandwidth=notch_trans_bandwidth / 2.0,
+                h_trans_bandwidth=notch_trans_bandwidth / 2.0,
+                method='iir',
+                iir_params=dict(notch_dict),
+                verbose=False
+            )
+        )
+
+    sos = np.vstack([iir_params['sos'] for iir_params in filters])
+    ringing_samples = int(sum(iir_params['padlen'] for iir_params in filters))
+
+    return sos, ringing_samples
@@ -0,0 +1,139 @@
+""" Cached spherical-spline interpolation of bad EEG channels. """
+
+import hashlib
+import os
+from pathlib import Path
+
+import mne
+import numpy as np
+
+try:
+    # Private to MNE (checked with 1.7, pinned in environment.yml), so guarded: without it, bad channels are
+    # interpolated by `epochs.interpolate_bads` without the cache
+    from mne.channels.interpolation import _make_interpolation_matrix
+except ImportError:
+    _make_interpolation_matrix = None
+
+
+class InterpolationCache:
+    """ Compute each spherical-spline interpolation matrix once and reuse it across participants and runs.
+
+    `epochs.interpolate_bads()` evaluates the Legendre series of the spherical splines for every participant, although
+    participants recorded with the same cap and the same bad channels share the same matrix. Here, matrices are keyed
+    by the channel and digitization positions (i.e., the montage), the good and bad channels and the reference. They
+    are kept in memory and, if a cache folder is given, persisted as `.npz` files.
+
+    Interpolation matches `epochs.interpolate_bads()` with the spline method for EEG channels and the automatic origin
+    fitted to the head shape. Unlike `reset_bads=True`, which resets all bad channels, only the interpolated EEG
+    channels are removed from the bad channels.
+
+    Parameters
+    ----------
+    cache_folder : Path | None
+        Folder the matrices are persisted to. If None, matrices are only cached in-process.
+
+    """
+
+    def __init__(self, cache_folder: Path | None = None):
+        self.cache_folder = Path(cache_folder) if cache_folder is not None else None
+        if self.cache_folder is not None:
+            self.cache_folder.mkdir(parents=True, exist_ok=True)
+        self._matrices = {}
+
+    @staticmethod
+    def _key(info: mne.Info, picks: np.ndarray, bads: list, reference_channels: list) -> str:
+        """ Hash of the positions, the good and bad channels and the reference. """
+        positions = np.array([info['chs'][pick]['loc'][:3] for pick in picks], dtype=float)
+        dig = np.array([point['r'] for point in info['dig'] or []], dtype=float)
+        names = [info['ch_names'][pick] for pick in picks]
+
+        key = hashlib.sha1()
+        key.update(positions.tobytes())
+        key.update(dig.tobytes())
+        key.update('\n'.join(names).encode())
+        key.update('\n'.join(sorted(bads)).encode())
+        key.update('\n'.join(reference_channels).encode())
+
+        return key.hexdigest()
+
+    def matrix(self, info: mne.Info, reference_channels: list) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """ Interpolation matrix mapping the good to the bad EEG channels.
+
+        Parameters
+        ----------
+        info : mne.Info
+            Measurement information with montage and bad channels set.
+        reference_channels : list
+            Channels the data were re-referenced to.
+
+        Returns
+        -------
+        interpolation : np.ndarray
+            Interpolation matrix (bad channels x good channels).
+        goods_idx : np.ndarray
+            Indices of the good EEG channels.
+        bads_idx : np.ndarray
+            Indices of the bad EEG channels.
+
+        """
+        picks = mne.pick_types(info, meg=False, eeg=True, exclude=[])
+        bads = [info['ch_names'][pick] for pick in picks if info['ch_names'][pick] in info['bads']]
+        is_bad = np.isin(np.array(info['ch_names'])[picks], bads)
+        goods_idx, bads_idx = picks[~is_bad], picks[is_bad]
+        if not len(bads_idx):
+            return np.empty((0, len(goods_idx))), goods_idx, bads_idx
+
+        key = self._key(info, picks, bads, reference_channels)
+        if key not in self._matrices:
+            cache_file = self.cache_folder / f'{key}.npz' if self.cache_folder is not None else None
+
+            if cache_file is not None and cache_file.exists():
+                self._matrices[key] = np.load(cache_file)['interpolation']
+            else:
+                _, origin, _ = mne.bem.fit_sphere_to_headshape(info, units='m', verbose=False)
+                positions = np.array([info['chs'][pick]['loc'][:3] for pick in picks], dtype=float)
+                self._matrices[key] = _make_interpolation_matrix(
+                    positions[~is_bad] - origin,
+                    positions[is_bad] - origin
+                )
+                if cache_file is not None:
+                    # Scheduled workers share the cache folder, so the matrix is written under a name of this process
+                    # and moved into place at once: another worker never loads a partially written file
+                    partial_file = self.cache_folder / f'.{key}_{os.getpid()}.npz'
+                    np.savez(partial_file, interpolation=self._matrices[key], goods=goods_idx, bads=bads_idx)
+                    os.replace(partial_file, cache_file)
+
+        return self._matrices[key], goods_idx, bads_idx
+
+    def interpolate_bads(self, epochs: mne.BaseEpochs, reference_channels: list) -> mne.BaseEpochs:
+        """ Interpolate the bad EEG channels of preloaded epochs in place and remove them from the bad channels.
+
+        Parameters
+        ----------
+        epochs : mne.BaseEpochs
+            Preloaded epochs with montage and bad channels set.
+        reference_channels : list
+            Channels the data were re-referenced to.
+
+        Returns
+        -------
+        epochs : mne.BaseEpochs
+            The interpolated epochs.
+
+        """
+        if _make_interpolation_matrix is None:
+            picks = mne.pick_types(epochs.info, meg=False, eeg=True, exclude=[])
+            bads_idx = [pick for pick in picks if epochs.ch_names[pick] in epochs.info['bads']]
+            epochs.interpolate_bads(reset_bads=False)
+        else:
+            interpolation, goods_idx, bads_idx = self.matrix(epochs.info, reference_channels)
+            if len(bads_idx):
+                # A single matrix product over all epochs
+                data = epochs.get_data(copy=False)
+                data[:, bads_idx, :] = np.matmul(interpolation, data[:, goods_idx, :])
+
+        # Only the interpolated channels are no longer bad, bad channels of other types are kept
+        interpolated = {epochs.ch_names[idx] for idx in bads_idx}
+        epochs.info['bads'] = [channel for channel in epochs.info['bads'] if channel not in interpolated]
+
+        return epochs
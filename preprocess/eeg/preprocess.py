@@ -1,74 +1,72 @@
 """ Pipeline for preprocessing EEG data.
 
 Prodecure includes the following steps:
-- Load raw data
+- Load raw data (or open it for streaming, see `streaming.py`)
 - Remove bad channels
 - Set reference and eog channels
-- Anti-alias filter at 1/3 of the goal frequency
-- Notch filter to remove power line noise
-- Segment data while accounting for delay
-- Decimate data to the goal frequency
+- Anti-alias filter at 1/3 of the goal frequency and notch filter to remove power line noise, in a single pass
+- Segment data while accounting for delay, decimating to the goal frequency
 - Apply ICA to remove EOG artifacts
-- Interpolate bad channels
+- Interpolate bad channels (with cached interpolation matrices)
 - Apply baseline correction
 - Save preprocessed data
 
 """
 from pathlib import Path
-from helpers import load_config
+from helpers import load_config, design_filters
+from streaming import stream_epochs
+from interpolation_cache import InterpolationCache
+from scheduler import MemoryScheduler
+from checkpoint import RunManifest, atomic_output, code_fingerprint, fingerprint, file_fingerprint
+from instrumentation import stage
 import numpy as np
-import matplotlib.pyplot as plt
 import mne
 mne.set_log_level('ERROR')
 
 
-def run_preprocessing(config: str, segment_to: str = 'audio') -> None:
-    """ Run the preprocessing pipeline.
+def preprocess_participant(
+    config: dict,
+    participant_id: str,
+    segment_to: str,
+    interpolation_cache: InterpolationCache
+) -> None:
+    """ Preprocess the raw recording of a participant and save its epochs, see `run_preprocessing`.
 
     Parameters
     ----------
-    config : str
-        Path to the configuration file.
+    config : dict
+        Configuration of the pipeline.
+    participant_id : str
+        Participant to preprocess.
     segment_to : str
-        Segment to which the data will be epoched. Options are 'audio' or 'onset'.
+        Segment to which the data will be epoched, 'onset' or 'target'.
+    interpolation_cache : InterpolationCache
+        Cache of the bad channel interpolation matrices.
 
     """
-    if segment_to not in ['onset', 'target']:
-        raise ValueError('segment_to parameter must be either "audio" or "onset"')
-
     # Paths
     raw_folder = Path(config['raw_folder'])
-    preprocessed_folder = Path(config['preprocessed_folder'])
     plots_folder = Path(config['plots_folder'])
-    preprocessed_folder.mkdir(parents=True, exist_ok=True)
-    plots_folder.mkdir(parents=True, exist_ok=True)
 
     # File parameters
-    no_participants = config['files_parameters']['no_participants']
     raw_fif_extension = config['files_parameters']['raw_fif_extension']
     epochs_fif_extension = config['files_parameters']['epochs_fif_extension']
 
-    # Generate participants list
-    participants = ['p' + str(i).zfill(2) for i in range(1, no_participants + 1)]
-
     # EEG parameters
     sfreq_goal = config['eeg_parameters']['sfreq_goal']
     baseline = config['eeg_parameters']['baseline']
     notch_frequencies = config['eeg_parameters']['notch_frequencies']
     notch_width = config['eeg_parameters']['notch_width']
     ica_seed = config['eeg_parameters']['ica_seed']
+    streaming = config['eeg_parameters']['streaming']
+    chunk_duration_s = config['eeg_parameters']['chunk_duration_s']
 
     alias_dict = config['iir_parameters']['alias_dict']
     notch_dict = config['iir_parameters']['notch_dict']
 
     # Epochs parameters (onset or target)
-    if segment_to == 'onset':
-        epochs_params = config['onset_epochs_params']
-    elif segment_to == 'target':
-        epochs_params = config['target_epochs_params']
-
-    preprocessed_folder = preprocessed_folder / epochs_params['folder']
-    preprocessed_folder.mkdir(parents=True, exist_ok=True)
+    epochs_params = config[f'{segment_to}_epochs_params']
+    preprocessed_folder = Path(config['preprocessed_folder']) / epochs_params['folder']
     delta_t = epochs_params['delta_t']
     trigger_codes = epochs_params['trigger_codes']
     epoch_limits = epochs_params['epoch_limits']
@@ -78,114 +76,247 @@ def run_preprocessing(config: str, segment_to: str = 'audio') -> None:
     bad_eog = config['channels']['bad_eog']
     montage = mne.channels.make_standard_montage(config['channels']['montage'])
 
-    for participant_id in participants:
-        raw_file = raw_folder / (participant_id + raw_fif_extension)
-        raw = mne.io.read_raw_fif(raw_file, preload=True)
-        raw.set_montage(montage)
-
-        bad_channels = config['channels']['bad_cap'][participant_id]
-        raw.info['bads'] = bad_channels
-        if participant_id in bad_mastoids:
-            reference_channels = config['channels']['mastoids_alt']
-        else:
-            reference_channels = config['channels']['mastoids']
-
-        if participant_id in bad_eog:
-            eog_channels = config['channels']['eog_alt']
-        else:
-            eog_channels = config['channels']['eog']
+    # Steps are traced separately, tagged with the participant and segment, see instrumentation.py
+    tags = {'participant': participant_id, 'segment': segment_to}
+
+    raw_file = raw_folder / (participant_id + raw_fif_extension)
+    with stage('read_raw', **tags):
+        raw = mne.io.read_raw_fif(raw_file, preload=not streaming)
+    raw.set_montage(montage)
+
+    bad_channels = config['channels']['bad_cap'][participant_id]
+    raw.info['bads'] = bad_channels
+    if participant_id in bad_mastoids:
+        reference_channels = config['channels']['mastoids_alt']
+    else:
+        reference_channels = config['channels']['mastoids']
+
+    if participant_id in bad_eog:
+        eog_channels = config['channels']['eog_alt']
+    else:
+        eog_channels = config['channels']['eog']
+
+    if segment_to == 'onset':
+        ica_components = config['channels']['onset_ica_components'][participant_id]
+    elif segment_to == 'target':
+        ica_components = config['channels']['target_ica_components'][participant_id]
+
+    # The stimulus channel is neither re-referenced nor filtered, so events are found on the raw recording
+    events = mne.find_events(
+        raw,
+        stim_channel='Status',
+        min_duration=(1 / raw.info['sfreq']),
+        shortest_event=1,
+        initial_event=True
+    )
+    if participant_id == 'p21' and segment_to == 'onset':
+        remove_times = config['eeg_parameters']['p21_extra_events_t']
+        events = events[np.isin(events[:, 0], remove_times, invert=True)]
+
+    delay_samples = int(delta_t * raw.info['sfreq'])
+    mask = np.isin(events[:, 2], trigger_codes)
+    audio_events_delta = events[mask, :]
+    audio_events_delta[:, 0] = audio_events_delta[:, 0] + delay_samples
+
+    # Epochs are decimated while they are extracted from the anti-aliased recording
+    decim = int(raw.info['sfreq'] / sfreq_goal)
+
+    # Anti-alias low-pass and all notch filters as a single cascade, applied in one forward-backward pass
+    sos, ringing_samples = design_filters(
+        raw.info['sfreq'],
+        sfreq_goal,
+        notch_frequencies,
+        notch_width,
+        alias_dict,
+        notch_dict
+    )
+
+    if streaming:
+        # Re-reference, filter and epoch chunk by chunk without loading the recording
+        with stage('stream_epochs', **tags):
+            epochs = stream_epochs(
+                raw,
+                audio_events_delta,
+                event_id=trigger_codes,
+                tmin=epoch_limits[0],
+                tmax=epoch_limits[1],
+                reference_channels=reference_channels,
+                eog_channels=eog_channels,
+                sos=sos,
+                overlap_samples=ringing_samples,
+                chunk_duration_s=chunk_duration_s,
+                decim=decim,
+                lowpass=sfreq_goal / 3.0
+            )
+        del raw
+    else:
         raw.set_eeg_reference(reference_channels)
         raw.set_channel_types({ch: 'eog' for ch in eog_channels})
 
-        if segment_to == 'onset':
-            ica_components = config['channels']['onset_ica_components'][participant_id]
-        elif segment_to == 'target':
-            ica_components = config['channels']['target_ica_components'][participant_id]
-
-        raw.filter(
-            l_freq=None,
-            h_freq=sfreq_goal / 3.0,
-            h_trans_bandwidth=sfreq_goal / 10.0,
-            method='iir',
-            iir_params=alias_dict
-        )
-        for f, freq in enumerate(notch_frequencies):
-            raw.notch_filter(
-                freqs=freq,
+        with stage('filter', **tags):
+            raw.filter(
+                l_freq=None,
+                h_freq=sfreq_goal / 3.0,
                 method='iir',
-                iir_params=notch_dict,
-                notch_widths=notch_width
+                iir_params=dict(sos=sos, padlen=ringing_samples)
+            )
+
+        with stage('epochs', **tags):
+            epochs = mne.Epochs(
+                raw,
+                audio_events_delta,
+                event_id=trigger_codes,
+                tmin=epoch_limits[0],
+                tmax=epoch_limits[1],
+                baseline=None,
+                decim=decim,
+                preload=True
             )
-        events = mne.find_events(
-            raw,
-            stim_channel='Status',
-            min_duration=(1 / raw.info['sfreq']),
-            shortest_event=1,
-            initial_event=True
-        )
-        if participant_id == 'p21' and segment_to == 'onset':
-            remove_times = config['eeg_parameters']['p21_extra_events_t']
-            events = events[np.isin(events[:, 0], remove_times, invert=True)]
-
-        delay_samples = int(delta_t * raw.info['sfreq'])
-        mask = np.isin(events[:, 2], trigger_codes)
-        audio_events_delta = events[mask, :]
-        audio_events_delta[:, 0] = audio_events_delta[:, 0] + delay_samples
-
-        epochs = mne.Epochs(
-            raw,
-            audio_events_delta,
-            event_id=trigger_codes,
-            tmin=epoch_limits[0],
-            tmax=epoch_limits[1],
-            baseline=None,
-            preload=True
-        )
         del raw
-        epochs.decimate(int(epochs.info['sfreq'] / sfreq_goal))
-
-        epochs_ica_copy = epochs.copy()
-        epochs_ica_copy.filter(
-            l_freq=1.0,
-            h_freq=None,
-            method='iir',
-            iir_params=dict(order=3, ftype='butter', output='sos')
-        )
-        ica = mne.preprocessing.ICA(
-            n_components=0.999,
-            method='picard',
-            max_iter=1000,
-            fit_params=dict(fastica_it=5),
-            random_state=ica_seed
-        )
+
+    epochs_ica_copy = epochs.copy()
+    epochs_ica_copy.filter(
+        l_freq=1.0,
+        h_freq=None,
+        method='iir',
+        iir_params=dict(order=3, ftype='butter', output='sos')
+    )
+    ica = mne.preprocessing.ICA(
+        n_components=0.999,
+        method='picard',
+        max_iter=1000,
+        fit_params=dict(fastica_it=5),
+        random_state=ica_seed
+    )
+    with stage('ica_fit', **tags):
         ica.fit(epochs_ica_copy)
-        fig_list = ica.plot_components(show=False)
+    # matplotlib is only needed for the ICA plots, import it on first use
+    import matplotlib.pyplot as plt
+    fig_list = ica.plot_components(show=False)
 
-        for f, fig in enumerate(fig_list):
-            fig.savefig(plots_folder / f'{participant_id}_ica_{f}.pdf')
+    for f, fig in enumerate(fig_list):
+        fig.savefig(plots_folder / f'{participant_id}_ica_{f}.pdf')
 
-        # Now close all the figures
-        plt.close('all')
+    # Now close all the figures
+    plt.close('all')
 
-        ica.exclude = ica_components
-        print(f'{participant_id}: removing components {ica_components}')
+    ica.exclude = ica_components
+    print(f'{participant_id}: removing components {ica_components}')
+    with stage('ica_apply', **tags):
         ica.apply(epochs)
 
-        if participant_id in bad_eog:
-            eog_channels = config['channels']['eog_alt']
-            epochs.set_channel_types({ch: 'eeg' for ch in eog_channels})
+    if participant_id in bad_eog:
+        eog_channels = config['channels']['eog_alt']
+        epochs.set_channel_types({ch: 'eeg' for ch in eog_channels})
+
+    with stage('interpolate_bads', **tags):
+        interpolation_cache.interpolate_bads(epochs, reference_channels)
+
+    epochs.apply_baseline(baseline)
+
+    # Written to a temporary file first, so a crash never leaves incomplete epochs behind, see checkpoint.py
+    preprocessed_file = preprocessed_folder / (participant_id + epochs_fif_extension)
+    with atomic_output(preprocessed_file) as partial_file:
+        epochs.save(partial_file, overwrite=True)
+
+    # epochs.filter(1, 12)
+    # epochs.crop(tmin=-.200, tmax=.700)
+    # evoked = epochs.average()
+    # evoked.plot(show=False, time_unit='ms').savefig(plots_folder / f'{participant_id}_evoked.pdf')
+
+
+def run_preprocessing(config: str, segment_to: str = 'audio') -> None:
+    """ Run the preprocessing pipeline.
 
-        epochs.interpolate_bads()
+    Participants are preprocessed in parallel within the memory budget of the `scheduler` configuration, see
+    `scheduler.py`. The size of a participant's job is that of the raw recording in memory (float64), read from the
+    file header. With `checkpoint.resume`, participants completed in an earlier run with the same parameters and raw
+    recording are skipped, see `checkpoint.py`.
 
-        epochs.apply_baseline(baseline)
+    Parameters
+    ----------
+    config : str
+        Path to the configuration file.
+    segment_to : str
+        Segment to which the data will be epoched. Options are 'audio' or 'onset'.
 
-        preprocessed_file = preprocessed_folder / (participant_id + epochs_fif_extension)
-        epochs.save(preprocessed_file, overwrite=True)
+    """
+    if segment_to not in ['onset', 'target']:
+        raise ValueError('segment_to parameter must be either "audio" or "onset"')
 
-        # epochs.filter(1, 12)
-        # epochs.crop(tmin=-.200, tmax=.700)
-        # evoked = epochs.average()
-        # evoked.plot(show=False, time_unit='ms').savefig(plots_folder / f'{participant_id}_evoked.pdf')
+    # Paths
+    raw_folder = Path(config['raw_folder'])
+    preprocessed_folder = Path(config['preprocessed_folder'])
+    plots_folder = Path(config['plots_folder'])
+    preprocessed_folder.mkdir(parents=True, exist_ok=True)
+    plots_folder.mkdir(parents=True, exist_ok=True)
+    epochs_params = config[f'{segment_to}_epochs_params']
+    (preprocessed_folder / epochs_params['folder']).mkdir(parents=True, exist_ok=True)
+
+    # Interpolation matrices are shared by participants with the same bad channels and persisted across runs
+    interpolation_folder = config['interpolation_folder']
+    interpolation_cache = InterpolationCache(Path(interpolation_folder) if interpolation_folder is not None else None)
+
+    # Generate participants list
+    no_participants = config['files_parameters']['no_participants']
+    raw_fif_extension = config['files_parameters']['raw_fif_extension']
+    epochs_fif_extension = config['files_parameters']['epochs_fif_extension']
+    participants = ['p' + str(i).zfill(2) for i in range(1, no_participants + 1)]
+
+    # Completed (participant, segment) units are recorded with the code and parameters they depend on, see checkpoint.py
+    manifest = RunManifest(
+        preprocessed_folder / config['checkpoint']['manifest_filename'],
+        resume=config['checkpoint']['resume']
+    )
+    channels = config['channels']
+    source = code_fingerprint(Path(__file__).parent)
+
+    # Streaming does not load the recordings, its peak is a smaller fraction of the recording's size
+    streaming = config['eeg_parameters']['streaming']
+    scheduler_parameters = config['scheduler']
+    scheduler = MemoryScheduler(
+        budget_mb=scheduler_parameters['memory_budget_mb'],
+        n_jobs=scheduler_parameters['n_jobs'],
+        history_file=scheduler_parameters['history_file'],
+        margin=scheduler_parameters['margin']
+    )
+
+    jobs = []
+    for participant_id in participants:
+        raw_file = raw_folder / (participant_id + raw_fif_extension)
+        unit = f'{participant_id}/{segment_to}'
+        unit_fingerprint = fingerprint(
+            source,
+            config['eeg_parameters'],
+            config['iir_parameters'],
+            epochs_params,
+            channels['montage'],
+            channels['bad_cap'][participant_id],
+            channels[f'{segment_to}_ica_components'][participant_id],
+            participant_id in channels['bad_mastoids'],
+            participant_id in channels['bad_eog'],
+            file_fingerprint(raw_file)
+        )
+        outputs = [preprocessed_folder / epochs_params['folder'] / (participant_id + epochs_fif_extension)]
+        if manifest.completed(unit, unit_fingerprint, outputs):
+            print(f'{unit}: completed in an earlier run, skipping')
+            continue
+
+        raw_info = mne.io.read_raw_fif(raw_file, preload=False)
+        jobs.append({
+            'name': participant_id,
+            'kind': 'preprocess_streaming' if streaming else 'preprocess',
+            'size_mb': raw_info.info['nchan'] * raw_info.n_times * 8 / 2**20,
+            'ratio': 1.0 if streaming else 3.0,
+            'function': preprocess_participant,
+            'args': (config, participant_id, segment_to, interpolation_cache),
+            'tags': {'participant': participant_id, 'segment': segment_to},
+            'unit': unit,
+            'fingerprint': unit_fingerprint,
+            'outputs': outputs
+        })
+
+    scheduler.run(jobs, callback=lambda job, _: manifest.record(job['unit'], job['fingerprint'], job['outputs']))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,206 @@
+""" Out-of-core filtering and epoching of continuous raw recordings.
+
+The raw file is read in chunks instead of being loaded at once. Each chunk is re-referenced, run through the forward
+pass of the anti-alias and notch filters with the filter state carried over from the previous chunk, and run through
+the backward pass once enough forward-filtered samples are available past its end for the backward filter to settle.
+The filtered samples are copied into the epochs they overlap and then discarded, so peak memory is bounded by the chunk
+size and the epochs instead of the length of the recording.
+
+Up to the decay of the filters' impulse responses, the result equals the zero-phase filtering of the loaded recording
+(`raw.filter` and `raw.notch_filter` with `method='iir'`), except within the filters' ringing time of the recording's
+first and last sample, where the in-memory filters pad the signal.
+
+"""
+
+import mne
+import numpy as np
+from scipy.signal import sosfilt, sosfilt_zi
+
+
+def filter_chunks(
+    read_chunk,
+    n_times: int,
+    sos: np.ndarray,
+    chunk_samples: int,
+    overlap_samples: int,
+    picks: np.ndarray | None = None
+):
+    """ Zero-phase filter a long signal chunk by chunk.
+
+    The forward pass runs over consecutive chunks with the filter state carried over. The backward pass of a block
+    starts `overlap_samples` past its end, from the steady state of the forward-filtered sample there, so it has
+    settled by the time it reaches the block.
+
+    Parameters
+    ----------
+    read_chunk : callable
+        Function returning the samples `[start, stop)` of the signal as (channels x times) array.
+    n_times : int
+        Number of samples of the signal.
+    sos : np.ndarray
+        Second-order sections of the filter.
+    chunk_samples : int
+        Number of samples read and returned at a time.
+    overlap_samples : int
+        Number of samples the backward pass runs ahead of a block, at least the ringing time of the filter.
+    picks : np.ndarray | None
+        Channels to filter, the others are returned unchanged. If None, all channels are filtered.
+
+    Yields
+    ------
+    start : int
+        First sample of the block.
+    block : np.ndarray
+        Samples of the block (channels x times).
+
+    """
+    base_zi = sosfilt_zi(sos)[:, None, :]
+    buffer = None
+    buffer_start = 0
+    zi = None
+
+    def backward(segment):
+        segment = segment[:, ::-1]
+        filtered, _ = sosfilt(sos, segment, axis=-1, zi=base_zi * segment[None, :, :1])
+        return filtered[:, ::-1]
+
+    for start in range(0, n_times, chunk_samples):
+        chunk = read_chunk(start, min(start + chunk_samples, n_times))
+        picks = np.arange(chunk.shape[0]) if picks is None else picks
+        if zi is None:
+            zi = base_zi * chunk[None, picks, :1]
+        chunk[picks], zi = sosfilt(sos, chunk[picks], axis=-1, zi=zi)
+        buffer = chunk if buffer is None else np.concatenate([buffer, chunk], axis=-1)
+
+        # Emit all blocks whose backward pass has enough forward-filtered samples to settle
+        while buffer.shape[-1] >= chunk_samples + overlap_samples:
+            block = buffer[:, :chunk_samples].copy()
+            block[picks] = backward(buffer[picks, :chunk_samples + overlap_samples])[:, :chunk_samples]
+            yield buffer_start, block
+            buffer = buffer[:, chunk_samples:]
+            buffer_start += chunk_samples
+
+    # The backward pass over the remaining samples starts at the end of the signal
+    if buffer is not None and buffer.shape[-1]:
+        buffer[picks] = backward(buffer[picks])
+        yield buffer_start, buffer
+
+
+def stream_epochs(
+    raw: mne.io.BaseRaw,
+    events: np.ndarray,
+    event_id: int | list,
+    tmin: float,
+    tmax: float,
+    reference_channels: list,
+    eog_channels: list,
+    sos: np.ndarray,
+    overlap_samples: int,
+    chunk_duration_s: float = 60.0,
+    decim: int = 1,
+    lowpass: float | None = None
+) -> mne.EpochsArray:
+    """ Re-reference, filter and epoch a raw recording without loading it into memory.
+
+    Mirrors the in-memory pipeline: `raw.set_eeg_reference(reference_channels)`, setting `eog_channels` to EOG,
+    filtering the data channels with `sos` forward and backward, and `mne.Epochs(raw, events, event_id, tmin, tmax,
+    baseline=None, decim=decim)`. Only every `decim`-th sample of an epoch is extracted, so the epochs are never held
+    at the original sampling frequency.
+
+    Parameters
+    ----------
+    raw : mne.io.BaseRaw
+        Raw recording opened with `preload=False`, with montage and bad channels set.
+    events : np.ndarray
+        Events to epoch around (events x 3), as returned by `mne.find_events`.
+    event_id : int | list
+        Event codes to epoch around.
+    tmin : float
+        Start of the epochs relative to the events in seconds.
+    tmax : float
+        End of the epochs relative to the events in seconds.
+    reference_channels : list
+        Channels whose mean is subtracted from the EEG channels.
+    eog_channels : list
+        Channels set to EOG after re-referencing. As with `raw.filter`, they are not filtered.
+    sos : np.ndarray
+        Second-order sections of the filters, see `helpers.design_filters`.
+    overlap_samples : int
+        Number of samples the backward pass runs ahead of a chunk, see `helpers.design_filters`.
+    chunk_duration_s : float
+        Duration of the chunks read from the raw file in seconds.
+    decim : int
+        Decimation factor applied while extracting the epochs. The recording must be low-passed accordingly by `sos`.
+    lowpass : float | None
+        Low-pass frequency of `sos`, stored in the measurement information like `raw.filter` does.
+
+    Returns
+    -------
+    epochs : mne.EpochsArray
+        Epochs of the filtered recording.
+
+    """
+    sfreq = raw.info['sfreq']
+    n_times = raw.n_times
+    chunk_samples = max(int(chunk_duration_s * sfreq), 1)
+
+    # Epoch limits in samples, as computed by mne.Epochs
+    start_idx = int(round(tmin * sfreq))
+    stop_idx = int(round(tmax * sfreq))
+    n_epoch_times = stop_idx - start_idx + 1
+
+    # Kept samples within an epoch, aligned to the event like mne.Epochs does, so time zero is kept
+    first_kept = -start_idx % decim
+    n_kept = len(range(first_kept, n_epoch_times, decim))
+
+    event_codes = np.atleast_1d(event_id)
+    events = events[np.isin(events[:, 2], event_codes)]
+    epoch_starts = events[:, 0] - raw.first_samp + start_idx
+    within_recording = (epoch_starts >= 0) & (epoch_starts + n_epoch_times <= n_times)
+    events, epoch_starts = events[within_recording], epoch_starts[within_recording]
+
+    # Re-referencing is applied chunk by chunk on the recording's channel types, before the EOG channels are set
+    reference_info = raw.info.copy()
+
+    def read_chunk(start, stop):
+        chunk = mne.io.RawArray(raw.get_data(start=start, stop=stop), reference_info, verbose=False)
+        chunk.set_eeg_reference(reference_channels, verbose=False)
+        return chunk.get_data()
+
+    info = mne.io.RawArray(raw.get_data(start=0, stop=1), reference_info, verbose=False).set_eeg_reference(
+        reference_channels, verbose=False
+    ).info
+    info.set_channel_types({ch: 'eog' for ch in eog_channels})
+    with info._unlock():
+        info['sfreq'] = sfreq / decim
+        if lowpass is not None:
+            info['lowpass'] = lowpass
+    # As with raw.filter, only data channels are filtered, including bad channels
+    filter_picks = mne.pick_types(
+        info, meg=True, eeg=True, seeg=True, ecog=True, dbs=True, fnirs=True, csd=True, exclude=[]
+    )
+
+    data = np.empty((len(events), len(raw.ch_names), n_kept))
+    kept_starts = epoch_starts + first_kept
+    for start, block in filter_chunks(read_chunk, n_times, sos, chunk_samples, overlap_samples, picks=filter_picks):
+        stop = start + block.shape[-1]
+        overlapping = np.flatnonzero((epoch_starts < stop) & (epoch_starts + n_epoch_times > start))
+        for epoch_idx in overlapping:
+            # Kept samples of the epoch that fall into the block, extracted with a strided slice
+            kept_start = kept_starts[epoch_idx]
+            first = min(max(-(-(start - kept_start) // decim), 0), n_kept)
+            last = min(max(-(-(stop - kept_start) // decim), 0), n_kept)
+            if first < last:
+                data[epoch_idx, :, first:last] = block[:, kept_start + first * decim - start::decim][:, :last - first]
+
+    epochs = mne.EpochsArray(
+        data,
+        info,
+        events=events,
+        tmin=(start_idx + first_kept) / sfreq,
+        event_id={str(code): int(code) for code in event_codes},
+        baseline=None,
+        verbose=False
+    )
+
+    return epochs
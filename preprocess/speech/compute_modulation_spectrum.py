@@ -7,6 +7,7 @@ import pandas as pd
 from pathlib import Path
 from helpers import load_config
 from speech_utils import compute_modulation_spectrum
+from stimulus_repository import StimulusRepository
 
 
 if __name__ == '__main__':
@@ -25,28 +26,38 @@ if __name__ == '__main__':
     mean_duration = np.mean(durations)
     mean_duration_samples = int(mean_duration * sfreq)
     stimuli_list = [file for file in path.glob('*.wav') if not file.name.startswith('._')]
+    index_file = output_folder / config['stimuli_parameters']['index_filename']
+    repository = StimulusRepository(path, index_file=index_file)
 
     # Spectrum parameters
-    mod_spectrum_filename = config['spectrum_parameters']['spectrum_filename']
-    center_freqs = config['spectrum_parameters']['gammatone_center_freqs']
+    mod_spectrum_filename = config['gammatone_parameters']['spectrum_filename']
+    accumulator_file = output_folder / config['gammatone_parameters']['accumulator_filename']
+    center_freqs = config['gammatone_parameters']['gammatone_center_freqs']
     center_freqs['low'] = center_freqs['low']*b2.Hz
     center_freqs['high'] = center_freqs['high']*b2.Hz
     center_freqs = b2h.erbspace(**center_freqs)
 
-    compression = config['spectrum_parameters']['compression']
+    compression = config['gammatone_parameters']['compression']
+    n_jobs = config['gammatone_parameters']['n_jobs']
+    storage = config['gammatone_parameters']['storage']
+    if storage not in ('ragged', 'padded'):
+        raise ValueError(f'Unknown storage `{storage}`, use `ragged` or `padded`.')
 
     spectrum_limits = [
-        config['spectrum_parameters']['spectrum_limits']['low'],
-        config['spectrum_parameters']['spectrum_limits']['high']
+        config['gammatone_parameters']['spectrum_limits']['low'],
+        config['gammatone_parameters']['spectrum_limits']['high']
     ]
 
     freqs_weighted, mod_spectrum = compute_modulation_spectrum(
         stimuli=stimuli_list,
         center_freqs=center_freqs,
         sfreq=sfreq,
-        mean_samples=mean_duration_samples,
+        mean_samples=None if storage == 'ragged' else mean_duration_samples,
         compression=compression,
-        spectrum_limits=spectrum_limits
+        spectrum_limits=spectrum_limits,
+        repository=repository,
+        n_jobs=n_jobs,
+        cache_file=accumulator_file
     )
 
     np.savez(output_folder / mod_spectrum_filename, freqs_weighted=freqs_weighted, mod_spectrum=mod_spectrum)
@@ -3,7 +3,7 @@
 import numpy as np
 from scipy.io import wavfile
 from pathlib import Path
-from speech_utils import cut_wav_from_cue
+from stimulus_repository import StimulusRepository
 from helpers import load_config
 
 
@@ -12,11 +12,15 @@ if __name__ == '__main__':
     wav_dir = Path(config['raw_stimuli_folder'])
     out_dir = Path(config['stimuli_parameters']['stimuli_folder'])
     out_dir.mkdir(exist_ok=True)
+    index_file = Path(config['output_folder']) / config['stimuli_parameters']['index_filename']
 
+    repository = StimulusRepository(wav_dir, index_file=index_file)
     stimuli_list = [file for file in wav_dir.glob('*.wav') if not file.name.startswith('._')]
 
     for stimulus in stimuli_list:
-        speech_train = cut_wav_from_cue(stimulus)
-        fs, _ = wavfile.read(stimulus)
+        speech_train = repository.speech_train(stimulus)
+        fs = repository.sfreq(stimulus)
         speech_train = speech_train.astype(np.int16)
         wavfile.write(out_dir / f'{stimulus.stem[:-5]}.wav', fs, speech_train)
+
+    repository.save_index()
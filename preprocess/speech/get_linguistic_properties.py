@@ -1,11 +1,15 @@
-""" Calculate the rates of phrases, syllables, words and phones for each stimulus. """
+""" Calculate the rates of phrases, syllables, words and phones for each stimulus.
+
+The word, syllable and phone events of all stimuli are parsed from the TextGrids and persisted once, see
+`linguistic_events.py`, so later analyses can generate event regressors without re-parsing the TextGrids.
+
+"""
 
-import numpy as np
 import pandas as pd
-import textgrid
 from pathlib import Path
 from helpers import load_config
-from scipy.io import wavfile
+from linguistic_events import LinguisticEvents
+from stimulus_repository import StimulusRepository
 
 if __name__ == '__main__':
     config = load_config('speech_config.yaml')
@@ -18,16 +22,24 @@ if __name__ == '__main__':
     tg_dir = Path(config['mfa_parameters']['final_output'])
     filename = config['mfa_parameters']['sentences_filename']
     tg_tier_order = config['mfa_parameters']['tg_tier_order']
-    word_idx = tg_tier_order.index('word')
-    phone_idx = tg_tier_order.index('phone')
 
     # Stimuli parameters
     stimuli_dir = Path(config['stimuli_parameters']['stimuli_folder'])
     n_phrases = config['stimuli_parameters']['n_phrases']
     properties_filename = config['stimuli_parameters']['properties_filename']
+    index_file = output_folder / config['stimuli_parameters']['index_filename']
+    events_file = output_folder / config['stimuli_parameters']['events_filename']
+    vowel_symbols = config['stimuli_parameters']['vowel_symbols']
+
+    repository = StimulusRepository(stimuli_dir, tg_dir, index_file=index_file, tg_tier_order=tg_tier_order)
 
     df_stimulus = pd.read_excel(filename, header=None, names=['file', 'sentence', 'syllables'])
     stimulus_list = df_stimulus['file'].tolist()
+    stems = [f'{stimulus}_70dB' for stimulus in stimulus_list]
+
+    events = LinguisticEvents.from_textgrids(repository, stems, vowels=vowel_symbols, cache_file=events_file)
+    word_counts = dict(zip(stems, events.counts('word')))
+    phone_counts = dict(zip(stems, events.counts('phone')))
 
     durations = []
     phrase_rates = []
@@ -35,21 +47,11 @@ if __name__ == '__main__':
     syllable_rates = []
     phone_rates = []
 
-    for stimulus in stimulus_list:
-        fs, speech_stream = wavfile.read(stimuli_dir / f'{stimulus}_70dB.wav')
-        tg = textgrid.TextGrid.fromFile(tg_dir / f'{stimulus}_70dB.TextGrid')
-
-        duration = len(speech_stream) / fs
-        offset_silence = np.abs(tg[word_idx][-1].minTime - tg[word_idx][-1].maxTime)
-        duration = duration - offset_silence
-
-        word_onsets = [entry.mark for entry in tg[word_idx] if entry.mark != '']
-        no_words = len(word_onsets)
-
+    for stimulus, stem in zip(stimulus_list, stems):
+        duration = repository.duration(stem) - repository.offset_silence(stem)
+        no_words = word_counts[stem]
         no_syllables = df_stimulus.loc[df_stimulus['file'] == stimulus, 'syllables'].values[0]
-
-        phone_onsets = [entry.mark for entry in tg[phone_idx] if entry.mark != '']
-        no_phones = len(phone_onsets)
+        no_phones = phone_counts[stem]
 
         durations.append(duration)
         phrase_rates.append(n_phrases / duration)
@@ -67,3 +69,4 @@ if __name__ == '__main__':
     })
 
     df_rates.to_csv(output_folder / properties_filename, index=False, header=True)
+    repository.save_index()
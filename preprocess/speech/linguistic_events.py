@@ -0,0 +1,257 @@
+""" Array-backed store of the word, syllable and phone events of the stimuli, with event regressors. """
+
+import os
+from pathlib import Path
+
+import numpy as np
+
+EVENT_DTYPE = np.dtype([('stimulus', np.int32), ('onset', np.float64), ('offset', np.float64), ('label', np.int32)])
+
+
+class LinguisticEvents:
+    """ Onsets and offsets of the words, syllables and phones of all stimuli, parsed from the TextGrids once.
+
+    Events of one kind are kept in a single structured array (`stimulus`, `onset`, `offset`, `label`) sorted by
+    stimulus and onset, with an offsets array pointing to the first event of each stimulus, so the events of a stimulus
+    are a slice. Labels are stored as codes into a vocabulary per kind. Times are in seconds relative to the start of
+    the TextGrid.
+
+    Syllables are approximated by their nuclei: phones containing a vowel symbol or the syllabic mark (e.g., `n̩`). A
+    vocalized r (`ɐ`) directly following a vowel within the same word forms a diphthong and is not counted as nucleus.
+    The syllable counts in the sentence list remain the reference for the syllable rate.
+
+    The store is persisted as `.npz` file together with the fingerprints (size and modification time) of the TextGrids
+    it was built from and the positions of the word and phone tiers, see `from_textgrids`.
+
+    Parameters
+    ----------
+    stimuli : list
+        Stimulus stems, e.g., `context003_70dB`.
+    events : dict
+        Structured arrays of `EVENT_DTYPE` keyed by kind.
+    labels : dict
+        Vocabularies (lists of labels) keyed by kind.
+
+    """
+
+    KINDS = ('word', 'syllable', 'phone')
+
+    def __init__(self, stimuli: list, events: dict, labels: dict):
+        self.stimuli = list(stimuli)
+        self._stimulus_idx = {stimulus: idx for idx, stimulus in enumerate(self.stimuli)}
+        self._events = {}
+        self._offsets = {}
+        self.labels = {kind: list(labels[kind]) for kind in self.KINDS}
+
+        for kind in self.KINDS:
+            kind_events = np.asarray(events[kind], dtype=EVENT_DTYPE)
+            kind_events = kind_events[np.lexsort((kind_events['onset'], kind_events['stimulus']))]
+            self._events[kind] = kind_events
+            self._offsets[kind] = np.searchsorted(kind_events['stimulus'], np.arange(len(self.stimuli) + 1))
+
+        self.fingerprints = None
+        self.vowels = None
+        self.tiers = None
+
+    @staticmethod
+    def _fingerprints(repository, stimuli: list) -> np.ndarray:
+        """ Size and modification time of the TextGrid of each stimulus. """
+        fingerprints = []
+        for stimulus in stimuli:
+            stat = os.stat(repository.textgrid_path(stimulus))
+            fingerprints.append([stat.st_size, stat.st_mtime_ns])
+        return np.array(fingerprints, dtype=np.int64).reshape(-1, 2)
+
+    @staticmethod
+    def is_nucleus(phone: str, vowels: str) -> bool:
+        """ Whether a phone is a syllable nucleus, i.e., contains a vowel symbol or the syllabic mark. """
+        return any(symbol in vowels for symbol in phone) or '̩' in phone
+
+    @classmethod
+    def from_textgrids(
+        cls,
+        repository,
+        stimuli: list,
+        vowels: str,
+        cache_file: Path | None = None
+    ) -> 'LinguisticEvents':
+        """ Parse the events from the TextGrids, or load them from the cache file if the TextGrids are unchanged.
+
+        Parameters
+        ----------
+        repository : StimulusRepository
+            Repository providing the TextGrids and the order of their tiers.
+        stimuli : list
+            Stimulus stems, e.g., `context003_70dB`.
+        vowels : str
+            Vowel symbols marking syllable nuclei.
+        cache_file : Path | None
+            `.npz` file the events are persisted to. If None, the TextGrids are always parsed.
+
+        Returns
+        -------
+        events : LinguisticEvents
+            Events of all stimuli.
+
+        """
+        stimuli = list(stimuli)
+        tiers = [repository.word_idx, repository.phone_idx]
+        fingerprints = cls._fingerprints(repository, stimuli)
+
+        if cache_file is not None and Path(cache_file).exists():
+            cached = cls.load(cache_file)
+            if (
+                cached.stimuli == stimuli
+                and np.array_equal(cached.fingerprints, fingerprints)
+                and cached.vowels == vowels
+                and cached.tiers == tiers
+            ):
+                return cached
+
+        rows = {kind: [] for kind in cls.KINDS}
+        vocabularies = {kind: {} for kind in cls.KINDS}
+
+        def add(kind, stimulus_idx, interval):
+            code = vocabularies[kind].setdefault(interval.mark, len(vocabularies[kind]))
+            rows[kind].append((stimulus_idx, interval.minTime, interval.maxTime, code))
+
+        for stimulus_idx, stimulus in enumerate(stimuli):
+            tg = repository.textgrid(stimulus)
+            words = [interval for interval in tg[repository.word_idx] if interval.mark != '']
+            phones = [interval for interval in tg[repository.phone_idx] if interval.mark != '']
+
+            for word in words:
+                add('word', stimulus_idx, word)
+
+            previous_nucleus, previous_word = False, None
+            for phone in phones:
+                add('phone', stimulus_idx, phone)
+
+                # Word the phone belongs to, to keep vocalized r's from merging across word boundaries
+                word_idx = next(
+                    (idx for idx, word in enumerate(words) if word.minTime <= phone.minTime < word.maxTime), None
+                )
+                nucleus = cls.is_nucleus(phone.mark, vowels)
+                diphthong = phone.mark == 'ɐ' and previous_nucleus and word_idx == previous_word
+                if nucleus and not diphthong:
+                    add('syllable', stimulus_idx, phone)
+                previous_nucleus, previous_word = nucleus, word_idx
+
+        events = cls(
+            stimuli,
+            events={kind: np.array(rows[kind], dtype=EVENT_DTYPE) for kind in cls.KINDS},
+            labels={kind: list(vocabularies[kind]) for kind in cls.KINDS}
+        )
+        events.fingerprints = fingerprints
+        events.vowels = vowels
+        events.tiers = tiers
+
+        if cache_file is not None:
+            events.save(cache_file)
+
+        return events
+
+    @classmethod
+    def load(cls, cache_file: Path) -> 'LinguisticEvents':
+        """ Load events persisted with `save`. """
+        with np.load(cache_file, allow_pickle=False) as data:
+            events = cls(
+                data['stimuli'].tolist(),
+                events={kind: data[f'{kind}_events'] for kind in cls.KINDS},
+                labels={kind: data[f'{kind}_labels'].tolist() for kind in cls.KINDS}
+            )
+            events.fingerprints = data['fingerprints']
+            events.vowels = str(data['vowels'])
+            events.tiers = data['tiers'].tolist()
+
+        return events
+
+    def save(self, cache_file: Path) -> None:
+        """ Persist the events, vocabularies and TextGrid fingerprints as `.npz` file. """
+        cache_file = Path(cache_file)
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        arrays = {}
+        for kind in self.KINDS:
+            arrays[f'{kind}_events'] = self._events[kind]
+            arrays[f'{kind}_labels'] = np.array(self.labels[kind], dtype=str)
+        np.savez(
+            cache_file,
+            stimuli=np.array(self.stimuli, dtype=str),
+            fingerprints=self.fingerprints if self.fingerprints is not None else np.empty((0, 2), dtype=np.int64),
+            vowels=np.array(self.vowels or ''),
+            tiers=np.array(self.tiers or [], dtype=int),
+            **arrays
+        )
+
+    def events(self, stimulus: str, kind: str) -> np.ndarray:
+        """ Events of one kind of a stimulus, as view into the structured array. """
+        stimulus_idx = self._stimulus_idx[stimulus]
+        return self._events[kind][self._offsets[kind][stimulus_idx]:self._offsets[kind][stimulus_idx + 1]]
+
+    def onsets(self, stimulus: str, kind: str) -> np.ndarray:
+        """ Onsets of the events of one kind of a stimulus in seconds. """
+        return self.events(stimulus, kind)['onset']
+
+    def counts(self, kind: str) -> np.ndarray:
+        """ Number of events of one kind per stimulus, in stimuli order. """
+        return np.diff(self._offsets[kind])
+
+    def regressors(
+        self,
+        kind: str,
+        sfreq: float,
+        n_samples: int,
+        shape: str = 'impulse',
+        stimuli: list | None = None
+    ) -> np.ndarray:
+        """ Event regressors of several stimuli at a given sampling frequency.
+
+        Parameters
+        ----------
+        kind : str
+            Kind of the events, one of `KINDS`.
+        sfreq : float
+            Sampling frequency of the regressors.
+        n_samples : int
+            Number of samples of the regressors. Events beyond are dropped.
+        shape : str
+            `impulse`: one at the sample of each onset. `step`: one from the onset to the offset of each event.
+        stimuli : list | None
+            Stimuli the regressors are generated for, in this order. If None, all stimuli.
+
+        Returns
+        -------
+        regressors : np.ndarray
+            Regressors (stimuli x samples).
+
+        """
+        if shape not in ('impulse', 'step'):
+            raise ValueError(f'Unknown regressor shape {shape}, use `impulse` or `step`.')
+
+        stimuli = self.stimuli if stimuli is None else list(stimuli)
+        stimulus_indices = np.array([self._stimulus_idx[stimulus] for stimulus in stimuli], dtype=int)
+
+        # Events of the requested stimuli and the row of the regressor they go to
+        offsets = self._offsets[kind]
+        counts = offsets[stimulus_indices + 1] - offsets[stimulus_indices]
+        rows = np.repeat(np.arange(len(stimuli)), counts)
+        event_idx = np.concatenate(
+            [np.arange(offsets[idx], offsets[idx + 1]) for idx in stimulus_indices] or [np.empty(0, dtype=int)]
+        )
+        events = self._events[kind][event_idx]
+        onsets = np.round(events['onset'] * sfreq).astype(int)
+
+        if shape == 'impulse':
+            regressors = np.zeros((len(stimuli), n_samples))
+            within = onsets < n_samples
+            np.add.at(regressors, (rows[within], onsets[within]), 1.0)
+            return regressors
+
+        # Boxcars as cumulative sum of +1 at the onsets and -1 at the offsets (at least one sample per event)
+        stops = np.maximum(np.round(events['offset'] * sfreq).astype(int), onsets + 1)
+        changes = np.zeros((len(stimuli), n_samples + 1))
+        within = onsets < n_samples
+        np.add.at(changes, (rows[within], onsets[within]), 1.0)
+        np.add.at(changes, (rows[within], np.minimum(stops[within], n_samples)), -1.0)
+
+        return np.cumsum(changes, axis=-1)[:, :n_samples]
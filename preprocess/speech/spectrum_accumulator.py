@@ -0,0 +1,126 @@
+""" Online accumulation of the modulation spectrum over stimuli. """
+
+import json
+from pathlib import Path
+
+import numpy as np
+
+
+class ModulationSpectrumAccumulator:
+    """ Running sum of squares of the per-stimulus modulation spectra.
+
+    The modulation spectrum is the root mean square over stimuli of the frequency-weighted spectra (see
+    `speech_utils.compute_modulation_spectrum`), so only the sum of their squares and the number of stimuli need to be
+    kept. Stimuli can be added one at a time, accumulated in shards (e.g., one per worker process) that are merged, and
+    added to an accumulator persisted as `.npz` file without recomputing the stimuli it already contains.
+
+    The names and fingerprints (size and modification time of the wav file) of the accumulated stimuli are kept to
+    detect stimuli that were added twice, changed or removed since. Spectra can only be combined if they share the
+    sampling frequency, FFT length and the settings they were computed with (e.g., gammatone filterbank and
+    compression).
+
+    Parameters
+    ----------
+    sfreq : float
+        Sampling frequency of the stimuli.
+    n_fft : int
+        Length of the FFT of the spectra.
+    settings : dict | None
+        JSON-serializable settings the spectra are computed with.
+
+    """
+
+    def __init__(self, sfreq: float, n_fft: int, settings: dict | None = None):
+        self.sfreq = float(sfreq)
+        self.n_fft = int(n_fft)
+        self.settings = dict(settings or {})
+        self.sum_squares = np.zeros(self.n_fft // 2 + 1)
+        self.stimuli = []
+        self.fingerprints = np.empty((0, 2), dtype=np.int64)
+
+    @property
+    def n_stimuli(self) -> int:
+        return len(self.stimuli)
+
+    @property
+    def freqs(self) -> np.ndarray:
+        """ Modulation frequencies of the spectra. """
+        return np.fft.rfftfreq(self.n_fft, 1 / self.sfreq)
+
+    def matches(self, sfreq: float, n_fft: int, settings: dict) -> bool:
+        """ Whether spectra computed with these parameters can be added. """
+        return self.sfreq == float(sfreq) and self.n_fft == int(n_fft) and self.settings == dict(settings)
+
+    def covers(self, stimuli: list, fingerprints: np.ndarray) -> bool:
+        """ Whether all accumulated stimuli are among the given ones and unchanged, i.e., the accumulator can be
+        extended with the others. """
+        current = {stimulus: tuple(fingerprint) for stimulus, fingerprint in zip(stimuli, fingerprints)}
+        return all(
+            current.get(stimulus) == tuple(fingerprint)
+            for stimulus, fingerprint in zip(self.stimuli, self.fingerprints)
+        )
+
+    def add(self, stimulus: str, spectrum: np.ndarray, fingerprint=(0, 0)) -> None:
+        """ Add the modulation spectrum of a stimulus. """
+        if stimulus in self.stimuli:
+            raise ValueError(f'Stimulus {stimulus} was already added.')
+        if spectrum.shape != self.sum_squares.shape:
+            raise ValueError(f'Spectrum of shape {spectrum.shape} does not match {self.sum_squares.shape}.')
+
+        self.sum_squares += spectrum**2
+        self.stimuli.append(stimulus)
+        self.fingerprints = np.vstack([self.fingerprints, np.asarray(fingerprint, dtype=np.int64).reshape(1, 2)])
+
+    def merge(self, other: 'ModulationSpectrumAccumulator') -> 'ModulationSpectrumAccumulator':
+        """ Add the stimuli of another accumulator, e.g., of a shard computed in a worker process. """
+        if not self.matches(other.sfreq, other.n_fft, other.settings):
+            raise ValueError('Cannot merge spectra computed with different parameters.')
+        duplicates = set(self.stimuli) & set(other.stimuli)
+        if duplicates:
+            raise ValueError(f'Stimuli {sorted(duplicates)} are in both accumulators.')
+
+        self.sum_squares += other.sum_squares
+        self.stimuli.extend(other.stimuli)
+        self.fingerprints = np.vstack([self.fingerprints, other.fingerprints])
+
+        return self
+
+    def rms(self) -> np.ndarray:
+        """ Root mean square of the spectra over the stimuli. """
+        if self.n_stimuli == 0:
+            raise ValueError('No stimuli were added.')
+
+        return np.sqrt(self.sum_squares / self.n_stimuli)
+
+    def modulation_spectrum(self, spectrum_limits: list) -> tuple[np.ndarray, np.ndarray]:
+        """ Frequencies and modulation spectrum between the spectrum limits, normalized to its maximum there. """
+        freqs = self.freqs
+        in_limits = (freqs >= spectrum_limits[0]) & (freqs <= spectrum_limits[1])
+        spectrum_rms = self.rms()
+
+        return freqs[in_limits], spectrum_rms[in_limits] / np.max(spectrum_rms[in_limits])
+
+    @classmethod
+    def load(cls, cache_file: Path) -> 'ModulationSpectrumAccumulator':
+        """ Load an accumulator persisted with `save`. """
+        with np.load(cache_file, allow_pickle=False) as data:
+            accumulator = cls(float(data['sfreq']), int(data['n_fft']), json.loads(str(data['settings'])))
+            accumulator.sum_squares = data['sum_squares']
+            accumulator.stimuli = data['stimuli'].tolist()
+            accumulator.fingerprints = data['fingerprints'].reshape(-1, 2)
+
+        return accumulator
+
+    def save(self, cache_file: Path) -> None:
+        """ Persist the sum of squares, the stimuli and their fingerprints as `.npz` file. """
+        cache_file = Path(cache_file)
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        np.savez(
+            cache_file,
+            sfreq=np.array(self.sfreq),
+            n_fft=np.array(self.n_fft),
+            settings=np.array(json.dumps(self.settings, sort_keys=True)),
+            sum_squares=self.sum_squares,
+            stimuli=np.array(self.stimuli, dtype=str),
+            fingerprints=self.fingerprints
+        )
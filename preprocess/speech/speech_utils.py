@@ -1,45 +1,193 @@
 import brian2hears as b2h
 import brian2 as b2
 import numpy as np
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from pathlib import Path
 from scipy.io import wavfile
+from spectrum_accumulator import ModulationSpectrumAccumulator
+from stimulus_repository import StimulusRepository
+from instrumentation import instrument
 
 
-def cut_wav_from_cue(stimulus: str) -> np.ndarray:
-    """ Cut the wav file from the cue point to remove the silence at the beginning of the file.
+def _load_sound(stimulus, repository: StimulusRepository | None) -> b2h.Sound:
+    """ Load a stimulus from the repository or, without repository, from disk. """
+    if repository is not None:
+        return repository.sound(stimulus)
+    return b2h.loadsound(str(stimulus))
 
-    Parameters
-    ----------
-    stimulus : str
-        Path to the wav file.
 
-    Returns
-    -------
-    speech_train : np.ndarray
-        Array of the speech signal (mono train).
+def _fingerprint(stimulus, repository: StimulusRepository | None) -> list:
+    """ Size and modification time of the wav file of a stimulus. """
+    path = repository.wav_path(stimulus) if repository is not None else Path(stimulus)
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _n_samples(stimulus, repository: StimulusRepository | None) -> int:
+    """ Number of samples of a stimulus, from the repository index or the (memory-mapped) wav file. """
+    if repository is not None:
+        return int(round(repository.duration(stimulus) * repository.sfreq(stimulus)))
+    return wavfile.read(str(stimulus), mmap=True)[1].shape[0]
+
+
+@instrument
+def _gammatone_subbands(
+    stimulus,
+    mean_samples: int | None,
+    center_freqs: dict,
+    compression: float,
+    repository: StimulusRepository | None
+) -> np.ndarray:
+    """ Half-wave rectified and compressed gammatone subbands, padded or cut to `mean_samples` unless None. """
+    sound = _load_sound(stimulus, repository)
+    gammatone = b2h.Gammatone(sound, center_freqs)
+    filterbank = b2h.FunctionFilterbank(gammatone, lambda x: b2.clip(x, 0, b2.Inf)**(compression))
+    subbands = np.asarray(filterbank.process())
+
+    if mean_samples is None:
+        return subbands
+
+    if subbands.shape[0] < mean_samples:
+        pad_length = mean_samples - subbands.shape[0]
+        subbands = np.pad(subbands, ((0, pad_length), (0, 0)), 'constant')
+    elif subbands.shape[0] > mean_samples:
+        subbands = subbands[:mean_samples]
+
+    return subbands
+
+
+def _stimulus_spectrum(
+    stimulus,
+    sfreq: float,
+    mean_samples: int | None,
+    center_freqs: dict,
+    compression: float,
+    repository: StimulusRepository | None,
+    n_fft: int | None = None
+) -> np.ndarray:
+    """ Frequency-weighted modulation spectrum of a single stimulus, RMS over gammatone subbands.
+
+    Without `mean_samples`, the subbands are transformed at their true length, zero-padded to `n_fft` samples so all
+    stimuli share the frequencies, and scaled by `sqrt(n_fft / n_samples)` so the spectral amplitude does not depend
+    on the stimulus length.
 
     """
+    subbands = _gammatone_subbands(stimulus, mean_samples, center_freqs, compression, repository)
 
-    _, data = wavfile.read(stimulus)
+    if mean_samples is None:
+        if subbands.shape[0] > n_fft:
+            raise ValueError(f'{stimulus}: {subbands.shape[0]} samples do not fit into an FFT of length {n_fft}.')
+        subband_spectra = np.abs(b2.rfft(subbands, n=n_fft, axis=0)) * np.sqrt(n_fft / subbands.shape[0])
+    else:
+        n_fft = mean_samples
+        subband_spectra = np.abs(b2.rfft(subbands, axis=0))
+    xf = b2.rfftfreq(n_fft, 1 / sfreq)
 
-    if data.ndim != 2:
-        raise ValueError('Soundfile needs to be a stereo file.')
+    mean_spectrum = np.sqrt(np.mean(subband_spectra**2, axis=1))
+    mean_spectrum = np.sqrt(xf) * mean_spectrum
 
-    speech_train = data[:, 0]
-    trigger_train = data[:, 1]
-    trigger = np.where(trigger_train != 0)[0][0]
+    return mean_spectrum
 
-    speech_train = speech_train[trigger:]
 
-    return speech_train
+def _accumulate_spectra(
+    stimuli: list,
+    accumulator: ModulationSpectrumAccumulator,
+    repository: StimulusRepository | None,
+    **kwargs
+) -> ModulationSpectrumAccumulator:
+    """ Add the modulation spectra of a shard of stimuli to an (empty) accumulator, in a worker process if needed. """
+    for stimulus in stimuli:
+        spectrum = _stimulus_spectrum(stimulus, repository=repository, **kwargs)
+        accumulator.add(Path(stimulus).stem, spectrum, _fingerprint(stimulus, repository))
 
+    return accumulator
 
+
+def _stimulus_envelope(
+    stimulus,
+    mean_samples: int | None,
+    center_freqs: dict,
+    compression: float,
+    repository: StimulusRepository | None
+) -> np.ndarray:
+    """ Envelope of a single stimulus, mean over gammatone subbands. """
+    subbands = _gammatone_subbands(stimulus, mean_samples, center_freqs, compression, repository)
+
+    return subbands.mean(axis=1)
+
+
+def _shared_worker(shm_name: str, size: int, start: int, stop: int, function, stimulus, kwargs: dict) -> None:
+    """ Compute one stimulus in a worker process and write the result into its segment of the shared array. """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        results = np.ndarray((size,), dtype=np.float64, buffer=shm.buf)
+        results[start:stop] = function(stimulus, **kwargs)
+        del results
+    finally:
+        shm.close()
+
+
+def _map_stimuli_ragged(function, stimuli: list, offsets: np.ndarray, n_jobs: int, **kwargs) -> np.ndarray:
+    """ Apply a per-stimulus function to all stimuli and concatenate the results, stimulus `i` filling the values
+    between `offsets[i]` and `offsets[i + 1]`.
+
+    With `n_jobs > 1`, the stimuli are fanned out across a process pool. Each worker writes its result directly into
+    a shared-memory array, so per-stimulus results are not pickled back to the parent.
+
+    """
+    size = int(offsets[-1])
+
+    if n_jobs == 1:
+        results = np.full(size, np.nan)
+        for idx, stimulus in enumerate(stimuli):
+            results[offsets[idx]:offsets[idx + 1]] = function(stimulus, **kwargs)
+        return results
+
+    shm = shared_memory.SharedMemory(create=True, size=max(size * 8, 1))
+    try:
+        shared = np.ndarray((size,), dtype=np.float64, buffer=shm.buf)
+        shared.fill(np.nan)
+
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            futures = [
+                executor.submit(
+                    _shared_worker, shm.name, size, offsets[idx], offsets[idx + 1], function, stimulus, kwargs
+                )
+                for idx, stimulus in enumerate(stimuli)
+            ]
+            for future in futures:
+                future.result()
+
+        results = shared.copy()
+        del shared
+    finally:
+        shm.close()
+        shm.unlink()
+
+    return results
+
+
+def _map_stimuli(function, stimuli: list, n_values: int, n_jobs: int, **kwargs) -> np.ndarray:
+    """ Apply a per-stimulus function to all stimuli and stack the results into a (n_stimuli, n_values) array. """
+    offsets = np.arange(len(stimuli) + 1) * n_values
+    results = _map_stimuli_ragged(function, stimuli, offsets, n_jobs, **kwargs)
+
+    return results.reshape(len(stimuli), n_values)
+
+
+@instrument
 def compute_modulation_spectrum(
     stimuli: list,
     sfreq: float,
-    mean_samples: int,
+    mean_samples: int | None,
     center_freqs: dict,
     compression: float,
-    spectrum_limits: list
+    spectrum_limits: list,
+    repository: StimulusRepository | None = None,
+    n_jobs: int = 1,
+    cache_file: Path | None = None
 ) -> tuple[np.ndarray, np.ndarray]:
     """ Compute the modulation spectrum of a list of stimuli according to the procedure suggested by Ding et al. (2017).
     The code is adapted from Oderbolz et al. (2024).
@@ -52,20 +200,31 @@ def compute_modulation_spectrum(
     5. Average over the stimuli and compute the root mean square (RMS) of modulation spectrum.
     6. Weight the modulation spectrum by frequencies between spectrum limits of interest.
 
+    The RMS is accumulated online as sum of squares (see `ModulationSpectrumAccumulator`), one shard of stimuli per
+    worker process. With a cache file, the accumulator is persisted and only stimuli that are not in it yet are
+    computed, as long as the stimuli in it are unchanged and the parameters are the same.
+
     Parameters
     ----------
     stimuli : list
         List of stimuli to compute the modulation spectrum from.
     sfreq : float
         Sampling frequency of the stimuli.
-    mean_samples : int
-        Number of samples to average the modulation spectrum over.
+    mean_samples : int | None
+        Number of samples to average the modulation spectrum over. If None, each stimulus is analyzed at its true
+        length and the spectra are zero-padded to the longest stimulus, see `_stimulus_spectrum`.
     center_freqs : dict
         Dictionary containing the parameters to create the gammatone filterbank.
     compression : float
         Compression factor for the half-wave rectification using the clip function.
     spectrum_limits : list
         List containing the lower and upper limit of the modulation spectrum.
+    repository : StimulusRepository | None
+        Repository the stimuli are loaded from. If None, the stimuli are read from disk with `b2h.loadsound`.
+    n_jobs : int
+        Number of worker processes the stimuli are distributed over.
+    cache_file : Path | None
+        `.npz` file the accumulated spectra are persisted to and extended from. If None, all stimuli are computed.
 
     Returns
     -------
@@ -83,91 +242,114 @@ def compute_modulation_spectrum(
     cortical entrainment and phase-amplitude coupling. bioRxiv preprint. https://doi.org/10.1101/2024.01.22.576636
 
     """
-    mean_spectra_list = []
-
-    for stimulus in stimuli:
-        sound = b2h.loadsound(str(stimulus))
-        gammatone = b2h.Gammatone(sound, center_freqs)
-        filterbank = b2h.FunctionFilterbank(gammatone, lambda x: b2.clip(x, 0, b2.Inf)**(compression))
-        subbands = filterbank.process()
-        subband_spectra_list = []
-
-        for j in range(len(subbands[1])):
-            band = subbands[:, j]
-
-            if band.shape[0] < mean_samples:
-                pad_length = mean_samples - band.shape[0]
-                band = np.pad(band, (0, pad_length), 'constant')
-            elif band.shape[0] > mean_samples:
-                cut_length = band.shape[0] - mean_samples
-                band = band[:-cut_length]
-
-            yf = np.abs(b2.rfft(band))
-            xf = b2.rfftfreq(mean_samples, 1 / sfreq)
-
-            abs_yf = np.abs(yf)
-
-            subband_spectra_list.append(abs_yf)
-
-        subband_spectra_list = np.array(subband_spectra_list)
-        mean_spectrum = np.sqrt(np.mean(subband_spectra_list**2, axis=0))
-        mean_spectrum = np.sqrt(xf) * mean_spectrum
-        mean_spectra_list.append(mean_spectrum)
-
-    mean_spectra_list = np.array(mean_spectra_list)
-    spectrum_rms = np.sqrt(np.mean(mean_spectra_list**2, axis=0))
-    mod_spectrum = spectrum_rms / np.max(spectrum_rms[(xf >= spectrum_limits[0]) & (xf <= spectrum_limits[1])])
-
-    freqs_weighted = xf[(xf >= spectrum_limits[0]) & (xf <= spectrum_limits[1])]
-    mod_spectrum = mod_spectrum[(xf >= spectrum_limits[0]) & (xf <= spectrum_limits[1])]
+    n_fft = mean_samples
+    if n_fft is None:
+        n_fft = max(_n_samples(stimulus, repository) for stimulus in stimuli)
+
+    settings = {
+        'mean_samples': mean_samples,
+        'center_freqs': np.asarray(center_freqs, dtype=float).tolist(),
+        'compression': float(compression)
+    }
+    accumulator = ModulationSpectrumAccumulator(sfreq, n_fft, settings)
+
+    if cache_file is not None and Path(cache_file).exists():
+        cached = ModulationSpectrumAccumulator.load(cache_file)
+        fingerprints = [_fingerprint(stimulus, repository) for stimulus in stimuli]
+        if cached.matches(sfreq, n_fft, settings) and cached.covers([Path(s).stem for s in stimuli], fingerprints):
+            accumulator = cached
+
+    pending = [stimulus for stimulus in stimuli if Path(stimulus).stem not in accumulator.stimuli]
+    kwargs = {
+        'sfreq': sfreq,
+        'mean_samples': mean_samples,
+        'center_freqs': center_freqs,
+        'compression': compression,
+        'n_fft': n_fft
+    }
+
+    if n_jobs == 1 or len(pending) <= 1:
+        _accumulate_spectra(pending, accumulator, repository, **kwargs)
+    else:
+        # One shard per worker, accumulated in the worker and merged here: only the sums are sent back
+        shards = [list(shard) for shard in np.array_split(np.array(pending, dtype=object), n_jobs) if len(shard)]
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            futures = [
+                executor.submit(
+                    _accumulate_spectra, shard, ModulationSpectrumAccumulator(sfreq, n_fft, settings), repository,
+                    **kwargs
+                )
+                for shard in shards
+            ]
+            for future in futures:
+                accumulator.merge(future.result())
+
+    if cache_file is not None:
+        accumulator.save(cache_file)
+
+    freqs_weighted, mod_spectrum = accumulator.modulation_spectrum(spectrum_limits)
 
     return freqs_weighted, mod_spectrum
 
 
+@instrument
 def compute_envelopes(
     stimuli: list,
-    mean_samples: int,
+    mean_samples: int | None,
     center_freqs: dict,
     compression: float,
-) -> np.ndarray:
+    repository: StimulusRepository | None = None,
+    n_jobs: int = 1
+) -> np.ndarray | tuple[np.ndarray, np.ndarray]:
     """ Compute the envelopes of a list of stimuli using the gammatone filterbank.
 
     Parameters
     ----------
     stimuli : list
         List of stimuli to compute the envelopes from.
-    mean_samples : int
-        Number of samples to average the envelopes over.
+    mean_samples : int | None
+        Number of samples the envelopes are padded or cut to. If None, the envelopes keep their true lengths and are
+        returned as ragged array.
     center_freqs : dict
         Dictionary containing the parameters to create the gammatone filterbank.
     compression : float
         Compression factor for the half-wave rectification using the clip function.
+    repository : StimulusRepository | None
+        Repository the stimuli are loaded from. If None, the stimuli are read from disk with `b2h.loadsound`.
+    n_jobs : int
+        Number of worker processes the stimuli are distributed over.
 
-    """
-
-    envelopes = np.full((len(stimuli), mean_samples), np.nan)
-
-    for idx, stimulus in enumerate(stimuli):
-        sound = b2h.loadsound(str(stimulus))
-        gammatone = b2h.Gammatone(sound, center_freqs)
-        filterbank = b2h.FunctionFilterbank(gammatone, lambda x: b2.clip(x, 0, b2.Inf)**(compression))
-        subbands = filterbank.process()
-
-        envelope = []
-
-        for j in range(len(subbands[1])):
-            band = subbands[:, j]
-
-            if band.shape[0] < mean_samples:
-                pad_length = mean_samples - band.shape[0]
-                band = np.pad(band, (0, pad_length), 0)
-            elif band.shape[0] > mean_samples:
-                cut_length = band.shape[0] - mean_samples
-                band = band[:-cut_length]
-
-            envelope.append(band)
-
-        envelopes[idx, :] = np.mean(envelope, axis=0)
-
-        return envelopes
+    Returns
+    -------
+    envelopes : np.ndarray | tuple[np.ndarray, np.ndarray]
+        Envelopes of the stimuli, shape (n_stimuli, mean_samples). Without `mean_samples`, the concatenated envelopes
+        and the offsets of the stimuli, i.e., stimulus `i` is `envelopes[offsets[i]:offsets[i + 1]]`.
 
+    """
+    if mean_samples is None:
+        lengths = [_n_samples(stimulus, repository) for stimulus in stimuli]
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        envelopes = _map_stimuli_ragged(
+            _stimulus_envelope,
+            stimuli,
+            offsets,
+            n_jobs=n_jobs,
+            mean_samples=None,
+            center_freqs=center_freqs,
+            compression=compression,
+            repository=repository
+        )
+        return envelopes, offsets
+
+    envelopes = _map_stimuli(
+        _stimulus_envelope,
+        stimuli,
+        n_values=mean_samples,
+        n_jobs=n_jobs,
+        mean_samples=mean_samples,
+        center_freqs=center_freqs,
+        compression=compression,
+        repository=repository
+    )
+
+    return envelopes
@@ -0,0 +1,192 @@
+""" Cached access to the stimulus WAV and TextGrid files shared by the speech processing scripts. """
+
+import json
+import os
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
+import textgrid
+from scipy.io import wavfile
+
+
+class StimulusRepository:
+    """ Load each stimulus WAV/TextGrid once and memoize the values derived from them.
+
+    Caching happens on three levels:
+    1. WAV files are memory-mapped, so reading a stimulus does not copy the whole file into memory.
+    2. Loaded WAV files and TextGrids are kept in an in-process LRU cache.
+    3. Derived values (duration, trigger offset, offset silence) are stored in an index file and
+       reused across runs as long as the source file is unchanged (same size and modification time).
+
+    Stimuli are addressed either by their WAV path or by their file stem, e.g., `context003_70dB`.
+
+    Parameters
+    ----------
+    wav_folder : Path
+        Folder containing the WAV files.
+    textgrid_folder : Path | None
+        Folder containing the TextGrids, named like the WAV files.
+    index_file : Path | None
+        JSON file the derived values are persisted to. If None, values are only memoized in-process.
+    tg_tier_order : list | None
+        Order of the tiers in the TextGrids. Defaults to `['word', 'phone']`.
+    cache_size : int
+        Maximum number of WAV files and TextGrids kept in the in-process cache.
+
+    """
+
+    def __init__(
+        self,
+        wav_folder: Path,
+        textgrid_folder: Path | None = None,
+        index_file: Path | None = None,
+        tg_tier_order: list | None = None,
+        cache_size: int = 256
+    ):
+        self.wav_folder = Path(wav_folder)
+        self.textgrid_folder = Path(textgrid_folder) if textgrid_folder is not None else None
+        self.index_file = Path(index_file) if index_file is not None else None
+        tg_tier_order = tg_tier_order if tg_tier_order is not None else ['word', 'phone']
+        self.word_idx = tg_tier_order.index('word')
+        self.phone_idx = tg_tier_order.index('phone')
+
+        self._index = {}
+        if self.index_file is not None and self.index_file.exists():
+            with open(self.index_file, 'r') as file:
+                self._index = json.load(file)
+        self._index_changed = False
+
+        self.cache_size = cache_size
+        self.read_wav = lru_cache(maxsize=cache_size)(self._read_wav)
+        self.read_textgrid = lru_cache(maxsize=cache_size)(self._read_textgrid)
+
+    def __getstate__(self) -> dict:
+        # The LRU caches wrap bound methods and cannot be pickled, e.g., when handing the repository to worker processes
+        state = self.__dict__.copy()
+        del state['read_wav'], state['read_textgrid']
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self.read_wav = lru_cache(maxsize=self.cache_size)(self._read_wav)
+        self.read_textgrid = lru_cache(maxsize=self.cache_size)(self._read_textgrid)
+
+    def wav_path(self, stimulus: str | Path) -> Path:
+        """ Path to the WAV file of a stimulus. """
+        if isinstance(stimulus, Path):
+            return stimulus
+        return self.wav_folder / f'{stimulus}.wav'
+
+    def textgrid_path(self, stimulus: str | Path) -> Path:
+        """ Path to the TextGrid of a stimulus. """
+        if self.textgrid_folder is None:
+            raise ValueError('No TextGrid folder given to the stimulus repository.')
+        stem = stimulus.stem if isinstance(stimulus, Path) else stimulus
+        return self.textgrid_folder / f'{stem}.TextGrid'
+
+    def _read_wav(self, path: Path) -> tuple[int, np.ndarray]:
+        return wavfile.read(path, mmap=True)
+
+    def _read_textgrid(self, path: Path) -> textgrid.TextGrid:
+        return textgrid.TextGrid.fromFile(path)
+
+    def wav(self, stimulus: str | Path) -> tuple[int, np.ndarray]:
+        """ Sampling frequency and memory-mapped samples of a stimulus. """
+        return self.read_wav(self.wav_path(stimulus))
+
+    def textgrid(self, stimulus: str | Path) -> textgrid.TextGrid:
+        """ Forced-alignment TextGrid of a stimulus. """
+        return self.read_textgrid(self.textgrid_path(stimulus))
+
+    def sound(self, stimulus: str | Path) -> 'b2h.Sound':
+        """ Stimulus as brian2hears sound, integer samples scaled to [-1, 1) like `b2h.loadsound` and `wavfile`.
+
+        Signed samples (16-bit, 24-bit read as 32-bit, 32-bit) are divided by their full scale, unsigned 8-bit samples
+        are centered around their midpoint first.
+
+        """
+        # brian2 takes seconds to import and is only needed for the sounds
+        import brian2 as b2
+        import brian2hears as b2h
+
+        sfreq, data = self.wav(stimulus)
+        if np.issubdtype(data.dtype, np.signedinteger):
+            data = data / -float(np.iinfo(data.dtype).min)
+        elif np.issubdtype(data.dtype, np.unsignedinteger):
+            midpoint = (np.iinfo(data.dtype).max + 1) / 2
+            data = (data - midpoint) / midpoint
+        return b2h.Sound(np.asarray(data, dtype=float), samplerate=sfreq*b2.Hz)
+
+    def _derived(self, path: Path, key: str, compute) -> float | int:
+        """ Look up a derived value in the index and compute it if the source file changed. """
+        stat = os.stat(path)
+        fingerprint = [stat.st_size, stat.st_mtime_ns]
+        entry = self._index.get(str(path.resolve()))
+
+        if entry is None or entry['fingerprint'] != fingerprint:
+            entry = {'fingerprint': fingerprint, 'values': {}}
+            self._index[str(path.resolve())] = entry
+
+        if key not in entry['values']:
+            entry['values'][key] = compute()
+            self._index_changed = True
+
+        return entry['values'][key]
+
+    def sfreq(self, stimulus: str | Path) -> int:
+        """ Sampling frequency of a stimulus. """
+        path = self.wav_path(stimulus)
+        return self._derived(path, 'sfreq', lambda: int(self.read_wav(path)[0]))
+
+    def duration(self, stimulus: str | Path) -> float:
+        """ Duration of a stimulus in seconds. """
+        path = self.wav_path(stimulus)
+
+        def compute():
+            sfreq, data = self.read_wav(path)
+            return data.shape[0] / sfreq
+
+        return self._derived(path, 'duration', compute)
+
+    def trigger_offset(self, stimulus: str | Path) -> int:
+        """ Sample of the first cue in the trigger train (second channel) of a stereo stimulus. """
+        path = self.wav_path(stimulus)
+
+        def compute():
+            _, data = self.read_wav(path)
+            if data.ndim != 2:
+                raise ValueError('Soundfile needs to be a stereo file.')
+            return int(np.flatnonzero(data[:, 1])[0])
+
+        return self._derived(path, 'trigger_offset', compute)
+
+    def speech_train(self, stimulus: str | Path) -> np.ndarray:
+        """ Speech signal (mono train) of a stereo stimulus from the cue point onwards.
+
+        Removes the silence at the beginning of the file that precedes the trigger.
+
+        """
+        _, data = self.wav(stimulus)
+        trigger = self.trigger_offset(stimulus)
+
+        return data[trigger:, 0]
+
+    def offset_silence(self, stimulus: str | Path) -> float:
+        """ Duration of the last interval in the word tier, i.e., the silence after the sentence. """
+        path = self.textgrid_path(stimulus)
+
+        def compute():
+            last_word = self.read_textgrid(path)[self.word_idx][-1]
+            return float(np.abs(last_word.minTime - last_word.maxTime))
+
+        return self._derived(path, 'offset_silence', compute)
+
+    def save_index(self) -> None:
+        """ Persist the derived values to the index file. """
+        if self.index_file is None or not self._index_changed:
+            return
+        self.index_file.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.index_file, 'w') as file:
+            json.dump(self._index, file, indent=1)
+        self._index_changed = False
@@ -0,0 +1,207 @@
+""" Parallel participant (x band) jobs within a memory budget.
+
+Running participants in parallel multiplies the memory of the preloaded recordings and float64 epochs. The scheduler
+runs jobs in worker processes and only starts a job if the estimated peaks of the running jobs, including it, stay
+within the budget. Jobs are started in order, later ones that fit are started ahead of a job that does not; a job above
+the budget on its own is started once no other job runs.
+
+The peak memory of a job is estimated from the size of its data in MB (e.g., from the file sizes, channels, sampling
+frequency and duration), times a ratio per kind of job. The ratio defaults to the job's own guess, and once peaks were
+observed, to the largest observed ratio of peak to size. The observed peaks are persisted as `.json` file, so later
+runs start from the refined estimates.
+
+The peak of a job is measured in its worker process as the peak resident memory above the worker's resident memory at
+the start of the job (the peak is reset per job on Linux, elsewhere it is the worker's peak so far). With a single
+job at a time, the jobs run in this process.
+
+Usage:
+    scheduler = MemoryScheduler(budget_mb=8000, n_jobs=4, history_file='memory_history.json')
+    results = scheduler.run([
+        {'name': 'p01', 'kind': 'preprocess', 'size_mb': 900, 'ratio': 3.0, 'function': preprocess, 'args': ('p01',)},
+        ...
+    ])
+
+"""
+
+import ctypes
+import json
+import multiprocessing
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from pathlib import Path
+
+from instrumentation import peak_rss, reset_peak_rss, stage
+
+# Observations kept per kind of job
+HISTORY_LENGTH = 100
+
+
+def _rss() -> int:
+    """ Current resident memory in bytes (Linux only, zero elsewhere). """
+    try:
+        with open('/proc/self/status', 'r') as file:
+            for line in file:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def _run_job(function, args: tuple, kwargs: dict, kind: str, tags: dict) -> tuple:
+    """ Run a job in a worker process, recorded as stage `kind` tagged with `tags`, and return its result and peak
+    memory in MB. """
+    reset_peak_rss()
+    start_rss = _rss()
+    with stage(kind, **tags):
+        result = function(*args, **kwargs)
+    peak_mb = max(peak_rss() - start_rss, 0) / 2**20
+
+    # Hand the memory freed by the job back to the system, so it does not count towards the next job's start
+    try:
+        ctypes.CDLL('libc.so.6').malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+    return result, peak_mb
+
+
+class MemoryScheduler:
+    """ Runs jobs in worker processes while their estimated peak memory stays within a budget.
+
+    Parameters
+    ----------
+    budget_mb : float
+        Budget for the sum of the estimated peaks of the running jobs in MB.
+    n_jobs : int
+        Number of worker processes.
+    history_file : Path | None
+        `.json` file with the observed peaks of earlier runs, updated after each run. If None, peaks are only used
+        within the run.
+    margin : float
+        Factor the estimates are scaled by.
+
+    """
+
+    def __init__(self, budget_mb: float, n_jobs: int = 1, history_file: Path | None = None, margin: float = 1.2):
+        self.budget_mb = float(budget_mb)
+        self.n_jobs = int(n_jobs)
+        self.history_file = Path(history_file) if history_file is not None else None
+        self.margin = float(margin)
+        self.history = {}
+        if self.history_file is not None and self.history_file.exists():
+            self.history = json.loads(self.history_file.read_text())
+
+    def estimate(self, kind: str, size_mb: float, ratio: float) -> float:
+        """ Estimated peak memory in MB of a job of a kind with data of `size_mb`, `ratio` if none was observed. """
+        observed = [peak / size for size, peak in self.history.get(kind, []) if size > 0]
+        if observed:
+            ratio = max(observed)
+
+        return self.margin * ratio * size_mb
+
+    def observe(self, kind: str, size_mb: float, peak_mb: float) -> None:
+        """ Record the observed peak of a job. """
+        observations = self.history.setdefault(kind, [])
+        observations.append([round(size_mb, 3), round(peak_mb, 3)])
+        del observations[:-HISTORY_LENGTH]
+
+    def save(self) -> None:
+        """ Persist the observed peaks to the history file. """
+        if self.history_file is None:
+            return
+        self.history_file.parent.mkdir(parents=True, exist_ok=True)
+        self.history_file.write_text(json.dumps(self.history))
+
+    def run(self, jobs: list, callback=None) -> list:
+        """ Run the jobs and return their results in order.
+
+        Parameters
+        ----------
+        jobs : list
+            Jobs as dictionaries with `function`, `args` (and optionally `kwargs`) to call, the `kind` of job, the
+            `size_mb` of its data, the `ratio` of peak memory to size guessed if none was observed, a `name`, and
+            optionally the `tags` (e.g., participant and band) the job is recorded with, see instrumentation.py.
+        callback : callable | None
+            Called in this process with each job and its result once the job completed, e.g., to record it.
+
+        Returns
+        -------
+        results : list
+            Return value of each job.
+
+        """
+        estimates = [self.estimate(job['kind'], job['size_mb'], job['ratio']) for job in jobs]
+        results = [None] * len(jobs)
+        pending = list(range(len(jobs)))
+        running = {}
+        used_mb = 0.0
+
+        # One job at a time needs no workers, the peaks are still recorded for later parallel runs
+        if self.n_jobs == 1:
+            try:
+                for job_idx, job in enumerate(jobs):
+                    results[job_idx], peak_mb = _run_job(
+                        job['function'],
+                        job['args'],
+                        job.get('kwargs', {}),
+                        job['kind'],
+                        job.get('tags', {})
+                    )
+                    self.observe(job['kind'], job['size_mb'], peak_mb)
+                    if callback is not None:
+                        callback(job, results[job_idx])
+            finally:
+                self.save()
+            return results
+
+        # Forked workers inherit the loaded libraries and the jobs' functions, also those of a script's `__main__`
+        context = multiprocessing.get_context('fork')
+        error = None
+        try:
+            with ProcessPoolExecutor(max_workers=self.n_jobs, mp_context=context) as executor:
+                while pending or running:
+                    for job_idx in list(pending):
+                        if len(running) >= self.n_jobs:
+                            break
+                        if running and used_mb + estimates[job_idx] > self.budget_mb:
+                            continue
+                        if estimates[job_idx] > self.budget_mb:
+                            print(
+                                f'{jobs[job_idx]["name"]}: estimated {estimates[job_idx]:.0f} MB exceed the budget of '
+                                f'{self.budget_mb:.0f} MB, running it alone'
+                            )
+
+                        job = jobs[job_idx]
+                        future = executor.submit(
+                            _run_job,
+                            job['function'],
+                            job['args'],
+                            job.get('kwargs', {}),
+                            job['kind'],
+                            job.get('tags', {})
+                        )
+                        running[future] = job_idx
+                        used_mb += estimates[job_idx]
+                        pending.remove(job_idx)
+
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        job_idx = running.pop(future)
+                        used_mb -= estimates[job_idx]
+                        if future.exception() is not None:
+                            # No further jobs are started, the running ones still complete (and are recorded)
+                            print(f'{jobs[job_idx]["name"]} failed')
+                            error = error or future.exception()
+                            pending.clear()
+                            continue
+                        results[job_idx], peak_mb = future.result()
+                        self.observe(jobs[job_idx]['kind'], jobs[job_idx]['size_mb'], peak_mb)
+                        if callback is not None:
+                            callback(jobs[job_idx], results[job_idx])
+        finally:
+            self.save()
+
+        if error is not None:
+            raise error
+
+        return results
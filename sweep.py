@@ -0,0 +1,347 @@
+""" Parameter sweeps over the pipelines' configurations that compute each distinct intermediate once.
+
+A sweep runs pipeline steps (see `SWEEP_STEPS`) for every combination of the values of a grid over configuration keys.
+Each step declares the configuration keys it reads and the outputs of other steps it takes as inputs, so the setting of
+a step at a grid point is identified by a fingerprint of the values it reads, its code (including the modules it
+imports) and the fingerprints of its inputs. Grid points with the same fingerprint share the step's output: sweeping
+the PLV method reuses the frequency bands of all points, and sweeping the frequency bands or the envelope compression
+reuses the epochs.
+
+The distinct settings of the steps are the nodes of a dependency graph. Each node runs once, in
+`<work_folder>/<step>/<fingerprint>` with its own configuration file and output folders, and is reused by later sweeps
+with the same fingerprint. Nodes whose inputs are ready run in parallel. The results of all grid points are collected
+into one table indexed by the grid point and its parameter values.
+
+Usage:
+    python neuroscales.py sweep sweep_config.yaml
+
+"""
+
+import copy
+import hashlib
+import itertools
+import json
+import subprocess
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+
+import pandas as pd
+import yaml
+
+from checkpoint import code_fingerprint
+from neuroscales import REPO_FOLDER, STEPS, find_config, run_step
+
+# Steps that can be swept, in the order they depend on each other. `reads`: configuration keys (sections or dotted keys
+# within sections) the step's output depends on, `inputs`: configuration keys pointing to the output of another step
+# (step, output key, subfolder), `outputs`: configuration keys of the folders the step writes to, `results`: key of
+# the `.csv` file in the first output folder collected into the results of the sweep
+SWEEP_STEPS = {
+    'epochs': {
+        **STEPS['eeg'][0],
+        'code': STEPS['eeg'][0]['code'].format(segments=['onset']),
+        'reads': [
+            'raw_folder', 'files_parameters', 'eeg_parameters', 'channels', 'onset_epochs_params', 'iir_parameters'
+        ],
+        'inputs': {},
+        'outputs': ['preprocessed_folder', 'plots_folder']
+    },
+    'bands': {
+        **STEPS['bands'][0],
+        'reads': [
+            'speech_folder', 'logs_folder', 'files_parameters', 'frequency_bands', 'filtering_parameters',
+            'iir_parameters', 'wavelet_parameters'
+        ],
+        'inputs': {'eeg_folder': ('epochs', 'preprocessed_folder', 'onset')},
+        'outputs': ['bands_folder']
+    },
+    'plv': {
+        **STEPS['plv'][0],
+        'reads': [
+            'files_parameters', 'frequency_bands', 'filtering_parameters.sfreq_goal', 'filtering_parameters.storage',
+            'plv_parameters'
+        ],
+        'inputs': {'bands_folder': ('bands', 'bands_folder', '.')},
+        'outputs': ['output_folder'],
+        'results': 'files_parameters.csv_filename'
+    },
+    'trf': {
+        **STEPS['trf'][0],
+        'reads': [
+            'speech_folder', 'logs_folder', 'files_parameters', 'frequency_bands', 'filtering_parameters',
+            'iir_parameters', 'trf_parameters'
+        ],
+        'inputs': {'eeg_folder': ('epochs', 'preprocessed_folder', 'onset')},
+        'outputs': ['output_folder'],
+        'results': 'trf_parameters.csv_filename'
+    }
+}
+
+
+def get_value(config: dict, key: str):
+    """ Value of a dotted key, e.g., `filtering_parameters.compression`. """
+    value = config
+    for part in key.split('.'):
+        if not isinstance(value, dict) or part not in value:
+            raise KeyError(f'Configuration has no key `{key}`.')
+        value = value[part]
+    return value
+
+
+def set_value(config: dict, key: str, value) -> None:
+    """ Set the value of an existing dotted key. """
+    *parents, last = key.split('.')
+    section = get_value(config, '.'.join(parents)) if parents else config
+    if not isinstance(section, dict) or last not in section:
+        raise KeyError(f'Configuration has no key `{key}`.')
+    section[last] = value
+
+
+def overlaps(key: str, other: str) -> bool:
+    """ Whether one dotted key is the other or contains it. """
+    key, other = key.split('.'), other.split('.')
+    return key[:len(other)] == other or other[:len(key)] == key
+
+
+def resolve_paths(config: dict, folder: Path) -> dict:
+    """ Make the relative paths of folders and files that exist relative to the configuration's folder absolute, as
+    the steps of a sweep run in their node folders. """
+    for key, value in config.items():
+        if isinstance(value, dict):
+            resolve_paths(value, folder)
+        elif isinstance(value, str) and key.endswith(('_folder', '_filename')) and not Path(value).is_absolute():
+            if (folder / value).exists():
+                config[key] = str((folder / value).resolve())
+    return config
+
+
+def source_fingerprint(step: dict) -> str:
+    """ Hash of the code a step runs: its code (if not a script) and the modules of its folder and the repository,
+    see `checkpoint.code_fingerprint`. """
+    return hashlib.sha1((step.get('code', '') + code_fingerprint(REPO_FOLDER / step['folder'])).encode()).hexdigest()
+
+
+def expand_grid(grid: dict) -> list:
+    """ All combinations of the values of the grid, `{'<config file>:<dotted key>': value}` per grid point. """
+    keys = list(grid.keys())
+    return [dict(zip(keys, values)) for values in itertools.product(*grid.values())]
+
+
+def plan_sweep(steps: list, points: list, base_configs: dict, work_folder: Path) -> tuple[dict, list]:
+    """ Nodes of the dependency graph of the steps over the grid points, and the node of each step at each point.
+
+    Parameters
+    ----------
+    steps : list
+        Names of the steps in `SWEEP_STEPS` to run, the inputs of steps that are not run are read from the
+        configurations.
+    points : list
+        Parameter values of each grid point, see `expand_grid`.
+    base_configs : dict
+        Configuration of each configuration file name.
+    work_folder : Path
+        Folder of the nodes.
+
+    Returns
+    -------
+    nodes : dict
+        Node of each node ID (`<step>-<fingerprint>`) with the step, configuration, folder, outputs, node IDs it
+        depends on and the fingerprinted settings.
+    index : list
+        Node ID of each step at each grid point.
+
+    """
+    nodes, index, sources = {}, [], {}
+    for point in points:
+        configs = copy.deepcopy(base_configs)
+        for parameter, value in point.items():
+            config_name, key = parameter.split(':', 1)
+            set_value(configs[config_name], key, value)
+
+        point_nodes = {}
+        for step_name in steps:
+            step = SWEEP_STEPS[step_name]
+            config = copy.deepcopy(configs[step['config']])
+            if step_name not in sources:
+                sources[step_name] = source_fingerprint(step)
+            settings = {
+                'step': step_name,
+                'source': sources[step_name],
+                'reads': {key: get_value(config, key) for key in step['reads']},
+                'inputs': {}
+            }
+
+            depends = []
+            for key, (input_step, output_key, subfolder) in step['inputs'].items():
+                if input_step in point_nodes:
+                    input_node = nodes[point_nodes[input_step]]
+                    config[key] = str(input_node['outputs'][output_key] / subfolder)
+                    settings['inputs'][key] = input_node['id']
+                    depends.append(input_node['id'])
+                else:
+                    settings['inputs'][key] = config[key]
+
+            fingerprint = hashlib.sha1(json.dumps(settings, sort_keys=True, default=str).encode()).hexdigest()[:16]
+            node_id = f'{step_name}-{fingerprint}'
+            if node_id not in nodes:
+                folder = work_folder / step_name / fingerprint
+                outputs = {key: folder / 'output' / key for key in step['outputs']}
+                for key, output_folder in outputs.items():
+                    config[key] = str(output_folder)
+                nodes[node_id] = {
+                    'id': node_id,
+                    'step': step_name,
+                    'config': config,
+                    'folder': folder,
+                    'outputs': outputs,
+                    'depends': depends,
+                    'settings': settings
+                }
+            point_nodes[step_name] = node_id
+
+        index.append(point_nodes)
+
+    return nodes, index
+
+
+def run_node(node: dict) -> int:
+    """ Run the step of a node from its folder, with its configuration and the output written to `log.txt`. """
+    step = SWEEP_STEPS[node['step']]
+    config_folder = node['folder'] / 'config'
+    config_folder.mkdir(parents=True, exist_ok=True)
+    for output_folder in node['outputs'].values():
+        output_folder.mkdir(parents=True, exist_ok=True)
+
+    with open(config_folder / step['config'], 'w') as file:
+        yaml.safe_dump(node['config'], file, sort_keys=False)
+
+    with open(node['folder'] / 'log.txt', 'w') as log:
+        returncode = run_step(step, cwd=config_folder, stdout=log, stderr=subprocess.STDOUT)
+
+    if returncode == 0:
+        with open(node['folder'] / 'done.json', 'w') as file:
+            json.dump(node['settings'], file, indent=2, default=str)
+
+    return returncode
+
+
+def run_nodes(nodes: dict, n_jobs: int = 1) -> list:
+    """ Run the nodes that were not computed before, each once its inputs are ready, `n_jobs` at a time.
+
+    Returns the IDs of the nodes that failed or whose inputs failed.
+
+    """
+    done = {node_id for node_id, node in nodes.items() if (node['folder'] / 'done.json').exists()}
+    failed, running = [], {}
+    print(f'{len(nodes)} nodes, {len(done)} reused from earlier sweeps')
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        while True:
+            for node_id, node in nodes.items():
+                if node_id in done or node_id in failed or node_id in running.values():
+                    continue
+                if any(depend in failed for depend in node['depends']):
+                    failed.append(node_id)
+                elif all(depend in done for depend in node['depends']):
+                    print(f'Running {node_id}')
+                    running[executor.submit(run_node, node)] = node_id
+
+            if not running:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                node_id = running.pop(future)
+                if future.result() == 0:
+                    done.add(node_id)
+                else:
+                    print(f'{node_id} failed, see {nodes[node_id]["folder"] / "log.txt"}')
+                    failed.append(node_id)
+
+    return failed
+
+
+def collect_results(steps: list, points: list, nodes: dict, index: list) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """ Index of the grid points (parameter values and node of each step) and the results of the steps with
+    `results` at all grid points, indexed by the grid point and its parameter values. """
+    parameters = [
+        {key: json.dumps(value) if isinstance(value, (list, dict)) else value for key, value in point.items()}
+        for point in points
+    ]
+    index_df = pd.DataFrame([
+        {'point_id': point_id, **point_parameters, **point_nodes}
+        for point_id, (point_parameters, point_nodes) in enumerate(zip(parameters, index))
+    ])
+
+    results = []
+    for point_id, (point_parameters, point_nodes) in enumerate(zip(parameters, index)):
+        for step_name in steps:
+            step = SWEEP_STEPS[step_name]
+            if 'results' not in step:
+                continue
+            node = nodes[point_nodes[step_name]]
+            results_file = next(iter(node['outputs'].values())) / get_value(node['config'], step['results'])
+            if not results_file.exists():
+                continue
+            df = pd.read_csv(results_file)
+            for column, value in reversed(list({'point_id': point_id, 'step': step_name, **point_parameters}.items())):
+                df.insert(0, column, value)
+            results.append(df)
+
+    results_df = pd.concat(results, ignore_index=True) if results else pd.DataFrame()
+
+    return index_df, results_df
+
+
+def run_sweep(sweep_config_file: Path, config_folders: list | None = None) -> int:
+    """ Run the sweep of a sweep configuration, see `sweep_config.yaml`. Returns 1 if any node failed. """
+    with open(sweep_config_file, 'r') as file:
+        sweep_config = yaml.safe_load(file)
+    sweep_folder = Path(sweep_config_file).resolve().parent
+
+    # Folders of the configurations given on the command line are relative to the working directory, else to the
+    # sweep configuration's folder
+    if config_folders is None:
+        config_folders = [sweep_folder / folder for folder in sweep_config['configs']]
+    work_folder = sweep_folder / sweep_config['work_folder']
+    output_folder = sweep_folder / sweep_config['output_folder']
+    output_folder.mkdir(parents=True, exist_ok=True)
+
+    unknown = [step for step in sweep_config['steps'] if step not in SWEEP_STEPS]
+    if unknown:
+        raise ValueError(f'Unknown steps {unknown}, use {list(SWEEP_STEPS)}.')
+    steps = [step for step in SWEEP_STEPS if step in sweep_config['steps']]
+
+    # Configurations of the steps, with paths relative to their folders made absolute
+    base_configs = {}
+    for step_name in steps:
+        step = SWEEP_STEPS[step_name]
+        config_folder = find_config(step, config_folders)
+        with open(config_folder / step['config'], 'r') as file:
+            base_configs[step['config']] = resolve_paths(yaml.safe_load(file), config_folder)
+
+    # Parameters no step reads would only multiply the grid points
+    grid = sweep_config['grid']
+    for parameter in grid:
+        config_name, key = parameter.split(':', 1)
+        if not any(
+            SWEEP_STEPS[step]['config'] == config_name
+            and any(overlaps(key, read) for read in SWEEP_STEPS[step]['reads'] + list(SWEEP_STEPS[step]['inputs']))
+            for step in steps
+        ):
+            raise ValueError(f'Parameter `{parameter}` is not read by any of the steps {steps}.')
+
+    points = expand_grid(grid)
+    nodes, index = plan_sweep(steps, points, base_configs, work_folder)
+    print(f'{len(points)} grid points of {len(steps)} steps')
+
+    failed = run_nodes(nodes, n_jobs=sweep_config['n_jobs'])
+
+    index_df, results_df = collect_results(steps, points, nodes, index)
+    index_df.to_csv(output_folder / sweep_config['index_filename'], index=False)
+    results_df.to_csv(output_folder / sweep_config['results_filename'], index=False)
+
+    if failed:
+        print(f'Failed nodes: {", ".join(failed)}')
+        return 1
+
+    return 0
@@ -0,0 +1,150 @@
+""" Calculate the stimulus-brain coherence as a function of frequency.
+
+Instead of filtering the envelopes and the EEG in each frequency band, the broadband envelopes and EEG (low-pass
+filtered and resampled to the goal sampling frequency) are related in one batched multitaper FFT per participant, see
+`coherence.py`. With ragged storage, each stimulus is analyzed at its true length (up to the end of the epochs)
+instead of being padded or cut to `mean_length_s`. The coherence (or phase-locking value) spectrum of each participant,
+stimulus and channel is stored as `.npz` file together with its frequencies, participants, stimuli and channels.
+
+"""
+
+from pathlib import Path
+
+import brian2 as b2
+import brian2hears as b2h
+import mne
+import numpy as np
+import pandas as pd
+
+from coherence import coherence_spectrum, ragged_coherence_spectrum
+from instrumentation import stage
+from ragged import RaggedArray
+from tracking_utils import (
+    load_config,
+    extract_envelope,
+    extract_eeg_band,
+    get_stimulus_order
+)
+
+mne.set_log_level('WARNING')
+
+
+def main():
+    # Load configuration
+    config = load_config('tracking_config.yaml')
+
+    # Set up folders and parameters
+    eeg_folder = Path(config['eeg_folder'])
+    speech_folder = Path(config['speech_folder'])
+    logs_folder = Path(config['logs_folder'])
+    output_folder = Path(config['output_folder'])
+    output_folder.mkdir(parents=True, exist_ok=True)
+
+    epochs_extension = config['files_parameters']['epochs_extension']
+    logs_txt_extension = config['files_parameters']['logs_txt_extension']
+    no_participants = config['files_parameters']['no_participants']
+    participants_list = ['p' + str(i).zfill(2) for i in range(1, no_participants + 1)]
+    montage = mne.channels.make_standard_montage(config['files_parameters']['eeg_montage'])
+    channels_list = montage.ch_names
+
+    # Filtering
+    sfreq_wav = config['filtering_parameters']['sfreq_wav']
+    sfreq_eeg = config['filtering_parameters']['sfreq_eeg']
+    sfreq_goal = config['filtering_parameters']['sfreq_goal']
+    center_freqs = config['filtering_parameters']['gammatone_center_freqs']
+    center_freqs['low'] = center_freqs['low']*b2.Hz
+    center_freqs['high'] = center_freqs['high']*b2.Hz
+    center_freqs = b2h.erbspace(**center_freqs)
+    compression = config['filtering_parameters']['compression']
+    mean_length_s = config['filtering_parameters']['mean_length_s']
+    mean_length_samples = np.arange(0, mean_length_s, 1 / sfreq_goal).shape[0]
+    alias_dict = config['iir_parameters']['alias_dict']
+    storage = config['filtering_parameters']['storage']
+    if storage not in ('ragged', 'padded'):
+        raise ValueError(f'Unknown storage `{storage}`, use `ragged` or `padded`.')
+
+    # Spectrum
+    spectrum_parameters = config['spectrum_parameters']
+
+    # Broadband envelopes at the goal sampling rate
+    wav_files = sorted(list(Path(speech_folder).rglob('*.wav')), key=lambda x: x.stem)
+    envelopes = [
+        extract_envelope(
+            wav_file,
+            center_freqs=center_freqs,
+            compression=compression,
+            sfreq=sfreq_wav,
+            sfreq_goal=sfreq_goal,
+            alias_dict=alias_dict
+        )
+        for wav_file in wav_files
+    ]
+    if storage == 'padded':
+        # Padded/cut to the same length
+        padded_envelopes = np.zeros((len(wav_files), mean_length_samples))
+        for wav_idx, envelope in enumerate(envelopes):
+            envelope = envelope[:mean_length_samples]
+            padded_envelopes[wav_idx, :envelope.shape[0]] = envelope
+        envelopes = padded_envelopes
+
+    spectra = []
+    for participant_id in participants_list:
+        with stage('participant', participant=participant_id):
+            epochs = mne.read_epochs(eeg_folder / f'{participant_id}{epochs_extension}', preload=True)
+            log_df = pd.read_csv(logs_folder / f'{participant_id}{logs_txt_extension}', sep='\t')
+            order = get_stimulus_order(log_df, [wav_file.stem for wav_file in wav_files], epochs.events[:, 2])
+
+            # Broadband EEG, low-pass filtered like the envelopes before decimation
+            if storage == 'ragged':
+                tmax = min(max(envelope.shape[0] for envelope in envelopes) / sfreq_goal, epochs.tmax)
+            else:
+                tmax = mean_length_s
+            eeg = extract_eeg_band(
+                epochs,
+                sfreq=sfreq_eeg,
+                sfreq_goal=sfreq_goal,
+                freq_min=None,
+                freq_max=sfreq_goal / 3.0,
+                iir_params=alias_dict,
+                tmax=tmax
+            )[order]
+
+            if storage == 'ragged':
+                # Each stimulus at its true length, up to the end of the epochs, see ragged.py
+                lengths = np.minimum([envelope.shape[0] for envelope in envelopes], eeg.shape[-1])
+                spectrum, freqs = ragged_coherence_spectrum(
+                    RaggedArray.from_list([envelope[:length] for envelope, length in zip(envelopes, lengths)]),
+                    RaggedArray.from_list([eeg[idx, :, :length] for idx, length in enumerate(lengths)]),
+                    sfreq=sfreq_goal,
+                    bandwidth=spectrum_parameters['bandwidth'],
+                    fmin=spectrum_parameters['fmin'],
+                    fmax=spectrum_parameters['fmax'],
+                    method=spectrum_parameters['method']
+                )
+            else:
+                spectrum, freqs = coherence_spectrum(
+                    envelopes,
+                    eeg[..., :mean_length_samples],
+                    sfreq=sfreq_goal,
+                    bandwidth=spectrum_parameters['bandwidth'],
+                    fmin=spectrum_parameters['fmin'],
+                    fmax=spectrum_parameters['fmax'],
+                    method=spectrum_parameters['method']
+                )
+            spectra.append(spectrum.astype(np.float32))
+
+    # Save the spectra (participants x stimuli x channels x freqs) with their coordinates
+    np.savez(
+        output_folder / spectrum_parameters['spectrum_filename'],
+        spectrum=np.stack(spectra),
+        freqs=freqs,
+        participants=np.array(participants_list),
+        stimuli=np.array([wav_file.stem for wav_file in wav_files]),
+        channels=np.array(channels_list),
+        method=np.array(spectrum_parameters['method'])
+    )
+
+
+if __name__ == '__main__':
+    print(f'Running {__file__}')
+    main()
@@ -3,13 +3,124 @@ import numpy as np
 import pandas as pd
 from pathlib import Path
 from tracking_utils import load_config
-from mne_connectivity import spectral_connectivity_time
+from phase_kernels import phase_locking_value, segment_phase_locking_value
+from ragged import RaggedArray
+from scheduler import MemoryScheduler
 from warnings import simplefilter
 
 # Suppress future warnings
 simplefilter(action='ignore', category=FutureWarning)
 
 
+def connectivity_plv(
+    data: np.ndarray,
+    freqs: np.ndarray,
+    fmin: float,
+    fmax: float,
+    sfreq: float,
+    n_cycles: int
+) -> np.ndarray:
+    """ PLV between the envelope (first signal) and each EEG channel (other signals) per stimulus with mne_connectivity.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Envelope and EEG phases of stimuli of equal length (stimuli x 1 + channels x times).
+    freqs : np.ndarray
+        Frequencies of the wavelets.
+    fmin : float
+        Lower frequency of the band the PLV is averaged over.
+    fmax : float
+        Upper frequency of the band the PLV is averaged over.
+    sfreq : float
+        Sampling frequency of the phases.
+    n_cycles : int
+        Number of cycles of the wavelets.
+
+    Returns
+    -------
+    plv : np.ndarray
+        Phase-locking values (stimuli x channels).
+
+    """
+    from mne_connectivity import spectral_connectivity_time
+
+    n_channels = data.shape[1] - 1
+    indices = (np.zeros(n_channels, dtype=int), np.arange(1, n_channels + 1))
+
+    tracking = spectral_connectivity_time(
+        data,
+        freqs=freqs,
+        method='plv',
+        average=False,
+        indices=indices,
+        fmin=fmin,
+        fmax=fmax,
+        sfreq=sfreq,
+        faverage=True,
+        verbose=False,
+        n_cycles=n_cycles,
+    )
+
+    return tracking.get_data().reshape(data.shape[0], n_channels)
+
+
+def participant_plv(
+    participant_id: str,
+    band: str,
+    bands_folder: Path,
+    envelopes_extension: str,
+    offsets_filename: str,
+    storage: str,
+    plv_method: str,
+    frequency_band: list,
+    sfreq: float
+) -> np.ndarray:
+    """ PLV between the envelope and each EEG channel per stimulus (stimuli x channels) of a participant in a band. """
+    n_cycles = 2 if band == 'phrase_rate' else 7
+    frequency_bins = np.linspace(frequency_band[0], frequency_band[1], 10)
+
+    if storage == 'ragged':
+        # Each stimulus at its true length, see ragged.py
+        phase_envelopes = RaggedArray.load(
+            bands_folder / f'{band}{envelopes_extension}',
+            bands_folder / offsets_filename,
+            mmap_mode=None
+        )
+        phase_eeg = RaggedArray.load(bands_folder / f'{participant_id}_{band}.npy', bands_folder / offsets_filename)
+
+        if plv_method == 'phase':
+            return segment_phase_locking_value(phase_envelopes.values, phase_eeg.values, phase_envelopes.offsets)
+
+        # mne_connectivity needs epochs of equal length: one call per stimulus length
+        plv = np.empty((len(phase_envelopes), phase_eeg.values.shape[0]))
+        for stimulus_indices in phase_envelopes.groups():
+            data = np.concatenate(
+                [phase_envelopes.stack(stimulus_indices)[:, None, :], phase_eeg.stack(stimulus_indices)],
+                axis=1
+            )
+            plv[stimulus_indices] = connectivity_plv(
+                data,
+                frequency_bins,
+                *frequency_band,
+                sfreq=sfreq,
+                n_cycles=n_cycles
+            )
+        return plv
+
+    phase_envelopes = np.load(bands_folder / f'{band}{envelopes_extension}')
+    phase_eeg = np.load(bands_folder / f'{participant_id}_{band}.npy', mmap_mode='r')
+    data = np.empty((phase_envelopes.shape[0], phase_eeg.shape[1] + 1, phase_envelopes.shape[1]))
+    data[:, 0, :] = phase_envelopes
+    data[:, 1:, :] = phase_eeg
+
+    if plv_method == 'phase':
+        # PLV over time directly from the band phases, see phase_kernels.py
+        return phase_locking_value(data[:, 0, :], data[:, 1:, :])
+
+    return connectivity_plv(data, frequency_bins, *frequency_band, sfreq=sfreq, n_cycles=n_cycles)
+
+
 def main():
     # Load configuration
     config = load_config('tracking_config.yaml')
@@ -23,6 +134,12 @@ def main():
     frequency_bands = list(frequency_bands_dict.keys())
 
     sfreq = config['filtering_parameters']['sfreq_goal']
+    plv_method = config['plv_parameters']['method']
+    if plv_method not in ('connectivity', 'phase'):
+        raise ValueError(f'Unknown PLV method `{plv_method}`, use `connectivity` or `phase`.')
+    envelopes_extension = config['files_parameters']['envelopes_extension']
+    offsets_filename = config['files_parameters']['offsets_filename']
+    storage = config['filtering_parameters']['storage']
     csv_filename = config['files_parameters']['csv_filename']
     csv_col_names = config['files_parameters']['csv_col_names']
     array_filename = config['files_parameters']['array_filename']
@@ -44,37 +161,49 @@ def main():
         (no_participants, len(frequency_bands), len(stimuli_list), len(channels_list)), np.nan
     )
 
-    # Compute phase-locking values (PLV) for each frequency band
-    for b_idx, band in enumerate(frequency_bands):
-        files = sorted(list(bands_folder.glob(f'*{band}.npy')))
-        files = [file for file in files if not file.name.startswith('.')]
-
-        for f_idx, file in enumerate(files):
-            data = np.load(file)
-            n_channels = len(channels_list)
-            n_cycles = 2 if band == 'phrase_rate' else 7
-
-            envelope_idx = np.zeros(n_channels).astype(int)
-            eeg_channel_indices = np.arange(1, n_channels + 1)
-            indices = (envelope_idx, eeg_channel_indices)
-
-            frequency_bins = np.linspace(frequency_bands_dict[band][0], frequency_bands_dict[band][1], 10)
+    n_channels = len(channels_list)
 
-            tracking = spectral_connectivity_time(
-                data,
-                freqs=frequency_bins,
-                method='plv',
-                average=False,
-                indices=indices,
-                fmin=frequency_bands_dict[band][0],
-                fmax=frequency_bands_dict[band][1],
-                sfreq=sfreq,
-                faverage=True,
-                verbose=False,
-                n_cycles=n_cycles,
+    # Participants x bands run in parallel within the memory budget, see scheduler.py. The size of a job is that of the
+    # band arrays it loads
+    scheduler_parameters = config['scheduler']
+    scheduler = MemoryScheduler(
+        budget_mb=scheduler_parameters['memory_budget_mb'],
+        n_jobs=scheduler_parameters['n_jobs'],
+        history_file=scheduler_parameters['history_file'],
+        margin=scheduler_parameters['margin']
+    )
+    jobs = [
+        {
+            'name': f'{participant_id} {band}',
+            'kind': f'plv_{plv_method}',
+            'size_mb': (
+                (bands_folder / f'{participant_id}_{band}.npy').stat().st_size
+                + (bands_folder / f'{band}{envelopes_extension}').stat().st_size
+            ) / 2**20,
+            'ratio': 3.0,
+            'function': participant_plv,
+            'tags': {'participant': participant_id, 'band': band},
+            'args': (
+                participant_id,
+                band,
+                bands_folder,
+                envelopes_extension,
+                offsets_filename,
+                storage,
+                plv_method,
+                frequency_bands_dict[band],
+                sfreq
             )
+        }
+        for band in frequency_bands
+        for participant_id in participants_list
+    ]
 
-            tracking_array[f_idx, b_idx, :, :] = tracking.get_data().squeeze()
+    # Compute phase-locking values (PLV) for each frequency band
+    plvs = iter(scheduler.run(jobs))
+    for b_idx, band in enumerate(frequency_bands):
+        for p_idx, participant_id in enumerate(participants_list):
+            tracking_array[p_idx, b_idx, :, :] = next(plvs)
 
     # Reshape and save the tracking results
     index = pd.MultiIndex.from_product(
@@ -0,0 +1,196 @@
+""" Fit temporal response functions (TRFs) mapping the speech envelope onto the EEG in each frequency band.
+
+For each participant and frequency band, the band-pass filtered envelopes and EEG epochs (the same as used for the
+phase-locking values) are related by a ridge-regularized forward model, see `trf.py`. The regularization parameter is
+chosen by leave-one-stimulus-out cross-validation; the cross-validated prediction accuracy (Pearson correlation) of
+each channel is stored as CSV, and the TRF weights (participants x bands x lags x channels) as array.
+
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from pathlib import Path
+
+import brian2 as b2
+import brian2hears as b2h
+import mne
+import numpy as np
+import pandas as pd
+
+from instrumentation import stage
+from tracking_utils import (
+    load_config,
+    extract_envelope,
+    extract_envelope_band,
+    extract_eeg_band,
+    get_stimulus_order
+)
+from trf import fit_trf, get_lags
+
+mne.set_log_level('WARNING')
+
+
+def fit_participant(
+    participant_id: str,
+    band_envelopes: dict,
+    settings: dict
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """ Fit the TRFs of one participant in all frequency bands.
+
+    Parameters
+    ----------
+    participant_id : str
+        Participant identifier, e.g., `p01`.
+    band_envelopes : dict
+        Band-pass filtered envelopes in stimuli order (stimuli x times), keyed by frequency band.
+    settings : dict
+        Folders, file extensions, filtering and TRF parameters.
+
+    Returns
+    -------
+    weights : np.ndarray
+        TRF weights (bands x lags x channels).
+    alphas : np.ndarray
+        Chosen regularization parameter per band.
+    scores : np.ndarray
+        Cross-validated prediction accuracies (bands x channels).
+
+    """
+    epochs = mne.read_epochs(settings['eeg_folder'] / f'{participant_id}{settings["epochs_extension"]}', preload=True)
+    log_df = pd.read_csv(settings['logs_folder'] / f'{participant_id}{settings["logs_txt_extension"]}', sep='\t')
+    order = get_stimulus_order(log_df, settings['stimuli'], epochs.events[:, 2])
+
+    weights, alphas, scores = [], [], []
+    for band, (freq_min, freq_max) in settings['frequency_bands'].items():
+        with stage('band', participant=participant_id, band=band):
+            eeg = extract_eeg_band(
+                epochs.copy(),
+                sfreq=settings['sfreq_eeg'],
+                sfreq_goal=settings['sfreq_goal'],
+                freq_min=freq_min,
+                freq_max=freq_max,
+                iir_params=settings['alias_dict'],
+                tmax=settings['mean_length_s']
+            )
+            band_weights, alpha, band_scores = fit_trf(
+                list(band_envelopes[band]),
+                eeg[order],
+                lags=settings['lags'],
+                alphas=settings['alphas']
+            )
+
+        weights.append(band_weights)
+        alphas.append(alpha)
+        scores.append(band_scores)
+
+    return np.stack(weights), np.array(alphas), np.stack(scores)
+
+
+def main():
+    # Load configuration
+    config = load_config('tracking_config.yaml')
+
+    # Set up folders and parameters
+    eeg_folder = Path(config['eeg_folder'])
+    speech_folder = Path(config['speech_folder'])
+    logs_folder = Path(config['logs_folder'])
+    output_folder = Path(config['output_folder'])
+    output_folder.mkdir(parents=True, exist_ok=True)
+
+    no_participants = config['files_parameters']['no_participants']
+    participants_list = ['p' + str(i).zfill(2) for i in range(1, no_participants + 1)]
+    montage = mne.channels.make_standard_montage(config['files_parameters']['eeg_montage'])
+    channels_list = montage.ch_names
+
+    frequency_bands_dict = config['frequency_bands']
+    frequency_bands = list(frequency_bands_dict.keys())
+
+    # Filtering
+    sfreq_wav = config['filtering_parameters']['sfreq_wav']
+    sfreq_eeg = config['filtering_parameters']['sfreq_eeg']
+    sfreq_goal = config['filtering_parameters']['sfreq_goal']
+    center_freqs = config['filtering_parameters']['gammatone_center_freqs']
+    center_freqs['low'] = center_freqs['low']*b2.Hz
+    center_freqs['high'] = center_freqs['high']*b2.Hz
+    center_freqs = b2h.erbspace(**center_freqs)
+    compression = config['filtering_parameters']['compression']
+    mean_length_s = config['filtering_parameters']['mean_length_s']
+    mean_length_samples = np.arange(0, mean_length_s, 1 / sfreq_goal).shape[0]
+    alias_dict = config['iir_parameters']['alias_dict']
+
+    # TRF
+    trf_parameters = config['trf_parameters']
+    lags = get_lags(trf_parameters['tmin'], trf_parameters['tmax'], sfreq_goal)
+    alphas = np.array(trf_parameters['alphas'], dtype=float)
+    n_jobs = trf_parameters['n_jobs']
+    csv_col_names = trf_parameters['csv_col_names']
+
+    # Envelopes at the preprocessed EEG sampling rate, then band-pass filtered and resampled once per band
+    wav_files = sorted(list(Path(speech_folder).rglob('*.wav')), key=lambda x: x.stem)
+    envelopes = [
+        extract_envelope(
+            wav_file,
+            center_freqs=center_freqs,
+            compression=compression,
+            sfreq=sfreq_wav,
+            sfreq_goal=sfreq_eeg,
+            alias_dict=alias_dict
+        )
+        for wav_file in wav_files
+    ]
+
+    band_envelopes = {}
+    for band in frequency_bands:
+        band_envelopes[band] = np.zeros((len(wav_files), mean_length_samples))
+        for wav_idx, envelope in enumerate(envelopes):
+            band_envelope = extract_envelope_band(
+                envelope,
+                sfreq=sfreq_eeg,
+                sfreq_goal=sfreq_goal,
+                freq_min=frequency_bands_dict[band][0],
+                freq_max=frequency_bands_dict[band][1],
+                iir_params=alias_dict
+            )[:mean_length_samples]
+            band_envelopes[band][wav_idx, :band_envelope.shape[0]] = band_envelope
+
+    settings = {
+        'eeg_folder': eeg_folder,
+        'logs_folder': logs_folder,
+        'epochs_extension': config['files_parameters']['epochs_extension'],
+        'logs_txt_extension': config['files_parameters']['logs_txt_extension'],
+        'stimuli': [wav_file.stem for wav_file in wav_files],
+        'frequency_bands': frequency_bands_dict,
+        'sfreq_eeg': sfreq_eeg,
+        'sfreq_goal': sfreq_goal,
+        'mean_length_s': mean_length_s,
+        'alias_dict': alias_dict,
+        'lags': lags,
+        'alphas': alphas
+    }
+
+    # Participants are independent and fitted in parallel
+    if n_jobs > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            results = list(executor.map(fit_participant, participants_list, repeat(band_envelopes), repeat(settings)))
+    else:
+        results = [fit_participant(participant_id, band_envelopes, settings) for participant_id in participants_list]
+
+    weights = np.stack([result[0] for result in results])
+    chosen_alphas = np.stack([result[1] for result in results])
+    scores = np.stack([result[2] for result in results])
+
+    # Save the cross-validated scores in long format and the TRF weights
+    index = pd.MultiIndex.from_product([participants_list, frequency_bands], names=csv_col_names[:2])
+    df = pd.DataFrame(scores.reshape(-1, len(channels_list)), index=index, columns=channels_list)
+    df[csv_col_names[3]] = chosen_alphas.reshape(-1)
+    df = df.set_index(csv_col_names[3], append=True)
+    df_long = df.stack().reset_index()
+    df_long.columns = [csv_col_names[0], csv_col_names[1], csv_col_names[3], csv_col_names[2], csv_col_names[4]]
+    df_long[csv_col_names].to_csv(output_folder / trf_parameters['csv_filename'], index=False)
+
+    np.save(output_folder / trf_parameters['weights_filename'], weights)
+
+
+if __name__ == '__main__':
+    print(f'Running {__file__}')
+    main()
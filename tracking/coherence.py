@@ -0,0 +1,189 @@
+""" Multitaper coherence and phase-locking spectra between the speech envelope and the EEG.
+
+The spectra of the envelope and all EEG channels of all stimuli are computed at once: the signals are multiplied by
+the Slepian (DPSS) tapers and Fourier-transformed in one batched FFT. Cross- and auto-spectra are averaged over the
+tapers, which yields tracking as a function of frequency for each stimulus and channel. Stimuli of different lengths
+(ragged arrays, see `ragged.py`) are transformed in batches of equal length onto the frequencies of the longest one.
+
+"""
+
+import numpy as np
+from scipy.fft import rfft, rfftfreq
+from scipy.signal.windows import dpss
+
+from ragged import RaggedArray
+
+
+def multitaper_spectra(
+    data: np.ndarray,
+    sfreq: float,
+    bandwidth: float,
+    fmin: float,
+    fmax: float,
+    n_fft: int | None = None
+) -> tuple[np.ndarray, np.ndarray]:
+    """ Tapered Fourier transforms of the signals between `fmin` and `fmax`.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Signals (... x times).
+    sfreq : float
+        Sampling frequency of the signals.
+    bandwidth : float
+        Full bandwidth of the tapers in Hz. `bandwidth * duration - 1` tapers are used (at least one).
+    fmin : float
+        Lowest frequency.
+    fmax : float
+        Highest frequency.
+    n_fft : int | None
+        Length of the FFT, at least the number of samples. The tapered signals are zero-padded, which only interpolates
+        the spectra, so that signals of different lengths share the frequencies. If None, the number of samples.
+
+    Returns
+    -------
+    spectra : np.ndarray
+        Tapered Fourier transforms (... x tapers x freqs).
+    freqs : np.ndarray
+        Frequencies of the spectra.
+
+    """
+    n_times = data.shape[-1]
+    half_bandwidth = bandwidth * n_times / sfreq / 2
+    n_tapers = max(int(2 * half_bandwidth) - 1, 1)
+    tapers = dpss(n_times, half_bandwidth, n_tapers)
+
+    if n_fft is None:
+        n_fft = n_times
+    elif n_fft < n_times:
+        raise ValueError(f'FFT length {n_fft} is shorter than the {n_times} samples.')
+
+    freqs = rfftfreq(n_fft, 1 / sfreq)
+    in_range = (freqs >= fmin) & (freqs <= fmax)
+
+    spectra = rfft(data[..., None, :] * tapers, n=n_fft, axis=-1)[..., in_range]
+
+    return spectra, freqs[in_range]
+
+
+def coherence_spectrum(
+    envelopes: np.ndarray,
+    eeg: np.ndarray,
+    sfreq: float,
+    bandwidth: float,
+    fmin: float,
+    fmax: float,
+    method: str = 'coherence',
+    n_fft: int | None = None
+) -> tuple[np.ndarray, np.ndarray]:
+    """ Coherence or phase-locking value between the envelope and each EEG channel as a function of frequency.
+
+    Parameters
+    ----------
+    envelopes : np.ndarray
+        Envelopes in stimuli order (stimuli x times).
+    eeg : np.ndarray
+        EEG responses in stimuli order (stimuli x channels x times).
+    sfreq : float
+        Sampling frequency of the envelopes and the EEG.
+    bandwidth : float
+        Full bandwidth of the tapers in Hz, see `multitaper_spectra`.
+    fmin : float
+        Lowest frequency.
+    fmax : float
+        Highest frequency.
+    method : str
+        `coherence`: magnitude of the coherency, i.e., the taper-averaged cross-spectrum normalized by the auto-spectra.
+        `plv`: magnitude of the taper-averaged phase difference, i.e., the cross-spectra normalized to unit length.
+    n_fft : int | None
+        Length of the FFT, see `multitaper_spectra`.
+
+    Returns
+    -------
+    spectrum : np.ndarray
+        Coherence or phase-locking values (stimuli x channels x freqs).
+    freqs : np.ndarray
+        Frequencies of the spectrum.
+
+    """
+    if method not in ('coherence', 'plv'):
+        raise ValueError(f'Unknown method {method}, use `coherence` or `plv`.')
+    if envelopes.shape[0] != eeg.shape[0] or envelopes.shape[-1] != eeg.shape[-1]:
+        raise ValueError(f'Envelopes of shape {envelopes.shape} do not match EEG responses of shape {eeg.shape}.')
+
+    envelope_spectra, freqs = multitaper_spectra(envelopes[:, None, :], sfreq, bandwidth, fmin, fmax, n_fft)
+    eeg_spectra, _ = multitaper_spectra(eeg, sfreq, bandwidth, fmin, fmax, n_fft)
+
+    cross_spectra = eeg_spectra * np.conj(envelope_spectra)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if method == 'coherence':
+            spectrum = np.abs(cross_spectra.mean(axis=-2)) / np.sqrt(
+                (np.abs(envelope_spectra)**2).mean(axis=-2) * (np.abs(eeg_spectra)**2).mean(axis=-2)
+            )
+        else:
+            spectrum = np.abs((cross_spectra / np.abs(cross_spectra)).mean(axis=-2))
+
+    return spectrum, freqs
+
+
+def ragged_coherence_spectrum(
+    envelopes: RaggedArray,
+    eeg: RaggedArray,
+    sfreq: float,
+    bandwidth: float,
+    fmin: float,
+    fmax: float,
+    method: str = 'coherence'
+) -> tuple[np.ndarray, np.ndarray]:
+    """ Coherence or phase-locking value spectrum of stimuli of different lengths, each at its true length.
+
+    Stimuli of equal length are batched, and the FFTs of all batches are zero-padded to the longest stimulus so that
+    the spectra share the frequencies, see `coherence_spectrum`.
+
+    Parameters
+    ----------
+    envelopes : RaggedArray
+        Envelopes in stimuli order (total samples).
+    eeg : RaggedArray
+        EEG responses in stimuli order (channels x total samples), with the same offsets as the envelopes.
+    sfreq : float
+        Sampling frequency of the envelopes and the EEG.
+    bandwidth : float
+        Full bandwidth of the tapers in Hz, see `multitaper_spectra`.
+    fmin : float
+        Lowest frequency.
+    fmax : float
+        Highest frequency.
+    method : str
+        `coherence` or `plv`, see `coherence_spectrum`.
+
+    Returns
+    -------
+    spectrum : np.ndarray
+        Coherence or phase-locking values (stimuli x channels x freqs).
+    freqs : np.ndarray
+        Frequencies of the spectrum.
+
+    """
+    if not np.array_equal(envelopes.offsets, eeg.offsets):
+        raise ValueError('Envelopes and EEG responses need the same stimulus lengths.')
+
+    n_fft = int(envelopes.lengths.max())
+    spectrum = None
+    for indices in envelopes.groups():
+        group_spectrum, freqs = coherence_spectrum(
+            envelopes.stack(indices),
+            eeg.stack(indices),
+            sfreq,
+            bandwidth,
+            fmin,
+            fmax,
+            method=method,
+            n_fft=n_fft
+        )
+        if spectrum is None:
+            spectrum = np.empty((len(envelopes),) + group_spectrum.shape[1:])
+        spectrum[indices] = group_spectrum
+
+    return spectrum, freqs
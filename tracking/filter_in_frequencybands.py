@@ -1,5 +1,6 @@
 import numpy as np
 import pandas as pd
+from contextlib import ExitStack
 from pathlib import Path
 import brian2 as b2
 import brian2hears as b2h
@@ -10,12 +11,132 @@ from tracking_utils import (
     extract_envelope,
     extract_envelope_phase,
     extract_eeg_phase,
-    reorder_eeg_data
+    get_stimulus_order
 )
+from phase_bank import MorletPhaseBank
+from ragged import RaggedArray
+from scheduler import MemoryScheduler
+from checkpoint import RunManifest, atomic_output, code_fingerprint, fingerprint, file_fingerprint
 
 mne.set_log_level('WARNING')
 
 
+def filter_participant_morlet(
+    participant_id: str,
+    eeg_file: Path,
+    order: np.ndarray,
+    bands_folder: Path,
+    frequency_bands_dict: dict,
+    lengths: np.ndarray,
+    decim: int,
+    sfreq_eeg: float,
+    sfreq_goal: float,
+    wavelet_parameters: dict,
+    storage: str,
+    mean_length_samples: int
+) -> None:
+    """ Write the EEG phases of all bands of a participant from one wavelet transform per epoch, see phase_bank.py. """
+    epochs = mne.read_epochs(eeg_file, preload=True)
+    n_stimuli = len(order)
+
+    # Drop the samples before the first one kept at the goal sampling frequency, so time zero is kept as with
+    # `epochs.decimate`
+    zero_idx = int(epochs.time_as_index(0)[0])
+    first_idx = zero_idx % decim
+    eeg = epochs.get_data(picks='eeg')[..., first_idx:]
+    zero_idx = (zero_idx - first_idx) // decim
+    if zero_idx + lengths.max() > -(-eeg.shape[-1] // decim):
+        raise ValueError(
+            f'{participant_id}: epochs are shorter than {lengths.max() / sfreq_goal} s after time zero.'
+        )
+
+    eeg_bank = MorletPhaseBank(sfreq_eeg, sfreq_goal, n_times=eeg.shape[-1], **wavelet_parameters)
+
+    # The band arrays are written to temporary files and moved in place once all are complete, see checkpoint.py
+    with ExitStack() as outputs:
+        band_files = {
+            band: outputs.enter_context(atomic_output(bands_folder / f'{participant_id}_{band}.npy'))
+            for band in frequency_bands_dict
+        }
+        if storage == 'ragged':
+            band_arrays = {
+                band: RaggedArray.empty(lengths, shape=(eeg.shape[1],), out_file=band_files[band])
+                for band in frequency_bands_dict
+            }
+        else:
+            band_arrays = {
+                band: np.lib.format.open_memmap(
+                    band_files[band],
+                    mode='w+',
+                    dtype=np.float64,
+                    shape=(n_stimuli, eeg.shape[1], mean_length_samples)
+                )
+                for band in frequency_bands_dict
+            }
+
+        # One epoch at a time in stimuli order, the phases of all bands from one transform
+        for dst_idx, src_idx in enumerate(order):
+            for band, phase_eeg in eeg_bank.phases(eeg[src_idx], frequency_bands_dict).items():
+                band_arrays[band][dst_idx] = phase_eeg[:, zero_idx:zero_idx + lengths[dst_idx]]
+
+        for band_array in band_arrays.values():
+            if storage == 'ragged':
+                band_array = band_array.values
+            band_array.flush()
+
+
+def filter_participant_iir(
+    participant_id: str,
+    band: str,
+    eeg_file: Path,
+    order: np.ndarray,
+    band_file: Path,
+    frequency_band: list,
+    lengths: np.ndarray | None,
+    sfreq_eeg: float,
+    sfreq_goal: float,
+    alias_dict: dict,
+    mean_length_samples: int,
+    mean_length_s: float
+) -> None:
+    """ Write the EEG phases of a participant in a band, at the stimuli lengths if given (ragged storage), else padded
+    or cut to the mean length. The stimuli `order` of the participant's epochs is shared by its bands. """
+    epochs = mne.read_epochs(eeg_file, preload=True)
+    n_stimuli = len(order)
+
+    # 1. Preallocate the band array on disk, in a temporary file moved in place once complete (see checkpoint.py)
+    n_channels = len(mne.pick_types(epochs.info, eeg=True, exclude=[]))
+    with atomic_output(band_file) as partial_file:
+        if lengths is not None:
+            band_array = RaggedArray.empty(lengths, shape=(n_channels,), out_file=partial_file)
+            tmax = lengths.max() / sfreq_goal
+        else:
+            band_array = np.lib.format.open_memmap(
+                partial_file,
+                mode='w+',
+                dtype=np.float64,
+                shape=(n_stimuli, n_channels, mean_length_samples)
+            )
+            tmax = mean_length_s
+
+        # 2. Write band-pass filtered EEG phase at 128 Hz (goal sampling rate) into the band array in stimuli order
+        extract_eeg_phase(
+            epochs,
+            sfreq=sfreq_eeg,
+            sfreq_goal=sfreq_goal,
+            freq_min=frequency_band[0],
+            freq_max=frequency_band[1],
+            iir_params=alias_dict,
+            tmax=tmax,
+            order=order,
+            out=band_array
+        )
+
+        if lengths is not None:
+            band_array = band_array.values
+        band_array.flush()
+
+
 if __name__ == '__main__':
     print(f'Running {__file__}')
 
@@ -29,6 +150,8 @@ if __name__ == '__main__':
 
     logs_txt_extension = config['files_parameters']['logs_txt_extension']
     epochs_extension = config['files_parameters']['epochs_extension']
+    envelopes_extension = config['files_parameters']['envelopes_extension']
+    offsets_filename = config['files_parameters']['offsets_filename']
     no_participants = config['files_parameters']['no_participants']
     participants = ['p' + str(i).zfill(2) for i in range(1, no_participants + 1)]
 
@@ -50,69 +173,230 @@ if __name__ == '__main__':
     mean_length_samples = time.shape[0]
 
     alias_dict = config['iir_parameters']['alias_dict']
+    phase_engine = config['filtering_parameters']['phase_engine']
+    wavelet_parameters = config['wavelet_parameters']
+    if phase_engine not in ('iir', 'morlet'):
+        raise ValueError(f'Unknown phase engine `{phase_engine}`, use `iir` or `morlet`.')
+    storage = config['filtering_parameters']['storage']
+    if storage not in ('ragged', 'padded'):
+        raise ValueError(f'Unknown storage `{storage}`, use `ragged` or `padded`.')
 
     wav_files = sorted(list(Path(speech_folder).rglob('*.wav')), key=lambda x: x.stem)
+    stimuli = [wav_file.stem for wav_file in wav_files]
 
-    for band in frequency_bands:
-        print(f'Processing `{band}` band')
-        # First, create array of phase envelopes containing all stimuli
-        phase_envelopes = np.full((len(wav_files), mean_length_samples), np.nan)
-
-        for wav_idx, wav_file in enumerate(wav_files):
-            # 1. Get envelopes at 512 Hz (preprocessed EEG sampling rate)
-            envelope = extract_envelope(
-                wav_file,
-                center_freqs=center_freqs,
-                compression=compression,
-                sfreq=sfreq_wav,
-                sfreq_goal=sfreq_eeg,
-                alias_dict=alias_dict
-            )
+    # Participants (x bands) run in parallel within the memory budget, see scheduler.py. The size of a job is that of
+    # its epochs in memory (float32 on disk, float64 in memory) and of the band arrays it writes
+    scheduler_parameters = config['scheduler']
+    scheduler = MemoryScheduler(
+        budget_mb=scheduler_parameters['memory_budget_mb'],
+        n_jobs=scheduler_parameters['n_jobs'],
+        history_file=scheduler_parameters['history_file'],
+        margin=scheduler_parameters['margin']
+    )
+    n_channels = len(mne.channels.make_standard_montage(config['files_parameters']['eeg_montage']).ch_names)
+    band_mb = len(wav_files) * n_channels * mean_length_samples * 8 / 2**20
+    epochs_mb = {
+        participant_id: 2 * (eeg_folder / f'{participant_id}{epochs_extension}').stat().st_size / 2**20
+        for participant_id in participants
+    }
 
-            # 2. Get band-pass filtered envelope phase at 128 Hz (goal sampling rate)
-            phase_envelope = extract_envelope_phase(
-                envelope,
-                sfreq=sfreq_eeg,
-                sfreq_goal=sfreq_goal,
-                freq_min=frequency_bands_dict[band][0],
-                freq_max=frequency_bands_dict[band][1],
-                iir_params=alias_dict
+    # The stimuli order of a participant's epochs is computed once (from the log and the epochs' events in the file
+    # header) and shared by all of its band jobs
+    orders = {}
+    for participant_id in participants:
+        epochs_header = mne.read_epochs(eeg_folder / f'{participant_id}{epochs_extension}', preload=False)
+        log_df = pd.read_csv(logs_folder / f'{participant_id}{logs_txt_extension}', sep='\t')
+        orders[participant_id] = get_stimulus_order(log_df, stimuli, epochs_header.events[:, 2])
+
+    # Completed (participant, band) units are recorded with the code, parameters and epochs they depend on and, with
+    # `checkpoint.resume`, skipped, see checkpoint.py. The envelope phases are cheap and always recomputed
+    manifest = RunManifest(
+        bands_folder / config['checkpoint']['manifest_filename'],
+        resume=config['checkpoint']['resume']
+    )
+    source = code_fingerprint(Path(__file__).parent)
+    input_fingerprints = {
+        participant_id: [
+            file_fingerprint(eeg_folder / f'{participant_id}{epochs_extension}'),
+            file_fingerprint(logs_folder / f'{participant_id}{logs_txt_extension}')
+        ]
+        for participant_id in participants
+    }
+
+    # Ragged storage keeps each stimulus at its true length, up to the end of the epochs (read from the first
+    # participant's file header)
+    if storage == 'ragged':
+        epochs_tmax = mne.read_epochs(eeg_folder / f'{participants[0]}{epochs_extension}', preload=False).tmax
+        max_length_samples = int(epochs_tmax * sfreq_goal)
+
+    # Envelopes at 512 Hz (preprocessed EEG sampling rate) only depend on the stimulus, compute them once for all bands
+    envelopes = [
+        extract_envelope(
+            wav_file,
+            center_freqs=center_freqs,
+            compression=compression,
+            sfreq=sfreq_wav,
+            sfreq_goal=sfreq_eeg,
+            alias_dict=alias_dict
+        )
+        for wav_file in wav_files
+    ]
+
+    if phase_engine == 'morlet':
+        # All bands from one wavelet transform per signal, see phase_bank.py
+        bank = MorletPhaseBank(
+            sfreq_eeg,
+            sfreq_goal,
+            n_times=max(envelope.shape[0] for envelope in envelopes),
+            **wavelet_parameters
+        )
+        if storage == 'ragged':
+            envelope_phases = [bank.phases(envelope, frequency_bands_dict) for envelope in envelopes]
+            lengths = np.minimum(
+                [phases[frequency_bands[0]].shape[0] for phases in envelope_phases],
+                max_length_samples
             )
+            for band in frequency_bands:
+                RaggedArray.from_list(
+                    [phases[band][:length] for phases, length in zip(envelope_phases, lengths)]
+                ).save(bands_folder / f'{band}{envelopes_extension}', bands_folder / offsets_filename)
+        else:
+            lengths = np.full(len(wav_files), mean_length_samples)
+            phase_envelopes = {band: np.zeros((len(wav_files), mean_length_samples)) for band in frequency_bands}
+            for wav_idx, envelope in enumerate(envelopes):
+                for band, phase_envelope in bank.phases(envelope, frequency_bands_dict).items():
+                    phase_envelope = phase_envelope[:mean_length_samples]
+                    phase_envelopes[band][wav_idx, :phase_envelope.shape[0]] = phase_envelope
 
-            # 3. Padding/cutting to account for different stimuli lengths
-            if phase_envelope.shape[0] > mean_length_samples:
-                phase_envelope = phase_envelope[:mean_length_samples]
-            else:
-                phase_envelope = np.pad(
-                    phase_envelope,
-                    (0, mean_length_samples - phase_envelope.shape[0]),
-                    'constant'
+            for band in frequency_bands:
+                np.save(bands_folder / f'{band}{envelopes_extension}', phase_envelopes[band])
+
+        jobs = [
+            {
+                'name': participant_id,
+                'kind': 'bands_morlet',
+                'size_mb': epochs_mb[participant_id] + len(frequency_bands) * band_mb,
+                'ratio': 2.0,
+                'function': filter_participant_morlet,
+                'tags': {'participant': participant_id},
+                'args': (
+                    participant_id,
+                    eeg_folder / f'{participant_id}{epochs_extension}',
+                    orders[participant_id],
+                    bands_folder,
+                    frequency_bands_dict,
+                    lengths,
+                    bank.decim,
+                    sfreq_eeg,
+                    sfreq_goal,
+                    wavelet_parameters,
+                    storage,
+                    mean_length_samples
+                ),
+                'unit': f'{participant_id}/morlet',
+                'fingerprint': fingerprint(
+                    source,
+                    config['filtering_parameters'],
+                    wavelet_parameters,
+                    frequency_bands_dict,
+                    lengths.tolist(),
+                    input_fingerprints[participant_id]
+                ),
+                'outputs': [bands_folder / f'{participant_id}_{band}.npy' for band in frequency_bands]
+            }
+            for participant_id in participants
+        ]
+
+    if phase_engine == 'iir':
+        jobs = []
+        for band in frequency_bands:
+            print(f'Processing `{band}` band')
+            # First, create array of phase envelopes containing all stimuli
+            phase_envelopes = np.full((len(wav_files), mean_length_samples), np.nan)
+            ragged_phase_envelopes = []
+
+            for wav_idx, envelope in enumerate(envelopes):
+                # 1. Get band-pass filtered envelope phase at 128 Hz (goal sampling rate)
+                phase_envelope = extract_envelope_phase(
+                    envelope,
+                    sfreq=sfreq_eeg,
+                    sfreq_goal=sfreq_goal,
+                    freq_min=frequency_bands_dict[band][0],
+                    freq_max=frequency_bands_dict[band][1],
+                    iir_params=alias_dict
                 )
 
-            phase_envelopes[wav_idx] = phase_envelope
-
-        # Second, create array of EEG data for each participant
-        for participant_id in participants:
-            # 1. Get epochs at 512 Hz (preprocessed EEG sampling rate)
-            epochs = mne.read_epochs(eeg_folder / f'{participant_id}{epochs_extension}', preload=True)
-
-            # 2. Get band-pass filtered EEG phase at 128 Hz (goal sampling rate)
-            eeg = extract_eeg_phase(
-                epochs,
-                sfreq=sfreq_eeg,
-                sfreq_goal=sfreq_goal,
-                freq_min=frequency_bands_dict[band][0],
-                freq_max=frequency_bands_dict[band][1],
-                iir_params=alias_dict,
-                tmax=mean_length_s
-            )
+                # 2. Padding/cutting to account for different stimuli lengths, or keeping the true length up to the
+                # end of the epochs
+                if storage == 'ragged':
+                    ragged_phase_envelopes.append(phase_envelope[:max_length_samples])
+                    continue
+
+                if phase_envelope.shape[0] > mean_length_samples:
+                    phase_envelope = phase_envelope[:mean_length_samples]
+                else:
+                    phase_envelope = np.pad(
+                        phase_envelope,
+                        (0, mean_length_samples - phase_envelope.shape[0]),
+                        'constant'
+                    )
+
+                phase_envelopes[wav_idx] = phase_envelope
 
-            # 3. Reorder stimuli in EEG array from randomized participant-specific order to stimuli array order
-            log_df = pd.read_csv(logs_folder / f'{participant_id}{logs_txt_extension}', sep='\t')
-            random_order = list(log_df.file.values)
-            sorted_eeg = reorder_eeg_data(order_list=random_order, eeg=eeg)
+            # Envelope phases are identical for all participants and stored once per band
+            if storage == 'ragged':
+                phase_envelopes = RaggedArray.from_list(ragged_phase_envelopes)
+                phase_envelopes.save(bands_folder / f'{band}{envelopes_extension}', bands_folder / offsets_filename)
+                lengths = phase_envelopes.lengths
+            else:
+                np.save(bands_folder / f'{band}{envelopes_extension}', phase_envelopes)
+                lengths = None
+
+            # Second, create array of EEG data for each participant
+            jobs.extend(
+                {
+                    'name': f'{participant_id} {band}',
+                    'kind': 'bands_iir',
+                    'size_mb': epochs_mb[participant_id] + band_mb,
+                    'ratio': 3.0,
+                    'function': filter_participant_iir,
+                    'tags': {'participant': participant_id, 'band': band},
+                    'args': (
+                        participant_id,
+                        band,
+                        eeg_folder / f'{participant_id}{epochs_extension}',
+                        orders[participant_id],
+                        bands_folder / f'{participant_id}_{band}.npy',
+                        frequency_bands_dict[band],
+                        lengths,
+                        sfreq_eeg,
+                        sfreq_goal,
+                        alias_dict,
+                        mean_length_samples,
+                        mean_length_s
+                    ),
+                    'unit': f'{participant_id}/{band}',
+                    'fingerprint': fingerprint(
+                        source,
+                        config['filtering_parameters'],
+                        frequency_bands_dict[band],
+                        alias_dict,
+                        lengths.tolist() if lengths is not None else None,
+                        input_fingerprints[participant_id]
+                    ),
+                    'outputs': [bands_folder / f'{participant_id}_{band}.npy']
+                }
+                for participant_id in participants
+            )
 
-            phase_envelopes_dim = np.expand_dims(phase_envelopes, axis=1)
-            band_array = np.concatenate((phase_envelopes_dim, sorted_eeg), axis=1)
+    pending_jobs = []
+    for job in jobs:
+        if manifest.completed(job['unit'], job['fingerprint'], job['outputs']):
+            print(f'{job["unit"]}: completed in an earlier run, skipping')
+            continue
+        pending_jobs.append(job)
 
-            np.save(bands_folder / f'{participant_id}_{band}.npy', band_array)
+    scheduler.run(
+        pending_jobs,
+        callback=lambda job, _: manifest.record(job['unit'], job['fingerprint'], job['outputs'])
+    )
@@ -0,0 +1,158 @@
+""" Morlet wavelet phase bank: the phases of all frequency bands from one Fourier transform of the signal.
+
+Instead of band-pass filtering and Hilbert-transforming the signal once per band, the complex Morlet coefficients of a
+dense, log-spaced frequency grid are computed at once:
+- The signal is Fourier-transformed once (zero-padded, so the circular convolution does not wrap around).
+- Its spectrum is multiplied by the precomputed spectra of the analytic Morlet wavelets, which are Gaussians centered
+  at the grid frequencies with a standard deviation of `frequency / n_cycles`.
+- The products are inverse-transformed, batched over frequencies and channels. The coefficients are band-limited far
+  below the goal sampling frequency, so only the spectrum below it is inverse-transformed, which yields the
+  coefficients decimated to the goal sampling frequency directly.
+
+A band is pooled by summing the coefficients of the grid frequencies within it; the sum of the Gaussian kernels acts
+as a band-pass filter, and the angle of the pooled coefficients is the phase in the band. New band definitions thus
+only cost a sum over the coefficients. As the inverse transform is linear, the phases of the bands alone are obtained
+even cheaper by pooling the kernel spectra before the inverse transform, one inverse transform per band.
+
+"""
+
+import numpy as np
+from scipy.fft import ifft, next_fast_len, rfft
+
+
+class MorletPhaseBank:
+    """ Complex Morlet coefficients of a log-spaced frequency grid and the phases of bands pooled from them.
+
+    Parameters
+    ----------
+    sfreq : float
+        Sampling frequency of the signals.
+    sfreq_goal : float
+        Sampling frequency of the coefficients. `sfreq / sfreq_goal` must be an integer.
+    n_times : int
+        Maximum number of samples of the signals at `sfreq`.
+    freq_min : float
+        Lowest frequency of the grid.
+    freq_max : float
+        Highest frequency of the grid.
+    n_freqs : int
+        Number of log-spaced frequencies of the grid.
+    n_cycles : float
+        Number of cycles of the wavelets, trading temporal for spectral resolution.
+
+    """
+
+    def __init__(
+        self,
+        sfreq: float,
+        sfreq_goal: float,
+        n_times: int,
+        freq_min: float,
+        freq_max: float,
+        n_freqs: int,
+        n_cycles: float
+    ):
+        decim = sfreq / sfreq_goal
+        if not np.isclose(decim, round(decim)):
+            raise ValueError(f'Sampling frequency {sfreq} Hz is not a multiple of the goal {sfreq_goal} Hz.')
+        if freq_max * (1 + 5 / n_cycles) >= sfreq_goal / 2:
+            raise ValueError(f'Wavelets up to {freq_max} Hz are not band-limited below {sfreq_goal / 2} Hz.')
+
+        self.sfreq = sfreq
+        self.decim = int(round(decim))
+        self.n_times = n_times
+        self.freqs = np.geomspace(freq_min, freq_max, n_freqs)
+        self.n_cycles = n_cycles
+
+        # Zero padding of five standard deviations of the longest wavelet keeps the convolution from wrapping around
+        sigma_t = n_cycles / (2 * np.pi * freq_min)
+        n_pad = int(np.ceil(5 * sigma_t * sfreq))
+        self.n_bins = next_fast_len(-(-(n_times + n_pad) // self.decim))
+        self.n_fft = self.n_bins * self.decim
+
+        # Spectra of the analytic wavelets on the bins below the goal sampling frequency, twice the Gaussian so the
+        # coefficients of a sinusoid have its amplitude
+        bin_freqs = np.arange(self.n_bins) * sfreq / self.n_fft
+        sigma_f = self.freqs[:, None] / n_cycles
+        self.kernels = 2 * np.exp(-0.5 * ((bin_freqs[None, :] - self.freqs[:, None]) / sigma_f)**2)
+
+    def transform(self, data: np.ndarray) -> np.ndarray:
+        """ Complex Morlet coefficients at the goal sampling frequency.
+
+        Parameters
+        ----------
+        data : np.ndarray
+            Signals (... x times) at the sampling frequency, with at most `n_times` samples.
+
+        Returns
+        -------
+        coefficients : np.ndarray
+            Coefficients (freqs x ... x times), where the k-th sample corresponds to the (k * decim)-th input sample.
+
+        """
+        return self._apply(data, self.kernels)
+
+    def _apply(self, data: np.ndarray, kernels: np.ndarray) -> np.ndarray:
+        """ Filter the signals with each of the kernel spectra (kernels x bins) and decimate them. """
+        n_times = data.shape[-1]
+        if n_times > self.n_times:
+            raise ValueError(f'Signal has {n_times} samples but the phase bank was set up for {self.n_times}.')
+
+        spectrum = rfft(data, self.n_fft, axis=-1)[..., :self.n_bins]
+        kernels = kernels.reshape(kernels.shape[0], *([1] * (data.ndim - 1)), self.n_bins)
+
+        # The inverse transform of the lowest bins evaluates the full-length one at every decim-th sample
+        coefficients = ifft(spectrum[None] * kernels, axis=-1)[..., :-(-n_times // self.decim)] / self.decim
+
+        return coefficients
+
+    def _in_band(self, freq_min: float, freq_max: float) -> np.ndarray:
+        """ Mask of the grid frequencies within a band. """
+        in_band = (self.freqs >= freq_min) & (self.freqs <= freq_max)
+        if not in_band.any():
+            raise ValueError(f'No grid frequency within {freq_min}-{freq_max} Hz, increase the number of frequencies.')
+        return in_band
+
+    def pool(self, coefficients: np.ndarray, freq_min: float, freq_max: float) -> np.ndarray:
+        """ Sum the coefficients of the grid frequencies within a band.
+
+        Parameters
+        ----------
+        coefficients : np.ndarray
+            Coefficients (freqs x ... x times), see `transform`.
+        freq_min : float
+            Lower frequency of the band.
+        freq_max : float
+            Upper frequency of the band.
+
+        Returns
+        -------
+        band_coefficients : np.ndarray
+            Pooled coefficients (... x times), their angle is the phase in the band.
+
+        """
+        return coefficients[self._in_band(freq_min, freq_max)].sum(axis=0)
+
+    def phases(self, data: np.ndarray, bands: dict) -> dict:
+        """ Phases of several bands from one Fourier transform of the signals.
+
+        Equals the angle of `pool(transform(data), ...)` for each band, with the kernels pooled before the inverse
+        transform.
+
+        Parameters
+        ----------
+        data : np.ndarray
+            Signals (... x times) at the sampling frequency.
+        bands : dict
+            Lower and upper frequency of each band, keyed by band name.
+
+        Returns
+        -------
+        phases : dict
+            Phases (... x times) at the goal sampling frequency, keyed by band name.
+
+        """
+        kernels = np.stack([self.kernels[self._in_band(*limits)].sum(axis=0) for limits in bands.values()])
+        band_coefficients = self._apply(data, kernels)
+
+        return {band: np.angle(coefficients) for band, coefficients in zip(bands, band_coefficients)}
@@ -0,0 +1,187 @@
+""" Phase statistics computed directly from angle arrays, with optional Numba-compiled kernels.
+
+The phase-locking value between two phase time series and the inter-trial phase coherence are lengths of mean
+resultant vectors, `|mean(exp(1j * phase))|`. Computed with NumPy, the complex tensor `exp(1j * phase)` is allocated
+for the whole (stimuli x channels x times) array. If Numba is installed, the kernels below instead accumulate the
+cosines and sines in fused loops, parallelized over stimuli and channels, without any temporary array. Without Numba,
+the NumPy reference path is used, one stimulus at a time to bound the size of the temporaries. Stimuli of different
+lengths are handled as ragged arrays (see `ragged.py`), reducing each stimulus' segment of the concatenated phases.
+
+"""
+
+import numpy as np
+
+from ragged import segment_sum
+
+try:
+    from numba import njit, prange
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+
+if NUMBA_AVAILABLE:
+    @njit(parallel=True, cache=True)
+    def _phase_locking_numba(phase_x, phase_y, out):
+        n_stimuli, n_channels, n_times = phase_y.shape
+        for idx in prange(n_stimuli * n_channels):
+            stimulus, channel = idx // n_channels, idx % n_channels
+            real, imag = 0.0, 0.0
+            for sample in range(n_times):
+                difference = phase_y[stimulus, channel, sample] - phase_x[stimulus, sample]
+                real += np.cos(difference)
+                imag += np.sin(difference)
+            out[stimulus, channel] = np.sqrt(real**2 + imag**2) / n_times
+
+    @njit(parallel=True, cache=True)
+    def _inter_trial_coherence_numba(phase, out):
+        n_trials, n_channels, n_times = phase.shape
+        for channel in prange(n_channels):
+            # Accumulate along the contiguous time axis, one trial after the other
+            real, imag = np.zeros(n_times), np.zeros(n_times)
+            for trial in range(n_trials):
+                for sample in range(n_times):
+                    real[sample] += np.cos(phase[trial, channel, sample])
+                    imag[sample] += np.sin(phase[trial, channel, sample])
+            for sample in range(n_times):
+                out[channel, sample] = np.sqrt(real[sample]**2 + imag[sample]**2) / n_trials
+
+    @njit(parallel=True, cache=True)
+    def _segment_phase_locking_numba(phase_x, phase_y, offsets, out):
+        n_channels = phase_y.shape[0]
+        n_segments = offsets.shape[0] - 1
+        for idx in prange(n_segments * n_channels):
+            segment, channel = idx // n_channels, idx % n_channels
+            real, imag = 0.0, 0.0
+            for sample in range(offsets[segment], offsets[segment + 1]):
+                difference = phase_y[channel, sample] - phase_x[sample]
+                real += np.cos(difference)
+                imag += np.sin(difference)
+            out[segment, channel] = np.sqrt(real**2 + imag**2) / (offsets[segment + 1] - offsets[segment])
+
+
+def _use_numba(use_numba: bool | None) -> bool:
+    """ Resolve the kernel choice: Numba if installed, unless explicitly disabled. """
+    if use_numba is None:
+        return NUMBA_AVAILABLE
+    if use_numba and not NUMBA_AVAILABLE:
+        raise ImportError('Numba is not installed, use the NumPy path with `use_numba=False`.')
+    return use_numba
+
+
+def phase_locking_value(
+    phase_x: np.ndarray,
+    phase_y: np.ndarray,
+    use_numba: bool | None = None
+) -> np.ndarray:
+    """ Phase-locking value over time between one signal and each channel of another, per stimulus.
+
+    Parameters
+    ----------
+    phase_x : np.ndarray
+        Phases of the first signal, e.g., the envelope (stimuli x times).
+    phase_y : np.ndarray
+        Phases of the second signal, e.g., the EEG (stimuli x channels x times).
+    use_numba : bool | None
+        Whether to use the Numba kernel. If None, it is used if Numba is installed.
+
+    Returns
+    -------
+    plv : np.ndarray
+        Length of the mean resultant vector of the phase differences (stimuli x channels).
+
+    """
+    if phase_x.shape[0] != phase_y.shape[0] or phase_x.shape[-1] != phase_y.shape[-1]:
+        raise ValueError(f'Phases of shape {phase_x.shape} do not match phases of shape {phase_y.shape}.')
+
+    out = np.empty(phase_y.shape[:2])
+
+    if _use_numba(use_numba):
+        _phase_locking_numba(
+            np.asarray(phase_x, dtype=np.float64),
+            np.asarray(phase_y, dtype=np.float64),
+            out
+        )
+    else:
+        for stimulus in range(phase_y.shape[0]):
+            out[stimulus] = np.abs(np.exp(1j * (phase_y[stimulus] - phase_x[stimulus])).mean(axis=-1))
+
+    return out
+
+
+def segment_phase_locking_value(
+    phase_x: np.ndarray,
+    phase_y: np.ndarray,
+    offsets: np.ndarray,
+    use_numba: bool | None = None
+) -> np.ndarray:
+    """ Phase-locking value over time per stimulus, for stimuli of different lengths stored as ragged arrays.
+
+    Parameters
+    ----------
+    phase_x : np.ndarray
+        Concatenated phases of the first signal, e.g., the envelope (total samples).
+    phase_y : np.ndarray
+        Concatenated phases of the second signal, e.g., the EEG (channels x total samples).
+    offsets : np.ndarray
+        Offsets of the stimuli, see `ragged.get_offsets`.
+    use_numba : bool | None
+        Whether to use the Numba kernel. If None, it is used if Numba is installed.
+
+    Returns
+    -------
+    plv : np.ndarray
+        Length of the mean resultant vector of the phase differences (stimuli x channels), NaN for empty stimuli.
+
+    """
+    if phase_x.shape[-1] != phase_y.shape[-1] or phase_x.shape[-1] != offsets[-1]:
+        raise ValueError(
+            f'Phases of shape {phase_x.shape} and {phase_y.shape} do not match offsets ending at {offsets[-1]}.'
+        )
+
+    out = np.empty((offsets.shape[0] - 1, phase_y.shape[0]))
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if _use_numba(use_numba):
+            _segment_phase_locking_numba(
+                np.asarray(phase_x, dtype=np.float64),
+                np.asarray(phase_y, dtype=np.float64),
+                np.asarray(offsets, dtype=np.int64),
+                out
+            )
+        else:
+            lengths = np.diff(offsets)
+            for channel in range(phase_y.shape[0]):
+                difference = phase_y[channel] - phase_x
+                real = segment_sum(np.cos(difference), offsets)
+                imag = segment_sum(np.sin(difference), offsets)
+                out[:, channel] = np.sqrt(real**2 + imag**2) / lengths
+
+    return out
+
+
+def inter_trial_coherence(phase: np.ndarray, use_numba: bool | None = None) -> np.ndarray:
+    """ Inter-trial phase coherence, i.e., phase consistency across trials at each channel and time point.
+
+    Parameters
+    ----------
+    phase : np.ndarray
+        Phases (trials x channels x times).
+    use_numba : bool | None
+        Whether to use the Numba kernel. If None, it is used if Numba is installed.
+
+    Returns
+    -------
+    itc : np.ndarray
+        Length of the mean resultant vector across trials (channels x times).
+
+    """
+    out = np.empty(phase.shape[1:])
+
+    if _use_numba(use_numba):
+        _inter_trial_coherence_numba(np.asarray(phase, dtype=np.float64), out)
+    else:
+        for channel in range(phase.shape[1]):
+            out[channel] = np.abs(np.exp(1j * phase[:, channel]).mean(axis=0))
+
+    return out
@@ -0,0 +1,136 @@
+""" Ragged storage of stimuli of different lengths.
+
+Instead of padding shorter stimuli with zeros and cutting longer ones to a common length, the samples of all stimuli
+are concatenated along the last (time) axis and the start of each stimulus is kept in an offsets array, i.e., stimulus
+`i` is `values[..., offsets[i]:offsets[i + 1]]`. Statistics over time are computed for all stimuli at once with segment
+reductions (`np.add.reduceat`), so each stimulus contributes exactly its own samples.
+
+On disk, the values are stored as `.npy` file (memory-mappable like the padded band arrays) and the offsets, which are
+shared by all files of a bands folder, as a separate `.npy` file.
+
+"""
+
+from pathlib import Path
+
+import numpy as np
+
+
+def get_offsets(lengths) -> np.ndarray:
+    """ Offsets of stimuli with the given lengths, starting with 0 and ending with the total length. """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    if np.any(lengths < 0):
+        raise ValueError('Stimulus lengths cannot be negative.')
+
+    return np.concatenate([[0], np.cumsum(lengths)])
+
+
+def segment_sum(values: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """ Sum of each stimulus' samples along the last axis.
+
+    Parameters
+    ----------
+    values : np.ndarray
+        Concatenated samples of all stimuli (... x total samples).
+    offsets : np.ndarray
+        Offsets of the stimuli, see `get_offsets`.
+
+    Returns
+    -------
+    sums : np.ndarray
+        Sums over time (... x stimuli). Empty stimuli sum to zero.
+
+    """
+    lengths = np.diff(offsets)
+    sums = np.zeros(values.shape[:-1] + (lengths.shape[0],), dtype=values.dtype)
+
+    # reduceat returns the sample at the offset for empty segments and cannot start at the total length
+    non_empty = lengths > 0
+    if np.any(non_empty):
+        sums[..., non_empty] = np.add.reduceat(values, offsets[:-1][non_empty], axis=-1)
+
+    return sums
+
+
+class RaggedArray:
+    """ Stimuli of different lengths concatenated along the last axis.
+
+    Parameters
+    ----------
+    values : np.ndarray
+        Concatenated samples of all stimuli (... x total samples), e.g., (channels x total samples) for the EEG.
+    offsets : np.ndarray
+        Offsets of the stimuli, see `get_offsets`.
+
+    """
+
+    def __init__(self, values: np.ndarray, offsets: np.ndarray):
+        offsets = np.asarray(offsets, dtype=np.int64)
+        if offsets.ndim != 1 or offsets[0] != 0 or np.any(np.diff(offsets) < 0):
+            raise ValueError('Offsets need to be increasing and start at 0.')
+        if values.shape[-1] != offsets[-1]:
+            raise ValueError(f'Values have {values.shape[-1]} samples but the offsets end at {offsets[-1]}.')
+
+        self.values = values
+        self.offsets = offsets
+
+    @classmethod
+    def from_list(cls, arrays: list) -> 'RaggedArray':
+        """ Concatenate arrays of the same shape except for the last axis. """
+        return cls(np.concatenate(arrays, axis=-1), get_offsets([array.shape[-1] for array in arrays]))
+
+    @classmethod
+    def empty(
+        cls,
+        lengths,
+        shape: tuple = (),
+        dtype=np.float64,
+        out_file: str | Path | None = None
+    ) -> 'RaggedArray':
+        """ Allocate a ragged array for stimuli of the given lengths, memory-mapped to `out_file` if given. """
+        offsets = get_offsets(lengths)
+        values_shape = tuple(shape) + (int(offsets[-1]),)
+        if out_file is None:
+            values = np.empty(values_shape, dtype=dtype)
+        else:
+            values = np.lib.format.open_memmap(out_file, mode='w+', dtype=dtype, shape=values_shape)
+
+        return cls(values, offsets)
+
+    @classmethod
+    def load(cls, values_file: str | Path, offsets_file: str | Path, mmap_mode: str | None = 'r') -> 'RaggedArray':
+        """ Load the values (memory-mapped by default) and the offsets stored with `save`. """
+        return cls(np.load(values_file, mmap_mode=mmap_mode), np.load(offsets_file))
+
+    def save(self, values_file: str | Path, offsets_file: str | Path | None = None) -> None:
+        """ Store the values and, if a file is given, the offsets as `.npy` files. """
+        np.save(values_file, self.values)
+        if offsets_file is not None:
+            np.save(offsets_file, self.offsets)
+
+    @property
+    def lengths(self) -> np.ndarray:
+        """ Number of samples of each stimulus. """
+        return np.diff(self.offsets)
+
+    def __len__(self) -> int:
+        return self.offsets.shape[0] - 1
+
+    def __getitem__(self, idx: int) -> np.ndarray:
+        return self.values[..., self.offsets[idx]:self.offsets[idx + 1]]
+
+    def __setitem__(self, idx: int, value: np.ndarray) -> None:
+        self.values[..., self.offsets[idx]:self.offsets[idx + 1]] = value
+
+    def groups(self) -> list:
+        """ Indices of the stimuli of each distinct length, to batch computations that need equal lengths. """
+        lengths = self.lengths
+        return [np.flatnonzero(lengths == length) for length in np.unique(lengths)]
+
+    def stack(self, indices: np.ndarray) -> np.ndarray:
+        """ Stimuli of equal length as one array (stimuli x ... x times), see `groups`. """
+        return np.stack([self[idx] for idx in indices])
+
+    def mean(self) -> np.ndarray:
+        """ Mean over time of each stimulus (... x stimuli). """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return segment_sum(self.values, self.offsets) / self.lengths
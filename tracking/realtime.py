@@ -0,0 +1,307 @@
+""" Real-time envelope tracking: causal filters with persistent state and a running phase-locking value.
+
+Audio and EEG arrive in chunks covering the same stretch of time. Every processing step is causal and carries its
+state from one chunk to the next, so the chunks can be of any length:
+1. Envelope: the gammatone filterbank of `extract_envelope` (the same cascades of biquads as brian2hears), half-wave
+   rectification, compression, averaging over subbands and the anti-alias low-pass filter, applied forward only. The
+   envelope is picked at the EEG sample times from the audio samples.
+2. Band phases: each band is shifted to zero frequency by a complex oscillator, low-pass filtered with half the band's
+   width and shifted back, i.e., a complex band-pass filter whose output is the analytic signal of the band. Its angle
+   is the instantaneous phase without the Hilbert transform's need for future samples.
+3. Running PLV: the unit phasors of the phase differences between EEG and envelope are summed per band and channel,
+   optionally with exponential forgetting, and normalized by the summed weights.
+
+The envelope and the EEG are filtered with the same band filters, so their group delays cancel in the phase
+differences. The algorithmic latency of the PLV is the processing time of a chunk plus the chunk duration, but its
+value lags behind by the filters' group delay, as with any causal filter.
+
+"""
+
+import time
+from pathlib import Path
+
+import mne
+import numpy as np
+import pandas as pd
+from scipy.io import wavfile
+from scipy.signal import iirfilter, sosfilt, sosfilt_zi
+
+from tracking_utils import get_stimulus_order
+
+
+class CausalEnvelope:
+    """ Causal, chunk-wise version of `extract_envelope`, resampled to the EEG sampling frequency.
+
+    Parameters
+    ----------
+    sfreq : float
+        Sampling frequency of the audio.
+    sfreq_goal : float
+        Sampling frequency of the envelope, e.g., the EEG sampling frequency.
+    center_freqs : np.ndarray
+        Center frequencies of the gammatone filterbank in Hz.
+    compression : float
+        Exponent of the compression function.
+    alias_dict : dict
+        IIR parameters of the anti-alias low-pass filter (`order`, `ftype`), as used by `extract_envelope`.
+
+    """
+
+    def __init__(self, sfreq: float, sfreq_goal: float, center_freqs: np.ndarray, compression: float, alias_dict: dict):
+        center_freqs = np.asarray(center_freqs, dtype=float)
+        if np.any(center_freqs >= sfreq / 2):
+            raise ValueError(f'Gammatone center frequencies must be below the Nyquist frequency of {sfreq / 2} Hz.')
+
+        self.sfreq = sfreq
+        self.ratio = sfreq / sfreq_goal
+        self.compression = compression
+
+        # Biquad cascades of the brian2hears gammatone filterbank: coefficients (channels x 3 x sections). brian2 takes
+        # seconds to import and is only needed here
+        import brian2 as b2
+        import brian2hears as b2h
+
+        gammatone = b2h.Gammatone(b2h.silence(1 * b2.ms, samplerate=sfreq * b2.Hz), center_freqs * b2.Hz)
+        self.gammatone_sos = [
+            np.concatenate([gammatone.filt_b[channel].T, gammatone.filt_a[channel].T], axis=1)
+            for channel in range(center_freqs.shape[0])
+        ]
+        self.gammatone_zi = [np.zeros((sos.shape[0], 2)) for sos in self.gammatone_sos]
+
+        self.alias_sos = iirfilter(
+            alias_dict['order'], sfreq_goal / 3.0, btype='lowpass', ftype=alias_dict['ftype'], fs=sfreq, output='sos'
+        )
+        self.alias_zi = None
+        self.n_samples = 0
+        self.n_output = 0
+
+    def process(self, audio: np.ndarray) -> np.ndarray:
+        """ Envelope samples at the goal sampling frequency whose times fall into the audio chunk. """
+        audio = np.asarray(audio, dtype=float)
+        envelope = np.zeros_like(audio)
+        for channel, sos in enumerate(self.gammatone_sos):
+            subband, self.gammatone_zi[channel] = sosfilt(sos, audio, zi=self.gammatone_zi[channel])
+            envelope += np.clip(subband, 0, None)**self.compression
+        envelope /= len(self.gammatone_sos)
+
+        if self.alias_zi is None:
+            self.alias_zi = sosfilt_zi(self.alias_sos) * (envelope[0] if envelope.shape[0] else 0.0)
+        envelope, self.alias_zi = sosfilt(self.alias_sos, envelope, zi=self.alias_zi)
+
+        # Output samples are picked at the audio samples nearest to their times, ties rounded up (not half to even as
+        # `np.round`) to agree with the count of output samples whose times fall before the end of the chunk
+        stop = self.n_samples + audio.shape[0]
+        n_output = int(np.ceil((stop - 0.5) / self.ratio)) if stop else 0
+        indices = np.floor(np.arange(self.n_output, n_output) * self.ratio + 0.5).astype(int) - self.n_samples
+        assert np.all(indices >= 0), 'Envelope output samples fall before the audio chunk.'
+        self.n_samples, self.n_output = stop, max(n_output, self.n_output)
+
+        return envelope[indices]
+
+
+class CausalBandPhase:
+    """ Instantaneous phase in several frequency bands from causal complex band-pass filters.
+
+    Parameters
+    ----------
+    sfreq : float
+        Sampling frequency of the signals.
+    bands : dict
+        Lower and upper frequency of each band, keyed by band name.
+    n_channels : int
+        Number of channels of the signals.
+    iir_params : dict
+        IIR parameters of the low-pass prototype of the band-pass filters (`order`, `ftype`).
+
+    """
+
+    def __init__(self, sfreq: float, bands: dict, n_channels: int, iir_params: dict):
+        self.sfreq = sfreq
+        self.bands = list(bands)
+        self.center_freqs = np.array([(freq_min + freq_max) / 2 for freq_min, freq_max in bands.values()])
+        self.sos = [
+            iirfilter(
+                iir_params['order'], (freq_max - freq_min) / 2, btype='lowpass', ftype=iir_params['ftype'], fs=sfreq,
+                output='sos'
+            )
+            for freq_min, freq_max in bands.values()
+        ]
+        self.zi = [np.zeros((sos.shape[0], n_channels, 2), dtype=complex) for sos in self.sos]
+        self.oscillator_phases = np.zeros(len(self.bands))
+
+    def process(self, data: np.ndarray) -> np.ndarray:
+        """ Phases (bands x channels x times) of a chunk (channels x times). """
+        n_times = data.shape[-1]
+        phases = np.empty((len(self.bands), data.shape[0], n_times))
+
+        for band_idx, sos in enumerate(self.sos):
+            # Oscillator phases are kept modulo 2 pi, so they stay accurate however long the stream runs
+            increment = 2 * np.pi * self.center_freqs[band_idx] / self.sfreq
+            carrier = np.exp(1j * (self.oscillator_phases[band_idx] + increment * np.arange(n_times)))
+            self.oscillator_phases[band_idx] = (self.oscillator_phases[band_idx] + increment * n_times) % (2 * np.pi)
+
+            baseband, self.zi[band_idx] = sosfilt(sos, data * np.conj(carrier), axis=-1, zi=self.zi[band_idx])
+            phases[band_idx] = np.angle(baseband * carrier)
+
+        return phases
+
+
+class StreamingPLV:
+    """ Running phase-locking value between the envelope and each EEG channel, updated chunk by chunk.
+
+    Parameters
+    ----------
+    sfreq_wav : float
+        Sampling frequency of the audio.
+    sfreq_eeg : float
+        Sampling frequency of the EEG.
+    n_channels : int
+        Number of EEG channels.
+    bands : dict
+        Lower and upper frequency of each band, keyed by band name.
+    center_freqs : np.ndarray
+        Center frequencies of the gammatone filterbank in Hz.
+    compression : float
+        Exponent of the compression function of the envelope.
+    alias_dict : dict
+        IIR parameters of the filters (`order`, `ftype`).
+    time_constant_s : float | None
+        Time constant of the exponential forgetting in seconds. If None, the PLV covers the whole stream.
+    warmup_s : float
+        Duration at the beginning of the stream that is skipped while the filters settle.
+
+    """
+
+    def __init__(
+        self,
+        sfreq_wav: float,
+        sfreq_eeg: float,
+        n_channels: int,
+        bands: dict,
+        center_freqs: np.ndarray,
+        compression: float,
+        alias_dict: dict,
+        time_constant_s: float | None = None,
+        warmup_s: float = 0.0
+    ):
+        self.envelope = CausalEnvelope(sfreq_wav, sfreq_eeg, center_freqs, compression, alias_dict)
+        self.envelope_phase = CausalBandPhase(sfreq_eeg, bands, 1, alias_dict)
+        self.eeg_phase = CausalBandPhase(sfreq_eeg, bands, n_channels, alias_dict)
+        self.bands = list(bands)
+        self.decay = np.exp(-1 / (time_constant_s * sfreq_eeg)) if time_constant_s is not None else 1.0
+        self.warmup_samples = int(round(warmup_s * sfreq_eeg))
+
+        self.n_samples = 0
+        self.resultant = np.zeros((len(self.bands), n_channels), dtype=complex)
+        self.weight = 0.0
+        self._envelope_buffer = np.empty(0)
+        self._eeg_buffer = np.empty((n_channels, 0))
+
+    def update(self, audio: np.ndarray, eeg: np.ndarray) -> np.ndarray:
+        """ Ingest a chunk of audio (times) and EEG (channels x times), return the current PLV (bands x channels). """
+        self._envelope_buffer = np.concatenate([self._envelope_buffer, self.envelope.process(audio)])
+        self._eeg_buffer = np.concatenate([self._eeg_buffer, np.asarray(eeg, dtype=float)], axis=-1)
+
+        # Samples for which both the envelope and the EEG are available
+        n_times = min(self._envelope_buffer.shape[0], self._eeg_buffer.shape[-1])
+        if n_times:
+            envelope_phases = self.envelope_phase.process(self._envelope_buffer[None, :n_times])
+            eeg_phases = self.eeg_phase.process(self._eeg_buffer[:, :n_times])
+            self._envelope_buffer = self._envelope_buffer[n_times:]
+            self._eeg_buffer = self._eeg_buffer[:, n_times:]
+
+            # Samples after the warm-up, weighted by their age at the end of the chunk
+            kept = np.arange(self.n_samples, self.n_samples + n_times) >= self.warmup_samples
+            weights = self.decay**np.arange(n_times - 1, -1, -1) * kept
+            phasors = np.exp(1j * (eeg_phases - envelope_phases))
+            self.resultant = self.decay**n_times * self.resultant + phasors @ weights
+            self.weight = self.decay**n_times * self.weight + weights.sum()
+            self.n_samples += n_times
+
+        return self.plv()
+
+    def plv(self) -> np.ndarray:
+        """ Current phase-locking values (bands x channels), NaN during the warm-up. """
+        if self.weight == 0:
+            return np.full(self.resultant.shape, np.nan)
+        return np.abs(self.resultant) / self.weight
+
+
+class FileReplaySource:
+    """ Stand-in for a live acquisition: replays a participant's epochs together with the stimuli as chunks.
+
+    Trials are replayed back to back in the order of the experiment, each from the stimulus onset for the duration of
+    the stimulus, so audio and EEG are continuous and aligned. Trial durations are cut to a whole number of samples of
+    both streams.
+
+    Parameters
+    ----------
+    epochs_file : Path
+        Onset-locked epochs of the participant.
+    log_file : Path
+        Log with the stimuli in the order of the experiment, see `get_stimulus_order`.
+    wav_files : list
+        Stimuli in stimuli array order.
+    chunk_duration_s : float
+        Duration of the chunks.
+    realtime : bool
+        Whether to release the chunks at the pace of a live recording instead of as fast as possible.
+
+    """
+
+    def __init__(
+        self,
+        epochs_file: Path,
+        log_file: Path,
+        wav_files: list,
+        chunk_duration_s: float,
+        realtime: bool = False
+    ):
+        self.epochs = mne.read_epochs(epochs_file, preload=True, verbose=False)
+        log_df = pd.read_csv(log_file, sep='\t')
+        order = get_stimulus_order(log_df, [wav_file.stem for wav_file in wav_files], self.epochs.events[:, 2])
+
+        # Stimulus of each epoch, in the order of the experiment
+        self.trial_wavs = [None] * len(self.epochs)
+        for wav_idx, epoch_idx in enumerate(order):
+            self.trial_wavs[epoch_idx] = wav_files[wav_idx]
+
+        self.sfreq_eeg = self.epochs.info['sfreq']
+        self.sfreq_wav = wavfile.read(wav_files[0], mmap=True)[0]
+        self.n_channels = len(mne.pick_types(self.epochs.info, eeg=True, exclude=[]))
+        self.chunk_duration_s = chunk_duration_s
+        self.realtime = realtime
+
+        # EEG samples per chunk and trial are multiples of this step, so they span a whole number of audio samples
+        self.step = int(self.sfreq_eeg / np.gcd(int(self.sfreq_wav), int(self.sfreq_eeg)))
+
+    def __iter__(self):
+        """ Yield chunks of audio (times), EEG (channels x times) and the time the chunk was complete. """
+        ratio = self.sfreq_wav / self.sfreq_eeg
+        chunk_samples = max(int(self.chunk_duration_s * self.sfreq_eeg) // self.step, 1) * self.step
+        zero_idx = int(self.epochs.time_as_index(0)[0])
+        eeg_picks = mne.pick_types(self.epochs.info, eeg=True, exclude=[])
+        start_time = time.perf_counter()
+        stream_samples = 0
+
+        for epoch_idx, wav_file in enumerate(self.trial_wavs):
+            _, audio = wavfile.read(wav_file, mmap=True)
+            audio = audio[:, 0] if audio.ndim == 2 else audio
+            eeg = self.epochs.get_data(copy=False)[epoch_idx, eeg_picks, zero_idx:]
+
+            n_trial = min(int(audio.shape[0] / ratio), eeg.shape[-1]) // self.step * self.step
+            for start in range(0, n_trial, chunk_samples):
+                stop = min(start + chunk_samples, n_trial)
+                audio_chunk = audio[int(round(start * ratio)):int(round(stop * ratio))]
+                if np.issubdtype(audio_chunk.dtype, np.integer):
+                    audio_chunk = audio_chunk / 2**15
+                stream_samples += stop - start
+
+                # A live source completes the chunk once its last sample is recorded
+                arrival = start_time + stream_samples / self.sfreq_eeg
+                if self.realtime:
+                    time.sleep(max(arrival - time.perf_counter(), 0))
+                else:
+                    arrival = time.perf_counter()
+
+                yield np.asarray(audio_chunk, dtype=float), eeg[:, start:stop], arrival
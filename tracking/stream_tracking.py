@@ -0,0 +1,110 @@
+""" Monitor envelope tracking live: replay a session chunk by chunk through the streaming PLV engine.
+
+The file replay source stands in for a live acquisition of the EEG and the audio, see `realtime.py`. Each chunk
+updates the running phase-locking value between the envelope and every EEG channel in each frequency band. The final
+values are stored as CSV, and the throughput and the latency of the updates as JSON.
+
+"""
+
+import json
+import time
+from pathlib import Path
+
+import brian2 as b2
+import brian2hears as b2h
+import mne
+import numpy as np
+import pandas as pd
+
+from realtime import FileReplaySource, StreamingPLV
+from tracking_utils import load_config
+
+mne.set_log_level('WARNING')
+
+
+def main():
+    # Load configuration
+    config = load_config('tracking_config.yaml')
+
+    # Set up folders and parameters
+    eeg_folder = Path(config['eeg_folder'])
+    speech_folder = Path(config['speech_folder'])
+    logs_folder = Path(config['logs_folder'])
+    output_folder = Path(config['output_folder'])
+    output_folder.mkdir(parents=True, exist_ok=True)
+
+    epochs_extension = config['files_parameters']['epochs_extension']
+    logs_txt_extension = config['files_parameters']['logs_txt_extension']
+    montage = mne.channels.make_standard_montage(config['files_parameters']['eeg_montage'])
+    channels_list = montage.ch_names
+    frequency_bands_dict = config['frequency_bands']
+
+    center_freqs = config['filtering_parameters']['gammatone_center_freqs']
+    center_freqs['low'] = center_freqs['low']*b2.Hz
+    center_freqs['high'] = center_freqs['high']*b2.Hz
+    center_freqs = np.asarray(b2h.erbspace(**center_freqs))
+    compression = config['filtering_parameters']['compression']
+    alias_dict = config['iir_parameters']['alias_dict']
+
+    streaming_parameters = config['streaming_parameters']
+    participant_id = streaming_parameters['participant_id']
+
+    wav_files = sorted(list(Path(speech_folder).rglob('*.wav')), key=lambda x: x.stem)
+    source = FileReplaySource(
+        eeg_folder / f'{participant_id}{epochs_extension}',
+        logs_folder / f'{participant_id}{logs_txt_extension}',
+        wav_files,
+        chunk_duration_s=streaming_parameters['chunk_duration_s'],
+        realtime=streaming_parameters['realtime']
+    )
+    engine = StreamingPLV(
+        sfreq_wav=source.sfreq_wav,
+        sfreq_eeg=source.sfreq_eeg,
+        n_channels=source.n_channels,
+        bands=frequency_bands_dict,
+        center_freqs=center_freqs,
+        compression=compression,
+        alias_dict=alias_dict,
+        time_constant_s=streaming_parameters['time_constant_s'],
+        warmup_s=streaming_parameters['warmup_s']
+    )
+
+    # Latency: time from the completion of a chunk until the PLV is updated with it
+    latencies = []
+    start_time = time.perf_counter()
+    for audio_chunk, eeg_chunk, arrival in source:
+        plv = engine.update(audio_chunk, eeg_chunk)
+        latencies.append(time.perf_counter() - arrival)
+    processing_s = time.perf_counter() - start_time
+
+    # Save the final running PLV in long format, and the throughput and latency of the stream
+    df = pd.DataFrame(plv, index=pd.Index(list(frequency_bands_dict), name='frequency_band'), columns=channels_list)
+    df_long = df.stack().reset_index()
+    df_long.columns = ['frequency_band', 'channel_id', 'tracking_value']
+    df_long.insert(0, 'participant_id', participant_id)
+    df_long.to_csv(output_folder / streaming_parameters['csv_filename'], index=False)
+
+    stream_s = engine.n_samples / source.sfreq_eeg
+    latencies = np.array(latencies)
+    stats = {
+        'participant_id': participant_id,
+        'n_chunks': int(latencies.shape[0]),
+        'stream_s': stream_s,
+        'processing_s': processing_s,
+        'realtime_factor': stream_s / processing_s,
+        'latency_median_ms': float(np.median(latencies) * 1e3),
+        'latency_p95_ms': float(np.percentile(latencies, 95) * 1e3),
+        'latency_max_ms': float(latencies.max() * 1e3)
+    }
+    with open(output_folder / streaming_parameters['stats_filename'], 'w') as file:
+        json.dump(stats, file, indent=1)
+
+    print(
+        f'{stream_s:.1f} s streamed in {processing_s:.1f} s ({stats["realtime_factor"]:.1f}x real time), '
+        f'latency median {stats["latency_median_ms"]:.1f} ms, 95th percentile {stats["latency_p95_ms"]:.1f} ms'
+    )
+
+
+if __name__ == '__main__':
+    print(f'Running {__file__}')
+    main()
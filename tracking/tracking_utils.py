@@ -1,11 +1,12 @@
 import yaml
 import numpy as np
+import pandas as pd
 from pathlib import Path
 from scipy.signal import hilbert
 
-import brian2 as b2
-import brian2hears as b2h
 import mne
+from instrumentation import instrument
+from ragged import RaggedArray
 
 
 def load_config(config_path: str) -> dict:
@@ -14,6 +15,7 @@ def load_config(config_path: str) -> dict:
         return yaml.safe_load(file)
 
 
+@instrument
 def extract_envelope(
         stimulus: Path,
         center_freqs: np.ndarray,
@@ -52,6 +54,10 @@ def extract_envelope(
         Envelope of the stimulus.
 
     """
+    # brian2 takes seconds to import and is only needed for the envelopes
+    import brian2 as b2
+    import brian2hears as b2h
+
     sound = b2h.loadsound(str(stimulus))
     gammatone = b2h.Gammatone(sound, center_freqs)
     filterbank = b2h.FunctionFilterbank(gammatone, lambda x: b2.clip(x, 0, b2.Inf)**(compression))
@@ -72,7 +78,8 @@ def extract_envelope(
     return envelope
 
 
-def extract_envelope_phase(
+@instrument
+def extract_envelope_band(
         envelope: np.ndarray,
         sfreq: float,
         sfreq_goal: float,
@@ -80,12 +87,11 @@ def extract_envelope_phase(
         freq_max: float,
         iir_params: dict
 ) -> np.ndarray:
-    """ Extract the phase of the envelope at the desired frequency band.
+    """ Band-pass filter and resample the envelope.
 
     Procedure:
     1. Band-pass filter the envelope.
     2. Resample the envelope.
-    3. Compute the phase of the envelope using the Hilbert transform.
 
     Parameters
     ----------
@@ -104,8 +110,8 @@ def extract_envelope_phase(
 
     Returns
     -------
-    phase_envelope : np.ndarray
-        Phase of the envelope at the desired frequency band.
+    band_envelope : np.ndarray
+        Envelope in the desired frequency band.
 
     """
     envelope = mne.filter.filter_data(
@@ -117,40 +123,81 @@ def extract_envelope_phase(
         iir_params=iir_params
     )
 
-    envelope = mne.filter.resample(envelope, down=sfreq / sfreq_goal, npad='auto')
+    band_envelope = mne.filter.resample(envelope, down=sfreq / sfreq_goal, npad='auto')
+
+    return band_envelope
+
+
+@instrument
+def extract_envelope_phase(
+        envelope: np.ndarray,
+        sfreq: float,
+        sfreq_goal: float,
+        freq_min: float,
+        freq_max: float,
+        iir_params: dict
+) -> np.ndarray:
+    """ Extract the phase of the envelope at the desired frequency band.
+
+    Procedure:
+    1. Band-pass filter and resample the envelope (see `extract_envelope_band`).
+    2. Compute the phase of the envelope using the Hilbert transform.
+
+    Parameters
+    ----------
+    envelope : np.ndarray
+        Envelope of the stimulus.
+    sfreq : float
+        Sampling frequency of the envelope.
+    sfreq_goal : float
+        Desired sampling frequency of the envelope.
+    freq_min : float
+        Lower frequency of the band-pass filter.
+    freq_max : float
+        Upper frequency of the band-pass filter.
+    iir_params : dict
+        Dictionary with the IIR filter parameters.
+
+    Returns
+    -------
+    phase_envelope : np.ndarray
+        Phase of the envelope at the desired frequency band.
+
+    """
+    envelope = extract_envelope_band(envelope, sfreq, sfreq_goal, freq_min, freq_max, iir_params)
 
     phase_envelope = np.angle(hilbert(envelope))
 
     return phase_envelope
 
 
-def extract_eeg_phase(
+@instrument
+def extract_eeg_band(
     epochs: mne.Epochs,
     sfreq: float,
     sfreq_goal: float,
-    freq_min: float,
+    freq_min: float | None,
     freq_max: float,
     iir_params: dict,
     tmax: float
 ) -> np.ndarray:
-    """ Extract the phase of the EEG signal at the desired frequency band.
+    """ Band-pass filter, decimate and crop the EEG signal.
 
     Procedure:
     1. Band-pass filter the EEG signal.
     2. Decimate the EEG signal.
     3. Crop the EEG signal to the desired length.
-    4. Compute the phase of the EEG signal using the Hilbert transform.
 
     Parameters
     ----------
     epochs : mne.Epochs
-        EEG epochs.
+        EEG epochs. Filtered, decimated and cropped in place.
     sfreq : float
         Sampling frequency of the EEG epochs.
     sfreq_goal : float
         Desired sampling frequency of the EEG epochs.
-    freq_min : float
-        Lower frequency of the band-pass filter.
+    freq_min : float | None
+        Lower frequency of the band-pass filter. If None, the EEG signal is only low-pass filtered.
     freq_max : float
         Upper frequency of the band-pass filter.
     iir_params : dict
@@ -160,8 +207,8 @@ def extract_eeg_phase(
 
     Returns
     -------
-    phase_eeg : np.ndarray
-        Phase of the EEG signal at the desired frequency band.
+    band_eeg : np.ndarray
+        EEG signal in the desired frequency band (epochs x channels x times), in epochs order.
 
     """
     epochs.filter(
@@ -172,32 +219,138 @@ def extract_eeg_phase(
     )
     epochs.decimate(sfreq / sfreq_goal)
     epochs.crop(tmin=0, tmax=tmax)
-    eeg = epochs.get_data(picks='eeg')
+    band_eeg = epochs.get_data(picks='eeg')
 
-    phase_eeg = np.angle(hilbert(eeg))
+    return band_eeg
 
-    return phase_eeg
 
+@instrument
+def extract_eeg_phase(
+    epochs: mne.Epochs,
+    sfreq: float,
+    sfreq_goal: float,
+    freq_min: float,
+    freq_max: float,
+    iir_params: dict,
+    tmax: float,
+    order: np.ndarray | None = None,
+    out: np.ndarray | RaggedArray | None = None
+) -> np.ndarray | RaggedArray:
+    """ Extract the phase of the EEG signal at the desired frequency band.
 
-def reorder_eeg_data(order_list: list, eeg: np.ndarray):
-    """ Reorder the EEG data according to the order of the stimuli.
+    Procedure:
+    1. Band-pass filter, decimate and crop the EEG signal (see `extract_eeg_band`).
+    2. Compute the phase of the EEG signal using the Hilbert transform, epoch by epoch in stimuli order.
 
     Parameters
     ----------
-    order_list : list
-        Order of the stimuli. Should reflect the order of the stimuli in the experiment.
-    eeg : np.ndarray
-        EEG data.
+    epochs : mne.Epochs
+        EEG epochs.
+    sfreq : float
+        Sampling frequency of the EEG epochs.
+    sfreq_goal : float
+        Desired sampling frequency of the EEG epochs.
+    freq_min : float
+        Lower frequency of the band-pass filter.
+    freq_max : float
+        Upper frequency of the band-pass filter.
+    iir_params : dict
+        Dictionary with the IIR filter parameters.
+    tmax : float
+        Desired length of the EEG signal in seconds.
+    order : np.ndarray | None
+        Permutation of the epochs as returned by `get_stimulus_order`. If None, the epochs order is kept.
+    out : np.ndarray | RaggedArray | None
+        Array of shape (n_epochs, n_channels, n_times) the phases are written into, e.g., a slice of a memory-mapped
+        band array. If a ragged array (channels x total samples), the phases of each stimulus are cut to its length,
+        see `ragged.py`. If None, a new array is allocated.
 
     Returns
     -------
-    sorted_eeg : np.ndarray
-        EEG data reordered according to the order of the stimuli.
+    phase_eeg : np.ndarray | RaggedArray
+        Phase of the EEG signal at the desired frequency band.
 
     """
-    sorted_order = sorted(order_list)
-    eeg_order_indices = {name: index for index, name in enumerate(order_list)}
-    new_order = [eeg_order_indices[name] for name in sorted_order]
-    sorted_eeg = eeg[new_order]
+    eeg = extract_eeg_band(epochs, sfreq, sfreq_goal, freq_min, freq_max, iir_params, tmax)
+
+    if order is None:
+        order = np.arange(eeg.shape[0])
+    elif order.shape[0] != eeg.shape[0]:
+        raise ValueError(f'Stimuli order has {order.shape[0]} entries but the EEG data contains {eeg.shape[0]} epochs.')
+
+    if isinstance(out, RaggedArray):
+        if len(out) != eeg.shape[0] or out.lengths.max() > eeg.shape[-1]:
+            raise ValueError(f'Ragged output of {len(out)} stimuli does not fit EEG phases of shape {eeg.shape}.')
 
-    return sorted_eeg
+        # The analytic signal of the whole cropped epoch, cut to the stimulus afterwards to keep the edges clean
+        for dst_idx, src_idx in enumerate(order):
+            analytic = hilbert(eeg[src_idx])[:, :out.lengths[dst_idx]]
+            out[dst_idx] = np.arctan2(analytic.imag, analytic.real)
+
+        return out
+
+    if out is None:
+        out = np.empty(eeg.shape)
+    elif out.shape != eeg.shape:
+        raise ValueError(f'Output array has shape {out.shape} but the EEG phases have shape {eeg.shape}.')
+
+    # One epoch at a time keeps the complex analytic signal small and lets the phase land in its final slot
+    for dst_idx, src_idx in enumerate(order):
+        analytic = hilbert(eeg[src_idx])
+        np.arctan2(analytic.imag, analytic.real, out=out[dst_idx])
+
+    phase_eeg = out
+
+    return phase_eeg
+
+
+def get_stimulus_order(log_df: pd.DataFrame, stimuli: list, event_codes: np.ndarray) -> np.ndarray:
+    """ Compute the permutation that sorts the EEG epochs into stimuli array order.
+
+    The permutation only depends on the participant log, so it is computed once per participant and reused for every
+    frequency band. It is validated against the epochs and the stimuli, as a log that does not match them would
+    otherwise silently misalign EEG and stimuli: the log must list each stimulus of the stimuli array once (a log name
+    matches the file stem up to a suffix, e.g., `context001` and `context001_70dB`), one per epoch, and, if the log
+    has a `trigger` column, its trigger codes must equal the event codes of the epochs.
+
+    Parameters
+    ----------
+    log_df : pd.DataFrame
+        Participant log with the stimuli in the order of the experiment (`file`) and, optionally, their trigger codes
+        (`trigger`).
+    stimuli : list
+        Names of the stimuli in stimuli array order, i.e., the stems of the sorted `.wav` files.
+    event_codes : np.ndarray
+        Event codes of the participant's EEG epochs (`epochs.events[:, 2]`).
+
+    Returns
+    -------
+    order : np.ndarray
+        Indices into the EEG epochs that yield the stimuli in sorted order.
+
+    """
+    order_array = np.asarray(log_df['file'].values, dtype=str)
+
+    if len(order_array) != len(event_codes):
+        raise ValueError(f'Log lists {len(order_array)} stimuli but the EEG file contains {len(event_codes)} epochs.')
+    if len(np.unique(order_array)) != len(order_array):
+        raise ValueError('Log contains duplicated stimuli, cannot determine the stimuli order.')
+    if len(order_array) != len(stimuli):
+        raise ValueError(f'Log lists {len(order_array)} stimuli but there are {len(stimuli)} stimulus files.')
+
+    order = np.argsort(order_array, kind='stable')
+
+    for name, stem in zip(order_array[order], stimuli):
+        if stem != name and not stem.startswith(f'{name}_'):
+            raise ValueError(f'Log stimuli do not match the stimulus files in sorted order: `{name}` vs `{stem}`.')
+
+    if 'trigger' in log_df:
+        mismatched = np.flatnonzero(log_df['trigger'].values != np.asarray(event_codes))
+        if mismatched.size:
+            epoch_idx = mismatched[0]
+            raise ValueError(
+                f'Log triggers differ from the EEG event codes in {mismatched.size} epochs, e.g., epoch {epoch_idx}: '
+                f'{log_df["trigger"].values[epoch_idx]} vs {event_codes[epoch_idx]}.'
+            )
+
+    return order
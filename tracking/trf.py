@@ -0,0 +1,222 @@
+""" Temporal response functions (TRFs): forward models mapping the speech envelope onto the EEG.
+
+The TRF of a channel is the ridge regression of its EEG on time-lagged copies of the envelope. Stimuli are modelled
+separately, so lagged samples never reach across stimulus boundaries (zeros are assumed outside a stimulus).
+
+Everything is computed from per-stimulus sufficient statistics of the lagged design matrix, which is never built:
+- The lagged auto-covariance of the envelope is computed via FFT and corrected for the samples shifted out of the
+  stimulus at its start and end, so it is exactly the covariance of the zero-padded design matrix.
+- The cross-covariances between the lagged envelope and the EEG are computed via FFT.
+- One eigendecomposition of the covariance yields the weights for all regularization parameters.
+- Leave-one-stimulus-out cross-validation scores (Pearson correlation between predicted and recorded EEG) are computed
+  from the held-out stimulus' statistics, batched over folds, regularization parameters and channels.
+
+"""
+
+import numpy as np
+from scipy.fft import irfft, next_fast_len, rfft
+
+
+def get_lags(tmin: float, tmax: float, sfreq: float) -> np.ndarray:
+    """ Lags in samples between `tmin` and `tmax` (seconds, positive: EEG follows the envelope). """
+    return np.arange(int(np.round(tmin * sfreq)), int(np.round(tmax * sfreq)) + 1)
+
+
+def lagged_statistics(envelope: np.ndarray, eeg: np.ndarray, lags: np.ndarray) -> dict:
+    """ Sufficient statistics of the lagged design matrix of one stimulus.
+
+    The design matrix `X` has one column per lag, `X[t, i] = envelope[t - lags[i]]`, with zeros outside the stimulus.
+
+    Parameters
+    ----------
+    envelope : np.ndarray
+        Envelope of the stimulus (times).
+    eeg : np.ndarray
+        EEG response to the stimulus (channels x times).
+    lags : np.ndarray
+        Consecutive lags in samples, see `get_lags`.
+
+    Returns
+    -------
+    statistics : dict
+        `xx`: X^T X (lags x lags), `xy`: X^T Y (lags x channels), `x_sum`: column sums of X (lags), `y_sum` and
+        `yy_sum`: sums of the EEG and its square (channels), and `n_times`.
+
+    """
+    n_times = envelope.shape[0]
+    n_lags = lags.shape[0]
+    max_lag = int(np.abs(lags).max())
+    n_fft = next_fast_len(n_times + max_lag + n_lags, real=True)
+
+    envelope_fft = rfft(envelope, n_fft)
+
+    # Auto-correlation of the zero-padded envelope for lag differences 0 .. n_lags - 1
+    autocorrelation = irfft(np.abs(envelope_fft)**2, n_fft)[:n_lags]
+
+    # Samples shifted out of the stimulus at its start (negative lags) and end (positive lags): products
+    # envelope[u] * envelope[u + d] summed over the first, and envelope[v] * envelope[v - d] over the last samples
+    n_head = max(-int(lags[0]), 0)
+    n_tail = max(int(lags[-1]), 0)
+    differences = np.arange(n_lags)[:, None]
+    padded = np.concatenate([np.zeros(n_lags), envelope, np.zeros(n_lags)])
+
+    head = np.arange(n_head)[None, :]
+    head_products = padded[n_lags + head] * padded[n_lags + head + differences]
+    head_sums = np.concatenate([np.zeros((n_lags, 1)), np.cumsum(head_products, axis=1)], axis=1)
+
+    tail = n_times - 1 - np.arange(n_tail)[None, :]
+    tail_products = padded[n_lags + tail] * padded[n_lags + tail - differences]
+    tail_sums = np.concatenate([np.zeros((n_lags, 1)), np.cumsum(tail_products, axis=1)], axis=1)
+
+    # X^T X from the auto-correlation, minus the products falling outside the stimulus for each pair of lags
+    rows, cols = np.meshgrid(np.arange(n_lags), np.arange(n_lags), indexing='ij')
+    low, high = np.minimum(rows, cols), np.maximum(rows, cols)
+    difference = high - low
+    xx = (
+        autocorrelation[difference]
+        - head_sums[difference, np.maximum(-lags[high], 0)]
+        - tail_sums[difference, np.maximum(lags[low], 0)]
+    )
+
+    # X^T Y: cross-correlation of the EEG with the envelope at each lag, wrapped negative lags at the end of the FFT
+    cross_correlation = irfft(rfft(eeg, n_fft) * np.conj(envelope_fft), n_fft)
+    xy = cross_correlation[:, lags % n_fft].T
+
+    # Column sums of X: sums of the envelope samples that stay within the stimulus at each lag
+    cumulative = np.concatenate([[0.0], np.cumsum(envelope)])
+    x_sum = cumulative[np.clip(n_times - lags, 0, n_times)] - cumulative[np.clip(-lags, 0, n_times)]
+
+    statistics = {
+        'xx': xx,
+        'xy': xy,
+        'x_sum': x_sum,
+        'y_sum': eeg.sum(axis=-1),
+        'yy_sum': (eeg**2).sum(axis=-1),
+        'n_times': n_times
+    }
+
+    return statistics
+
+
+def stack_statistics(statistics: list) -> dict:
+    """ Stack the statistics of several stimuli along a new first axis. """
+    return {key: np.stack([np.asarray(entry[key]) for entry in statistics]) for key in statistics[0]}
+
+
+def ridge_path(xx: np.ndarray, xy: np.ndarray, alphas: np.ndarray) -> np.ndarray:
+    """ Ridge regression weights for all regularization parameters from one eigendecomposition.
+
+    Parameters
+    ----------
+    xx : np.ndarray
+        Covariance of the design matrix (... x lags x lags). Leading axes are batched, e.g., cross-validation folds.
+    xy : np.ndarray
+        Cross-covariance of the design matrix and the EEG (... x lags x channels).
+    alphas : np.ndarray
+        Regularization parameters, relative to the mean eigenvalue of `xx`.
+
+    Returns
+    -------
+    weights : np.ndarray
+        Weights (... x alphas x lags x channels).
+
+    """
+    eigenvalues, eigenvectors = np.linalg.eigh(xx)
+    scale = eigenvalues.mean(axis=-1, keepdims=True)
+
+    projected = np.swapaxes(eigenvectors, -1, -2) @ xy
+    shrinkage = 1.0 / (eigenvalues[..., None, :] + alphas[:, None] * scale[..., None, :])
+    weights = eigenvectors[..., None, :, :] @ (shrinkage[..., :, :, None] * projected[..., None, :, :])
+
+    return weights
+
+
+def score(weights: np.ndarray, statistics: dict) -> np.ndarray:
+    """ Pearson correlation between the predicted and recorded EEG, computed from the sufficient statistics.
+
+    Parameters
+    ----------
+    weights : np.ndarray
+        Weights (... x alphas x lags x channels).
+    statistics : dict
+        Statistics of the evaluated stimuli, with the same leading axes as `weights`.
+
+    Returns
+    -------
+    scores : np.ndarray
+        Correlations (... x alphas x channels).
+
+    """
+    xx = statistics['xx'][..., None, :, :]
+    xy = statistics['xy'][..., None, :, :]
+    x_sum = statistics['x_sum'][..., None, :, None]
+    n_times = np.asarray(statistics['n_times'])[..., None, None]
+
+    # Sums of the prediction, its square and its product with the EEG
+    prediction_sum = (weights * x_sum).sum(axis=-2)
+    prediction_squares = (weights * (xx @ weights)).sum(axis=-2)
+    products = (weights * xy).sum(axis=-2)
+    y_sum = statistics['y_sum'][..., None, :]
+    yy_sum = statistics['yy_sum'][..., None, :]
+
+    covariance = products - prediction_sum * y_sum / n_times
+    prediction_variance = prediction_squares - prediction_sum**2 / n_times
+    eeg_variance = yy_sum - y_sum**2 / n_times
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        scores = covariance / np.sqrt(prediction_variance * eeg_variance)
+
+    return scores
+
+
+def fit_trf(
+    envelopes: list,
+    eeg: np.ndarray,
+    lags: np.ndarray,
+    alphas: np.ndarray
+) -> tuple[np.ndarray, float, np.ndarray]:
+    """ Fit a TRF with the regularization parameter chosen by leave-one-stimulus-out cross-validation.
+
+    Parameters
+    ----------
+    envelopes : list
+        Envelope of each stimulus (times).
+    eeg : np.ndarray
+        EEG responses in stimuli order (stimuli x channels x times).
+    lags : np.ndarray
+        Consecutive lags in samples, see `get_lags`.
+    alphas : np.ndarray
+        Regularization parameters, relative to the mean eigenvalue of the training covariance.
+
+    Returns
+    -------
+    weights : np.ndarray
+        TRF fitted on all stimuli with the best regularization parameter (lags x channels).
+    alpha : float
+        Regularization parameter with the best mean cross-validation score over stimuli and channels.
+    scores : np.ndarray
+        Cross-validation scores at the best regularization parameter, averaged over the held-out stimuli (channels).
+
+    """
+    if len(envelopes) != eeg.shape[0]:
+        raise ValueError(f'{len(envelopes)} envelopes but EEG responses to {eeg.shape[0]} stimuli.')
+    if len(envelopes) < 2:
+        raise ValueError('Leave-one-stimulus-out cross-validation needs at least two stimuli.')
+
+    alphas = np.asarray(alphas, dtype=float)
+    statistics = stack_statistics([
+        lagged_statistics(envelope, response, lags) for envelope, response in zip(envelopes, eeg)
+    ])
+
+    # Training statistics of all folds at once: totals minus the held-out stimulus
+    training = {key: value.sum(axis=0, keepdims=True) - value for key, value in statistics.items()}
+    fold_weights = ridge_path(training['xx'], training['xy'], alphas)
+    fold_scores = score(fold_weights, statistics)
+
+    mean_scores = np.nanmean(fold_scores, axis=0)
+    best = int(np.nanargmax(np.nanmean(mean_scores, axis=-1)))
+
+    totals = {key: value.sum(axis=0) for key, value in statistics.items()}
+    weights = ridge_path(totals['xx'], totals['xy'], alphas[best:best + 1])[0]
+
+    return weights, float(alphas[best]), mean_scores[best]